@@ -0,0 +1,93 @@
+"""Measure the latency of acquiring a socks5 server with and without the
+socks5s indexes.
+
+Usage: python benchmarks/bench_acquire.py [--rows 100000] [--acquires 500]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+
+from socks5man.misc import set_cwd
+
+COUNTRIES = [
+    ("Germany", "DE", "Berlin"), ("United States", "US", "Norwell"),
+    ("Netherlands", "NL", "Amsterdam"), ("France", "FR", "Paris"),
+    ("China", "CN", "Beijing"), ("Brazil", "BR", "Sao Paulo"),
+]
+
+INDEXES = [
+    "ix_socks5s_acquire", "ix_socks5s_country", "ix_socks5s_country_code",
+    "ix_socks5s_city"
+]
+
+def fill(db, rows):
+    batch = []
+    for i in range(rows):
+        country, code, city = random.choice(COUNTRIES)
+        batch.append({
+            "host": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "port": 1080,
+            "country": country,
+            "country_code": code,
+            "city": city,
+            "operational": random.random() < 0.7,
+            "bandwidth": random.uniform(0.5, 100),
+            "connect_time": random.uniform(0.01, 3),
+        })
+        if len(batch) >= 10000:
+            db.bulk_add_socks5(batch)
+            batch = []
+    if batch:
+        db.bulk_add_socks5(batch)
+
+def measure(db, acquires, **filters):
+    timings = []
+    for _ in range(acquires):
+        start = time.perf_counter()
+        db.find_socks5(**filters)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return {
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--acquires", type=int, default=500)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    set_cwd(tmpdir)
+    try:
+        from socks5man.database import Database
+        db = Database()
+        fill(db, args.rows)
+
+        results = {"rows": args.rows, "acquires": args.acquires}
+        for name in ("indexed", "unindexed"):
+            if name == "unindexed":
+                for index in INDEXES:
+                    db.engine.execute("DROP INDEX %s" % index)
+            results[name] = {
+                "any": measure(db, args.acquires),
+                "country": measure(db, args.acquires, country="germany"),
+                "city_code": measure(
+                    db, args.acquires, country_code="nl", city="amsterdam"
+                ),
+            }
+
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
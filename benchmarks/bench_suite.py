@@ -0,0 +1,277 @@
+"""Measure verification, acquiring, bulk adding and geo IP re-annotation
+performance against local fake socks5 servers.
+
+Each benchmark runs for each amount of servers in a new temporary socks5man
+cwd. The results are printed as JSON, and written to --output, so they can
+be compared between versions.
+
+Usage: python benchmarks/bench_suite.py [--sizes 1000,10000,100000]
+    [--benchmarks verify,acquire,bulk_add,reannotate] [--output FILE]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import configparser
+import ipaddress
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from socks5man.misc import cwd, create_cwd, set_cwd
+
+from fakes import FakeNetwork
+
+BENCHMARKS = ("verify", "acquire", "bulk_add", "reannotate")
+
+COUNTRIES = [
+    ("Germany", "DE", "Berlin"), ("United States", "US", "Norwell"),
+    ("Netherlands", "NL", "Amsterdam"), ("France", "FR", "Paris"),
+    ("China", "CN", "Beijing"), ("Brazil", "BR", "Sao Paulo"),
+]
+
+def summarize(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {}
+    return {
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+        "p99_ms": timings[int(len(timings) * 0.99)] * 1000,
+    }
+
+def public_ip(rng):
+    while True:
+        ip = ipaddress.IPv4Address(rng.getrandbits(32))
+        if ip.is_global:
+            return str(ip)
+
+def configure(options):
+    """Change options in the config of the current cwd"""
+    path = cwd("conf", "socks5man.conf")
+    config = configparser.ConfigParser()
+    config.read(path)
+    for (section, option), value in options.items():
+        config.set(section, option, str(value))
+    with open(path, "w") as fp:
+        config.write(fp)
+
+def prepare(options=None):
+    """Fill the current empty cwd, change the given config options and
+    create the database"""
+    create_cwd()
+    configure(options or {})
+    from socks5man.database import Database
+    Database().connect(create=True)
+    return cwd()
+
+def fill(size, hosts, operational=None, rng=None):
+    """Add 'size' socks5s with hosts and ports from the given list of
+    (host, port) tuples"""
+    from socks5man.database import Database
+    db = Database()
+    rng = rng or random.Random(1)
+    batch = []
+    for i in range(size):
+        country, code, city = rng.choice(COUNTRIES)
+        host, port = hosts[i % len(hosts)]
+        batch.append({
+            "host": host,
+            "port": port,
+            "country": country,
+            "country_code": code,
+            "city": city,
+            "operational": rng.random() < 0.7 if operational is None
+            else operational,
+            "bandwidth": rng.uniform(0.5, 100),
+            "connect_time": rng.uniform(0.01, 3),
+        })
+        if len(batch) >= 10000:
+            db.bulk_add_socks5(batch)
+            batch = []
+    if batch:
+        db.bulk_add_socks5(batch)
+
+def bench_verify(size, args, network):
+    prepare({
+        ("operationality", "ip_api"): network.url("/ip"),
+        ("operationality", "timeout"): 10,
+        ("connection_time", "hostname"): "127.0.0.1",
+        ("connection_time", "port"): network.http_port,
+        ("bandwidth", "enabled"): "yes" if args.file_size else "no",
+        ("bandwidth", "download_url"): network.url("/file"),
+        ("bandwidth", "times"): 1,
+        ("socks5man", "verify_workers"): args.workers,
+    })
+    from socks5man.database import Database
+    from socks5man.tools import verify_all
+    fill(size, [("127.0.0.1", port) for port in network.ports])
+
+    start = time.perf_counter()
+    verify_all(workers=args.workers)
+    seconds = time.perf_counter() - start
+    operational = sum(
+        count for _, state, count in Database().count_by_state() if state
+    )
+    return {
+        "seconds": seconds,
+        "servers_per_second": size / seconds,
+        "operational": operational,
+    }
+
+def _acquire_worker(path, acquires, use_pool, barrier, queue):
+    set_cwd(path)
+    logging.getLogger("socks5man").setLevel(logging.ERROR)
+    from socks5man.manager import Manager
+    manager = Manager(pool=use_pool)
+    barrier.wait()
+    timings = []
+    for _ in range(acquires):
+        start = time.perf_counter()
+        manager.acquire()
+        timings.append(time.perf_counter() - start)
+    manager.close()
+    queue.put(timings)
+
+def bench_acquire(size, args, network):
+    path = prepare()
+    fill(size, [(public_ip(random.Random(i)), 1080) for i in range(1000)])
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for name, use_pool in (("database", False), ("pool", True)):
+        barrier = ctx.Barrier(args.processes + 1)
+        queue = ctx.Queue()
+        workers = [
+            ctx.Process(target=_acquire_worker, args=(
+                path, args.acquires, use_pool, barrier, queue
+            )) for _ in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        timings = []
+        for _ in workers:
+            timings.extend(queue.get())
+        seconds = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+
+        result = summarize(timings)
+        result["acquires_per_second"] = len(timings) / seconds
+        results[name] = result
+
+    results["processes"] = args.processes
+    return results
+
+def bench_bulk_add(size, args, network):
+    prepare()
+    from socks5man.manager import Manager
+    rng = random.Random(2)
+    entries = (
+        {"host": public_ip(rng), "port": 1080} for _ in range(size)
+    )
+
+    start = time.perf_counter()
+    added = Manager().bulk_add(entries)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "servers_per_second": size / seconds,
+        "added": added,
+    }
+
+def bench_reannotate(size, args, network):
+    prepare()
+    from socks5man.tools import reannotate_geoinfo
+    rng = random.Random(3)
+    fill(size, [(public_ip(rng), 1080) for _ in range(size)])
+
+    start = time.perf_counter()
+    changed = reannotate_geoinfo()
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "servers_per_second": size / seconds,
+        "changed": changed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS))
+    parser.add_argument("--output", help="Also write the results to a file")
+    parser.add_argument(
+        "--servers", type=int, default=200,
+        help="The amount of fake socks5 servers. The added socks5s are "
+             "spread over the fake servers"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01,
+        help="Seconds the fake socks5 servers wait before replying"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float,
+        help="Mbit/s of the fake socks5 servers. Unlimited by default"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.1,
+        help="Fraction of requests the fake socks5 servers refuse"
+    )
+    parser.add_argument(
+        "--file-size", type=int, default=100000,
+        help="Bytes of the bandwidth test file. 0 disables the bandwidth "
+             "approximation"
+    )
+    parser.add_argument("--workers", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--acquires", type=int, default=1000)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    benchmarks = args.benchmarks.split(",")
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: %s" % name)
+
+    logging.getLogger("socks5man").setLevel(logging.ERROR)
+    results = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "timestamp": time.time(),
+        "options": vars(args),
+        "results": [],
+    }
+    network = FakeNetwork(
+        servers=args.servers, latency=args.latency,
+        bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+        file_size=args.file_size or 1, seed=4
+    )
+    with network:
+        for name in benchmarks:
+            for size in sizes:
+                path = tempfile.mkdtemp()
+                set_cwd(path)
+                try:
+                    result = globals()["bench_%s" % name](
+                        size, args, network
+                    )
+                finally:
+                    shutil.rmtree(path)
+                result.update(benchmark=name, size=size)
+                results["results"].append(result)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+if __name__ == "__main__":
+    main()
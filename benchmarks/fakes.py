@@ -0,0 +1,211 @@
+"""Local fake SOCKS5 servers and a HTTP server for benchmarks.
+
+The fake socks5 servers relay CONNECT requests like real servers, with a
+configurable latency, bandwidth and failure rate. The HTTP server answers
+'/ip' with the IP of the client, like the operationality IP api, and '/file'
+with a test file for the bandwidth approximation. Everything runs on one
+event loop in a separate process, so serving does not take CPU time from the
+measured process.
+"""
+from __future__ import absolute_import
+import asyncio
+import multiprocessing
+import random
+import struct
+
+SOCKS_VERSION = 0x05
+REPLY_SUCCEEDED = 0x00
+REPLY_GENERAL_FAILURE = 0x01
+
+async def relay(reader, writer, bandwidth=None, chunk_size=65536):
+    """Copy data until EOF. Limits the speed to 'bandwidth' Mbit/s"""
+    try:
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+            if bandwidth:
+                await asyncio.sleep(len(data) * 8 / (bandwidth * 1000000))
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+class FakeSocks5Server(object):
+    """SOCKS5 server without authentication that relays CONNECT requests.
+    Waits 'latency' seconds before replying to a request and refuses a
+    'failure_rate' fraction of the requests"""
+
+    def __init__(self, latency=0, bandwidth=None, failure_rate=0, rng=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.random = rng or random.Random()
+        self.server = None
+
+    async def start(self, host="127.0.0.1"):
+        self.server = await asyncio.start_server(self.handle, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        upstream_writer = None
+        try:
+            _, nmethods = await reader.readexactly(2)
+            await reader.readexactly(nmethods)
+            writer.write(struct.pack("!BB", SOCKS_VERSION, 0x00))
+
+            _, _, _, atyp = await reader.readexactly(4)
+            if atyp == 0x01:
+                host = ".".join(str(b) for b in await reader.readexactly(4))
+            elif atyp == 0x03:
+                length = (await reader.readexactly(1))[0]
+                host = (await reader.readexactly(length)).decode("idna")
+            else:
+                return
+            port = struct.unpack("!H", await reader.readexactly(2))[0]
+
+            if self.latency:
+                await asyncio.sleep(self.latency)
+
+            reply = REPLY_SUCCEEDED
+            if self.random.random() < self.failure_rate:
+                reply = REPLY_GENERAL_FAILURE
+            else:
+                try:
+                    upstream_reader, upstream_writer = \
+                        await asyncio.open_connection(host, port)
+                except OSError:
+                    reply = REPLY_GENERAL_FAILURE
+
+            writer.write(struct.pack(
+                "!BBBB4sH", SOCKS_VERSION, reply, 0x00, 0x01, b"\x00" * 4, 0
+            ))
+            if reply != REPLY_SUCCEEDED:
+                return
+
+            await asyncio.gather(
+                relay(reader, upstream_writer),
+                relay(upstream_reader, writer, bandwidth=self.bandwidth)
+            )
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if upstream_writer:
+                upstream_writer.close()
+            writer.close()
+
+class FakeHTTPServer(object):
+    """HTTP server that answers '/ip' with the IP of the client and
+    '/file' with 'file_size' bytes"""
+
+    def __init__(self, file_size=1000000):
+        self.file_size = file_size
+        self.server = None
+
+    async def start(self, host="127.0.0.1"):
+        self.server = await asyncio.start_server(self.handle, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1].decode("utf-8")
+            if path == "/ip":
+                self._respond(
+                    writer, 200,
+                    writer.get_extra_info("peername")[0].encode("utf-8")
+                )
+            elif path == "/file":
+                writer.write((
+                    "HTTP/1.1 200 OK\r\nContent-Length: %s\r\n"
+                    "Connection: close\r\n\r\n" % self.file_size
+                ).encode("utf-8"))
+                chunk = b"\x00" * 65536
+                remaining = self.file_size
+                while remaining > 0:
+                    writer.write(chunk[:remaining])
+                    remaining -= len(chunk)
+                    await writer.drain()
+            else:
+                self._respond(writer, 404, b"Not found")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, body):
+        writer.write((
+            "HTTP/1.1 %s %s\r\nContent-Length: %s\r\n"
+            "Connection: close\r\n\r\n" % (
+                status, "OK" if status == 200 else "Not Found", len(body)
+            )
+        ).encode("utf-8") + body)
+
+def _serve(conn, servers, latency, bandwidth, failure_rate, file_size,
+           seed):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    rng = random.Random(seed)
+    http_port = loop.run_until_complete(
+        FakeHTTPServer(file_size=file_size).start()
+    )
+    ports = [
+        loop.run_until_complete(FakeSocks5Server(
+            latency=latency, bandwidth=bandwidth,
+            failure_rate=failure_rate, rng=rng
+        ).start()) for _ in range(servers)
+    ]
+    conn.send((http_port, ports))
+    # Serve until the parent closes the pipe
+    loop.add_reader(conn.fileno(), loop.stop)
+    loop.run_forever()
+
+class FakeNetwork(object):
+    """Runs 'servers' fake socks5 servers and a fake HTTP server in a
+    separate process"""
+
+    def __init__(self, servers=100, latency=0, bandwidth=None,
+                 failure_rate=0, file_size=1000000, seed=None):
+        self.servers = servers
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.file_size = file_size
+        self.seed = seed
+        self.process = None
+        self.conn = None
+        self.http_port = None
+        self.ports = []
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(
+            child_conn, self.servers, self.latency, self.bandwidth,
+            self.failure_rate, self.file_size, self.seed
+        ))
+        self.process.daemon = True
+        self.process.start()
+        self.http_port, self.ports = self.conn.recv()
+        return self
+
+    def stop(self):
+        if self.conn:
+            self.conn.close()
+        if self.process:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def url(self, path):
+        return "http://127.0.0.1:%s%s" % (self.http_port, path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
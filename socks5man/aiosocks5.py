@@ -0,0 +1,360 @@
+from __future__ import absolute_import
+import asyncio
+import logging
+import socket
+import ssl
+import struct
+import urllib.parse
+
+from socks5man.exceptions import Socks5ClientError
+
+log = logging.getLogger(__name__)
+
+SOCKS_VERSION = 0x05
+USERPASS_VERSION = 0x01
+
+AUTH_NONE = 0x00
+AUTH_USERPASS = 0x02
+AUTH_NO_ACCEPTABLE = 0xFF
+
+CMD_CONNECT = 0x01
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+REPLIES = {
+    0x01: "General SOCKS server failure",
+    0x02: "Connection not allowed by ruleset",
+    0x03: "Network unreachable",
+    0x04: "Host unreachable",
+    0x05: "Connection refused",
+    0x06: "TTL expired",
+    0x07: "Command not supported",
+    0x08: "Address type not supported",
+}
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+def run(coro):
+    """Run the given coroutine on a new event loop and return its result.
+    Used by the synchronous API. Code that already runs on an event loop
+    should await the coroutines instead."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+async def recv_exactly(sock, size):
+    """Receive exactly 'size' bytes from the given non-blocking socket"""
+    loop = asyncio.get_event_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise Socks5ClientError("Connection closed by socks5 server")
+        data += chunk
+
+    return data
+
+async def readline(reader):
+    """Read a line from the given stream reader
+    @raise Socks5ClientError: if the line is longer than the reader limit"""
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError) as e:
+        raise Socks5ClientError("Invalid line in HTTP response: %s" % e)
+
+def encode_address(host, port):
+    """Encode the given host and port as a SOCKS5 address (RFC 1928).
+    Hostnames are resolved by the socks5 server."""
+    try:
+        return struct.pack(
+            "!B4sH", ATYP_IPV4, socket.inet_aton(host), port
+        )
+    except (socket.error, TypeError):
+        pass
+
+    try:
+        return struct.pack(
+            "!B16sH", ATYP_IPV6, socket.inet_pton(socket.AF_INET6, host), port
+        )
+    except (socket.error, TypeError):
+        pass
+
+    name = host.encode("idna")
+    if len(name) > 255:
+        raise Socks5ClientError("Hostname too long: %s" % host)
+    return struct.pack("!BB", ATYP_DOMAIN, len(name)) + name + struct.pack(
+        "!H", port
+    )
+
+async def handshake(sock, dest_host, dest_port, username=None,
+                    password=None):
+    """Perform the SOCKS5 greeting, optional username/password
+    authentication (RFC 1929) and the CONNECT request on a socket that is
+    connected to a socks5 server.
+    @raise Socks5ClientError: if the socks5 server refuses or replies with
+    an invalid message"""
+    loop = asyncio.get_event_loop()
+    methods = [AUTH_NONE]
+    if username is not None and password is not None:
+        methods.append(AUTH_USERPASS)
+
+    await loop.sock_sendall(
+        sock, struct.pack("!BB", SOCKS_VERSION, len(methods)) + bytes(methods)
+    )
+    version, method = struct.unpack("!BB", await recv_exactly(sock, 2))
+    if version != SOCKS_VERSION:
+        raise Socks5ClientError(
+            "Server replied with invalid SOCKS version: %s" % version
+        )
+
+    if method == AUTH_USERPASS:
+        if username is None or password is None:
+            raise Socks5ClientError(
+                "Server requires authentication, but no credentials provided"
+            )
+        user = username.encode("utf-8")
+        passwd = password.encode("utf-8")
+        await loop.sock_sendall(
+            sock, struct.pack("!BB", USERPASS_VERSION, len(user)) + user +
+            struct.pack("!B", len(passwd)) + passwd
+        )
+        _, status = struct.unpack("!BB", await recv_exactly(sock, 2))
+        if status != 0x00:
+            raise Socks5ClientError("Authentication failed")
+
+    elif method != AUTH_NONE:
+        raise Socks5ClientError("No acceptable authentication method")
+
+    await loop.sock_sendall(
+        sock, struct.pack("!BBB", SOCKS_VERSION, CMD_CONNECT, 0x00) +
+        encode_address(dest_host, dest_port)
+    )
+    version, reply, _, atyp = struct.unpack(
+        "!BBBB", await recv_exactly(sock, 4)
+    )
+    if version != SOCKS_VERSION:
+        raise Socks5ClientError(
+            "Server replied with invalid SOCKS version: %s" % version
+        )
+    if reply != 0x00:
+        raise Socks5ClientError(
+            "CONNECT failed: %s" % REPLIES.get(reply, "Unknown error")
+        )
+
+    # Read and discard the bound address and port
+    if atyp == ATYP_IPV4:
+        await recv_exactly(sock, 4 + 2)
+    elif atyp == ATYP_IPV6:
+        await recv_exactly(sock, 16 + 2)
+    elif atyp == ATYP_DOMAIN:
+        length = struct.unpack("!B", await recv_exactly(sock, 1))[0]
+        await recv_exactly(sock, length + 2)
+    else:
+        raise Socks5ClientError("Unknown address type in reply: %s" % atyp)
+
+async def connect(proxy_host, proxy_port, dest_host, dest_port,
+                  username=None, password=None):
+    """Open a connection to dest_host:dest_port through the given socks5
+    server.
+    @return: A connected non-blocking socket"""
+    loop = asyncio.get_event_loop()
+    infos = await loop.getaddrinfo(
+        proxy_host, proxy_port, type=socket.SOCK_STREAM
+    )
+    if not infos:
+        raise Socks5ClientError("Cannot resolve socks5 host %s" % proxy_host)
+
+    family, socktype, proto, _, addr = infos[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, addr)
+        await handshake(
+            sock, dest_host, dest_port, username=username, password=password
+        )
+    except BaseException:
+        sock.close()
+        raise
+
+    return sock
+
+async def open_connection(proxy_host, proxy_port, dest_host, dest_port,
+                          username=None, password=None, use_ssl=False):
+    """Open a connection through the given socks5 server and wrap it in
+    asyncio streams.
+    @return: A (StreamReader, StreamWriter) tuple"""
+    sock = await connect(
+        proxy_host, proxy_port, dest_host, dest_port, username=username,
+        password=password
+    )
+    if use_ssl:
+        return await asyncio.open_connection(
+            sock=sock, ssl=ssl.create_default_context(),
+            server_hostname=dest_host
+        )
+    return await asyncio.open_connection(sock=sock)
+
+class HTTPResponse(object):
+    """A minimal HTTP/1.1 response. The body can be read in chunks using
+    read()."""
+
+    def __init__(self, status, headers, reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self._remaining = None
+        self._chunked = False
+        self._eof = False
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            self._chunked = True
+        elif "content-length" in headers:
+            try:
+                self._remaining = int(headers["content-length"])
+            except ValueError:
+                raise Socks5ClientError(
+                    "Invalid Content-Length: %s" % headers["content-length"]
+                )
+
+    async def _read_chunk_size(self):
+        line = await readline(self.reader)
+        try:
+            return int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise Socks5ClientError("Invalid chunk size: %r" % line)
+
+    async def read(self, size=65536):
+        """Read up to 'size' bytes of the body. Returns an empty bytes
+        object if the complete body has been read"""
+        if self._eof:
+            return b""
+
+        if self._chunked:
+            if not self._remaining:
+                self._remaining = await self._read_chunk_size()
+                if self._remaining == 0:
+                    # Consume optional trailers and the final CRLF
+                    while (await readline(self.reader)).strip():
+                        pass
+                    self._eof = True
+                    return b""
+            data = await self.reader.read(min(size, self._remaining))
+            if not data:
+                raise Socks5ClientError("Connection closed mid-chunk")
+            self._remaining -= len(data)
+            if not self._remaining:
+                await self.reader.readexactly(2)
+            return data
+
+        if self._remaining is not None:
+            if not self._remaining:
+                self._eof = True
+                return b""
+            data = await self.reader.read(min(size, self._remaining))
+            if not data:
+                raise Socks5ClientError("Connection closed before end of body")
+            self._remaining -= len(data)
+            return data
+
+        data = await self.reader.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    async def read_all(self):
+        """Read the complete body"""
+        body = []
+        while True:
+            data = await self.read()
+            if not data:
+                break
+            body.append(data)
+
+        return b"".join(body)
+
+    def close(self):
+        self.writer.close()
+
+async def http_open(url, proxy_host, proxy_port, username=None,
+                    password=None, redirects=5):
+    """Send a HTTP/1.1 GET request for the given URL through the given
+    socks5 server and read the response status and headers. Redirects
+    are followed.
+    @return: A HTTPResponse object. The caller should close it.
+    @raise Socks5ClientError: on protocol errors or non 2xx responses"""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https"):
+        raise Socks5ClientError("Unsupported URL scheme: %s" % url)
+
+    use_ssl = parsed.scheme == "https"
+    port = parsed.port or (443 if use_ssl else 80)
+    path = parsed.path or "/"
+    if parsed.query:
+        path = "%s?%s" % (path, parsed.query)
+
+    reader, writer = await open_connection(
+        proxy_host, proxy_port, parsed.hostname, port, username=username,
+        password=password, use_ssl=use_ssl
+    )
+    try:
+        writer.write((
+            "GET %s HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "User-Agent: socks5man\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: close\r\n\r\n" % (path, parsed.netloc)
+        ).encode("utf-8"))
+        await writer.drain()
+
+        statusline = await readline(reader)
+        parts = statusline.decode("iso-8859-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise Socks5ClientError("Invalid HTTP status line: %r" % statusline)
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise Socks5ClientError("Invalid HTTP status line: %r" % statusline)
+
+        headers = {}
+        while True:
+            line = await readline(reader)
+            if not line.strip():
+                break
+            key, _, value = line.decode("iso-8859-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        if status in REDIRECT_CODES and headers.get("location"):
+            location = urllib.parse.urljoin(url, headers["location"])
+        elif status < 200 or status >= 300:
+            raise Socks5ClientError("HTTP error %s for: %s" % (status, url))
+        else:
+            return HTTPResponse(status, headers, reader, writer)
+    except BaseException:
+        writer.close()
+        raise
+
+    writer.close()
+    if redirects <= 0:
+        raise Socks5ClientError("Too many redirects for: %s" % url)
+    return await http_open(
+        location, proxy_host, proxy_port, username=username,
+        password=password, redirects=redirects - 1
+    )
+
+async def http_get(url, proxy_host, proxy_port, username=None,
+                   password=None):
+    """Perform a HTTP GET request for the given URL through the given socks5
+    server.
+    @return: The response body (bytes)"""
+    response = await http_open(
+        url, proxy_host, proxy_port, username=username, password=password
+    )
+    try:
+        return await response.read_all()
+    finally:
+        response.close()
@@ -13,10 +13,17 @@ def confbool(val):
 class Config(object):
 
     _cache = {}
+    _defaults = {}
     _conf = {
         "socks5man": {
             "verify_interval": int,
-            "bandwidth_interval": int
+            "bandwidth_interval": int,
+            "verify_workers": int,
+            "bulk_batch_size": int,
+            "result_batch_size": int,
+            "result_flush_interval": int,
+            "policy": str,
+            "policy_candidates": int
         },
         "operationality": {
             "ip_api": str,
@@ -32,33 +39,83 @@ class Config(object):
             "enabled": confbool,
             "download_url": str,
             "times": int,
-            "timeout": int
+            "timeout": int,
+            "max_bytes": int,
+            "max_time": int,
+            "chunk_size": int
         },
         "geodb": {
             "geodb_url": str,
-            "geodb_md5_url": str
+            "geodb_md5_url": str,
+            "update_chunk_size": int
+        },
+        "database": {
+            "journal_mode": str,
+            "synchronous": str,
+            "busy_timeout": int,
+            "cache_size": int,
+            "mmap_size": int,
+            "pool_size": int
+        },
+        "leases": {
+            "max_per_socks5": int,
+            "expire": int,
+            "max_failures": int
+        },
+        "pool": {
+            "sync_interval": int,
+            "refresh_interval": int,
+            "max_age": int
+        },
+        "gateway": {
+            "host": str,
+            "port": int,
+            "connect_attempts": int,
+            "connect_timeout": int,
+            "buffer_size": int
+        },
+        "dns": {
+            "cache_ttl": int,
+            "negative_ttl": int,
+            "workers": int
+        },
+        "scheduler": {
+            "min_interval": int,
+            "stable_interval": int,
+            "stable_checks": int,
+            "max_interval": int,
+            "backoff_factor": float,
+            "flap_window": int,
+            "recent_use": int,
+            "refresh_interval": int
+        },
+        "history": {
+            "retention": int,
+            "downsample_after": int,
+            "downsample_interval": int,
+            "compact_interval": int
+        },
+        "metrics": {
+            "enabled": confbool,
+            "host": str,
+            "port": int,
+            "textfile": str,
+            "textfile_interval": int
         }
     }
 
-    def read(self):
-        if Config._cache:
-            Config._cache = {}
-
+    def _parse(self, *paths):
+        """Read the config files into a dict of sections with typed option
+        values. Options of later files override those of earlier files"""
         config = configparser.ConfigParser()
-
-        confpath = cwd("conf", "socks5man.conf")
-        if not os.path.isfile(confpath):
-            raise Socks5ConfigError(
-                "Cannot read config. Config file '%s' does not exist" %
-                confpath
-            )
         try:
-            config.read(confpath)
+            config.read(paths)
         except configparser.Error as e:
             raise Socks5ConfigError(
                 "Cannot parse config file. Error: %s" % e
             )
 
+        values = {}
         for section in config.sections():
             if section not in self._conf:
                 raise Socks5ConfigError(
@@ -66,8 +123,8 @@ class Config(object):
                     " the config class to prevent this error." % section
                 )
 
-            if section not in Config._cache:
-                Config._cache[section] = {}
+            if section not in values:
+                values[section] = {}
 
             for k in config.options(section):
                 option_type = self._conf[section].get(k)
@@ -89,22 +146,61 @@ class Config(object):
                         )
                     )
 
-                Config._cache[section][k] = value
+                values[section][k] = value
 
-def cfg(*args):
-    if not Config._cache:
-        Config().read()
+        return values
+
+    def read(self):
+        if Config._cache:
+            Config._cache = {}
+
+        confpath = cwd("conf", "socks5man.conf")
+        if not os.path.isfile(confpath):
+            raise Socks5ConfigError(
+                "Cannot read config. Config file '%s' does not exist" %
+                confpath
+            )
+
+        # The config shipped with socks5man holds the default of every
+        # option. The config of the cwd is only copied once, so it lacks
+        # options that were added after it was created.
+        Config._cache = self._parse(
+            cwd("conf", "socks5man.conf", internal=True), confpath
+        )
 
+    def read_defaults(self):
+        Config._defaults = self._parse(
+            cwd("conf", "socks5man.conf", internal=True)
+        )
+
+def _lookup(values, args):
     val = None
     for arg in args:
         try:
             if val:
                 val = val[arg]
             else:
-                val = Config._cache[arg]
+                val = values[arg]
         except KeyError:
             raise Socks5ConfigError(
                 "Tried to read non-existing config option: %s" % str(args)
             )
 
     return val
+
+def cfg(*args):
+    """Read a config option of the socks5man cwd. Options missing from its
+    config have the value of the config shipped with socks5man"""
+    # The cache is cleared when the socks5man cwd changes
+    if not Config._cache:
+        Config().read()
+
+    return _lookup(Config._cache, args)
+
+def cfg_default(*args):
+    """Read the default value of a config option from the config shipped
+    with socks5man. For when the config of the cwd may not exist yet"""
+    if not Config._defaults:
+        Config().read_defaults()
+
+    return _lookup(Config._defaults, args)
@@ -1,24 +1,37 @@
 from __future__ import absolute_import
+import calendar
 import logging
+import math
 import os
-from datetime import datetime
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from sqlalchemy import (
     Column, Integer, String, DateTime, Boolean, Text, create_engine,
-    Float, and_, func
+    Float, ForeignKey, Index, and_, bindparam, case, cast, event, exists,
+    func, literal, select, text, union_all
 )
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
-from socks5man.exceptions import Socks5manError, Socks5manDatabaseError
+from socks5man import metrics
+from socks5man.config import cfg, cfg_default
+from socks5man.exceptions import (
+    Socks5manError, Socks5manDatabaseError, Socks5ConfigError
+)
 from socks5man.misc import cwd, Singleton
 
 log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
-SCHEMA_VERSION = "2910ee00d182"
+SCHEMA_VERSION = "4d1f6b8e3a29"
 
 
 class AlembicVersion(Base):
@@ -44,9 +57,30 @@ class Socks5(Base):
     operational = Column(Boolean, nullable=False, default=False)
     bandwidth = Column(Float(), nullable=True)
     connect_time = Column(Float(), nullable=True)
+    ttfb = Column(Float(), nullable=True)
     description = Column(Text(), nullable=True)
     dnsport = Column(Integer(), nullable=True)
     private = Column(Boolean, nullable=True)
+    lease_latency = Column(Float(), nullable=True)
+    lease_failures = Column(
+        Integer(), nullable=False, default=0, server_default="0"
+    )
+    # The time of the last failed check or failed lease
+    last_failure = Column(DateTime(), nullable=True)
+    uptime = Column(Float(), nullable=True)
+    connect_time_ewma = Column(Float(), nullable=True)
+    connect_time_p95 = Column(Float(), nullable=True)
+    check_failures = Column(
+        Integer(), nullable=False, default=0, server_default="0"
+    )
+    # The amount of checks and successful checks in the check history,
+    # used to calculate the uptime
+    check_count = Column(
+        Integer(), nullable=False, default=0, server_default="0"
+    )
+    check_successes = Column(
+        Integer(), nullable=False, default=0, server_default="0"
+    )
 
     def __init__(self, host, port, country, country_code, private):
         self.host = host
@@ -80,13 +114,250 @@ class Socks5(Base):
         )
 
 
+# The columns of socks5s that can be exported, in table order
+EXPORT_COLUMNS = tuple(column.name for column in Socks5.__table__.columns)
+
+def export_columns(columns=None):
+    """Returns the list of column names to export. Accepts a list or a
+    comma separated string of column names. All columns if not given
+    @raise ValueError: if a column does not exist"""
+    if not columns:
+        return list(EXPORT_COLUMNS)
+    if isinstance(columns, str):
+        columns = columns.split(",")
+
+    columns = [c.strip() for c in columns if c.strip()]
+    unknown = [c for c in columns if c not in EXPORT_COLUMNS]
+    if unknown:
+        raise ValueError(
+            "Unknown column(s) %s. Choose from: %s" % (
+                ", ".join(unknown), ", ".join(EXPORT_COLUMNS)
+            )
+        )
+    return columns
+
+
+class Socks5Lease(Base):
+    __tablename__ = "socks5_leases"
+
+    id = Column(Integer(), primary_key=True)
+    socks5_id = Column(Integer(), ForeignKey("socks5s.id"), nullable=False)
+    acquired_on = Column(DateTime(), nullable=False)
+    expires_on = Column(DateTime(), nullable=False)
+
+    def __repr__(self):
+        return "<Socks5Lease(id=%s, socks5_id=%s, expires_on=%s)>" % (
+            self.id, self.socks5_id, self.expires_on
+        )
+
+class Socks5Check(Base):
+    """The results of checks of a socks5. A row holds the result of a single
+    check, or the combined results of the checks in a period after old
+    checks are downsampled"""
+    __tablename__ = "socks5_checks"
+
+    id = Column(Integer(), primary_key=True)
+    socks5_id = Column(Integer(), ForeignKey("socks5s.id"), nullable=False)
+    checked_on = Column(DateTime(), nullable=False)
+    checks = Column(Integer(), nullable=False, default=1)
+    successes = Column(Integer(), nullable=False)
+    connect_time = Column(Float(), nullable=True)
+    bandwidth = Column(Float(), nullable=True)
+    downsampled = Column(
+        Boolean, nullable=False, default=False, server_default="0"
+    )
+
+    def __repr__(self):
+        return "<Socks5Check(socks5_id=%s, checked_on=%s, checks=%s)>" % (
+            self.socks5_id, self.checked_on, self.checks
+        )
+
+
+# Indexes for the acquire ordering and the case-insensitive geo filters.
+# The acquire index starts with operational, as acquiring always filters on
+# it, and its column order and directions match ACQUIRE_ORDER, so SQLite can
+# return the first matching socks5s without sorting the table.
+Index(
+    "ix_socks5s_acquire", Socks5.operational, Socks5.last_use,
+    Socks5.last_check.desc(), Socks5.connect_time, Socks5.bandwidth.desc()
+)
+Index("ix_socks5s_country", func.lower(Socks5.country))
+Index("ix_socks5s_country_code", func.lower(Socks5.country_code))
+Index("ix_socks5s_city", func.lower(Socks5.city))
+Index(
+    "ix_socks5_leases_socks5_id", Socks5Lease.socks5_id,
+    Socks5Lease.expires_on
+)
+Index("ix_socks5_leases_expires_on", Socks5Lease.expires_on)
+Index(
+    "ix_socks5_checks_socks5_id", Socks5Check.socks5_id,
+    Socks5Check.checked_on
+)
+Index("ix_socks5_checks_checked_on", Socks5Check.checked_on)
+Index(
+    "ix_socks5_checks_downsampled", Socks5Check.downsampled,
+    Socks5Check.checked_on
+)
+
+# The weight of a newly observed latency in the average latency of a socks5
+LEASE_LATENCY_WEIGHT = 0.3
+
+# The lease latency in seconds used to weigh the active leases of socks5s
+# of which no lease latency was observed yet
+DEFAULT_LEASE_LATENCY = 1.0
+
+# The weight of a new connection time in the connect_time_ewma of a socks5
+CONNECT_TIME_WEIGHT = 0.3
+
+# The amount of latest connection times the connect_time_p95 is
+# calculated from
+P95_SAMPLES = 100
+
+ACQUIRE_ORDER = (
+    Socks5.last_use.asc(), Socks5.last_check.desc(),
+    Socks5.connect_time.asc(), Socks5.bandwidth.desc()
+)
+
+def acquire_order_key(socks5):
+    """Sort key that orders socks5s like ACQUIRE_ORDER does in SQLite, where
+    NULL values are the smallest"""
+    def asc(value):
+        return (value is not None, value)
+
+    def desc(value):
+        if value is None:
+            return (1, 0)
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        return (0, -value)
+
+    return (
+        asc(socks5.last_use), desc(socks5.last_check),
+        asc(socks5.connect_time), desc(socks5.bandwidth)
+    )
+
+# Orders find_socks5 can use instead of ACQUIRE_ORDER. The socks5 column
+# to sort on and if higher values are better
+FIND_ORDERS = {
+    "uptime": ("uptime", True),
+    "connect_time": ("connect_time_ewma", False),
+    "connect_time_p95": ("connect_time_p95", False),
+}
+
+def find_order(order_by=None):
+    """Returns the ORDER BY clauses and the matching sort key function for
+    the given FIND_ORDERS name, or ACQUIRE_ORDER if no name is given.
+    Socks5s of which the value is unknown come last. Socks5s with equal
+    values are ordered like ACQUIRE_ORDER
+    @raise ValueError: if the order name is unknown"""
+    if not order_by:
+        return ACQUIRE_ORDER, acquire_order_key
+    if order_by not in FIND_ORDERS:
+        raise ValueError(
+            "Unknown order '%s'. Choose from: %s" % (
+                order_by, ", ".join(sorted(FIND_ORDERS))
+            )
+        )
+
+    name, descending = FIND_ORDERS[order_by]
+    column = getattr(Socks5, name)
+    clauses = (
+        column.is_(None), column.desc() if descending else column.asc()
+    ) + ACQUIRE_ORDER
+
+    def key(socks5):
+        value = getattr(socks5, name)
+        if value is None:
+            return (1, 0), acquire_order_key(socks5)
+        return (0, -value if descending else value), acquire_order_key(socks5)
+
+    return clauses, key
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the given values"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+
+def database_settings():
+    """Read the [database] config section. Uses the default settings if
+    the config does not exist yet, such as when the database is created
+    before the config
+    @raise Socks5manDatabaseError: if an option has an invalid value"""
+    try:
+        settings = dict(cfg("database"))
+    except Socks5ConfigError:
+        settings = dict(cfg_default("database"))
+
+    settings["journal_mode"] = settings["journal_mode"].lower()
+    settings["synchronous"] = settings["synchronous"].lower()
+    if settings["journal_mode"] not in JOURNAL_MODES:
+        raise Socks5manDatabaseError(
+            "Invalid journal_mode '%s'. Choose from: %s" % (
+                settings["journal_mode"], ", ".join(JOURNAL_MODES)
+            )
+        )
+    if settings["synchronous"] not in SYNCHRONOUS_MODES:
+        raise Socks5manDatabaseError(
+            "Invalid synchronous mode '%s'. Choose from: %s" % (
+                settings["synchronous"], ", ".join(SYNCHRONOUS_MODES)
+            )
+        )
+
+    return settings
+
+def pragma_listener(settings):
+    """Create a listener for the engine 'connect' event that applies the
+    given SQLite settings to each new connection"""
+    pragmas = [
+        "PRAGMA journal_mode=%s" % settings["journal_mode"],
+        "PRAGMA synchronous=%s" % settings["synchronous"],
+        "PRAGMA busy_timeout=%d" % settings["busy_timeout"],
+        # A negative cache_size is in KiB instead of pages
+        "PRAGMA cache_size=-%d" % settings["cache_size"],
+        "PRAGMA mmap_size=%d" % settings["mmap_size"],
+    ]
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    return on_connect
+
 class Database(object, metaclass=Singleton):
 
+    # The amount of times the compare and set claiming of socks5s is
+    # retried when other callers claim the same candidates
+    CLAIM_ATTEMPTS = 5
+
     def __init__(self):
         self.connect(create=True)
 
     def connect(self, create=False):
-        self.engine = create_engine("sqlite:///%s" % cwd("socks5man.db"))
+        settings = database_settings()
+        # Connections are kept open, so the SQLite page cache and the
+        # settings are reused by later sessions. The connections are shared
+        # between threads, but only used by one thread at a time.
+        self.engine = create_engine(
+            "sqlite:///%s" % cwd("socks5man.db"), poolclass=QueuePool,
+            pool_size=settings["pool_size"],
+            connect_args={
+                "check_same_thread": False,
+                "timeout": settings["busy_timeout"] / 1000.0
+            }
+        )
+        event.listen(self.engine, "connect", pragma_listener(settings))
+        # UPDATE ... RETURNING is supported since SQLite 3.35.0
+        self.supports_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
         self.Session = sessionmaker(bind=self.engine)
         if create:
             if not os.path.exists(cwd("socks5man.db")):
@@ -143,9 +414,12 @@ class Database(object, metaclass=Singleton):
         return socks_id
 
     def remove_socks5(self, id):
-        """Removes the socks5 entry with the specified id"""
+        """Removes the socks5 entry with the specified id, and its checks
+        and leases"""
         session = self.Session()
         try:
+            session.query(Socks5Check).filter_by(socks5_id=id).delete()
+            session.query(Socks5Lease).filter_by(socks5_id=id).delete()
             session.query(Socks5).filter_by(id=id).delete()
             session.commit()
         except SQLAlchemyError as e:
@@ -155,39 +429,61 @@ class Database(object, metaclass=Singleton):
         finally:
             session.close()
 
+    @staticmethod
+    def _list_filters(query, country=None, country_code=None, city=None,
+                      host=None, operational=None, unverified=None,
+                      description=None, dnsport=None):
+        if operational is not None:
+            query = query.filter(Socks5.operational == operational)
+        if country:
+            query = query.filter(
+                func.lower(Socks5.country) == func.lower(country)
+            )
+        if country_code:
+            query = query.filter(
+                func.lower(Socks5.country_code) == func.lower(country_code)
+            )
+        if city:
+            query = query.filter(
+                func.lower(Socks5.city) == func.lower(city)
+            )
+        if unverified:
+            query = query.filter(Socks5.last_check == None)
+        if host:
+            if isinstance(host, (list, tuple)):
+                query = query.filter(Socks5.host.in_(set(host)))
+            else:
+                query = query.filter(Socks5.host == host)
+        if description:
+            query = query.filter(
+                func.lower(Socks5.description) == func.lower(description))
+        if dnsport:
+            query = query.filter(Socks5.dnsport == int(dnsport))
+        return query
+
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="list_socks5")
     def list_socks5(self, country=None, country_code=None, city=None,
                     host=None, operational=None, unverified=None,
-                    description=None, dnsport=None):
-        """Return a list of socks5 servers matching the filters"""
+                    description=None, dnsport=None, limit=None,
+                    after_id=None):
+        """Return a list of socks5 servers matching the filters, ordered
+        by id
+        @param limit: The maximum amount of socks5s to return
+        @param after_id: Only return socks5s with a higher id. Use the id
+        of the last socks5 of the previous page to read the next page"""
         session = self.Session()
-        socks = session.query(Socks5)
         try:
-            if operational is not None:
-                socks = socks.filter_by(operational=operational)
-            if country:
-                socks = socks.filter(
-                    func.lower(Socks5.country) == func.lower(country)
-                )
-            if country_code:
-                socks = socks.filter(
-                    func.lower(Socks5.country_code) == func.lower(country_code)
-                )
-            if city:
-                socks = socks.filter(
-                    func.lower(Socks5.city) == func.lower(city)
-                )
-            if unverified:
-                socks = socks.filter_by(last_check=None)
-            if host:
-                if isinstance(host, (list, tuple)):
-                    socks = socks.filter(Socks5.host.in_(set(host)))
-                else:
-                    socks = socks.filter_by(host=host)
-            if description:
-                socks = socks.filter(
-                    func.lower(Socks5.description) == func.lower(description))
-            if dnsport:
-                socks = socks.filter(Socks5.dnsport == int(dnsport))
+            socks = self._list_filters(
+                session.query(Socks5), country=country,
+                country_code=country_code, city=city, host=host,
+                operational=operational, unverified=unverified,
+                description=description, dnsport=dnsport
+            )
+            if after_id is not None:
+                socks = socks.filter(Socks5.id > after_id)
+            socks = socks.order_by(Socks5.id)
+            if limit is not None:
+                socks = socks.limit(limit)
             socks = socks.all()
             for s in socks:
                 session.expunge(s)
@@ -200,6 +496,92 @@ class Database(object, metaclass=Singleton):
         finally:
             session.close()
 
+    def export_socks5(self, columns=None, country=None, country_code=None,
+                      city=None, host=None, operational=None,
+                      unverified=None, description=None, dnsport=None,
+                      limit=None, after_id=None, batch_size=1000):
+        """Yields tuples of the given columns of all socks5s matching the
+        filters, ordered by id. Takes the same filters as list_socks5. The
+        rows are read from a single query 'batch_size' rows at a time, so
+        memory usage does not depend on the amount of socks5s.
+        @param columns: A list of socks5s column names. All columns if not
+        given
+        @raise ValueError: if a column does not exist"""
+        columns = export_columns(columns)
+        session = self.Session()
+        try:
+            query = self._list_filters(
+                session.query(*[getattr(Socks5, c) for c in columns]),
+                country=country, country_code=country_code, city=city,
+                host=host, operational=operational, unverified=unverified,
+                description=description, dnsport=dnsport
+            )
+            if after_id is not None:
+                query = query.filter(Socks5.id > after_id)
+            query = query.order_by(Socks5.id)
+            if limit is not None:
+                query = query.limit(limit)
+            for row in query.yield_per(batch_size):
+                yield tuple(row)
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error exporting socks5s: %s" % e
+            )
+        finally:
+            session.close()
+
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="count_socks5")
+    def count_socks5(self, country=None, country_code=None, city=None,
+                     host=None, operational=None, unverified=None,
+                     description=None, dnsport=None):
+        """Return the amount of socks5 servers matching the filters. Takes
+        the same filters as list_socks5"""
+        session = self.Session()
+        try:
+            return self._list_filters(
+                session.query(func.count(Socks5.id)), country=country,
+                country_code=country_code, city=city, host=host,
+                operational=operational, unverified=unverified,
+                description=description, dnsport=dnsport
+            ).scalar()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error counting socks5s: %s" % e
+            )
+        finally:
+            session.close()
+
+    def operational_state(self):
+        """Return a value that changes when operational socks5s are added
+        or removed, or when socks5s change operational state. Used to
+        detect changes without reading all socks5s."""
+        session = self.Session()
+        try:
+            return tuple(session.query(
+                func.count(Socks5.id), func.total(Socks5.id)
+            ).filter(Socks5.operational == True).one())
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error reading operational state: %s" % e
+            )
+        finally:
+            session.close()
+
+    def count_by_state(self):
+        """Returns a list of (country_code, operational, count) tuples with
+        the amount of socks5s per country code and operational state"""
+        session = self.Session()
+        try:
+            return session.query(
+                Socks5.country_code, Socks5.operational, func.count(Socks5.id)
+            ).group_by(Socks5.country_code, Socks5.operational).all()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error counting socks5s: %s" % e
+            )
+        finally:
+            session.close()
+
     def view_socks5(self, socks5_id=None, host=None, port=None):
         """Returns a socks5 server matching the given id"""
         session = self.Session()
@@ -224,9 +606,146 @@ class Database(object, metaclass=Singleton):
             session.close()
         return socks5
 
+    def _find_filters(self, country=None, country_code=None, city=None,
+                      min_mbps_down=None, max_connect_time=None,
+                      min_uptime=None, max_connect_time_p95=None,
+                      max_check_failures=None):
+        """Returns a list of filter clauses that an operational socks5 must
+        match to be acquired"""
+        filters = [Socks5.operational == True]
+        if country:
+            filters.append(func.lower(Socks5.country) == func.lower(country))
+        if country_code:
+            filters.append(
+                func.lower(Socks5.country_code) == func.lower(country_code)
+            )
+        if city:
+            filters.append(func.lower(Socks5.city) == func.lower(city))
+        if min_mbps_down:
+            filters.append(Socks5.bandwidth >= min_mbps_down)
+        if max_connect_time:
+            filters.append(Socks5.connect_time <= max_connect_time)
+        if min_uptime:
+            filters.append(Socks5.uptime >= min_uptime)
+        if max_connect_time_p95:
+            filters.append(Socks5.connect_time_p95 <= max_connect_time_p95)
+        if max_check_failures is not None:
+            filters.append(Socks5.check_failures <= max_check_failures)
+
+        return filters
+
+    def _claim_groups(self, filters, limit, quotas=None):
+        """Split a claim into (filters, limit) groups. Without quotas, this
+        is a single group. Each quota is a group for its country code. The
+        rest of the limit is claimed from socks5s in other countries.
+        @param quotas: A dict of country code and the amount of socks5s
+        to claim in that country"""
+        if not quotas:
+            return [(filters, limit)]
+
+        merged = OrderedDict()
+        for code, amount in quotas.items():
+            merged[code.lower()] = merged.get(code.lower(), 0) + amount
+
+        groups = [
+            (filters + [func.lower(Socks5.country_code) == code], amount)
+            for code, amount in merged.items() if amount > 0
+        ]
+        remaining = limit - sum(merged.values())
+        if remaining > 0:
+            groups.append((
+                filters + [~func.lower(Socks5.country_code).in_(merged)],
+                remaining
+            ))
+        return groups
+
+    def _candidates(self, groups, order=ACQUIRE_ORDER):
+        """Select the ids of the first socks5s in the given order of each
+        (filters, limit) group. The groups are combined using UNION ALL."""
+        selects = [
+            select([Socks5.id]).where(and_(*filters)).order_by(
+                *order
+            ).limit(limit) for filters, limit in groups
+        ]
+        if len(selects) == 1:
+            return selects[0]
+
+        # A compound SELECT cannot have a LIMIT per part, so each part is
+        # a subquery
+        return union_all(*[select([s.alias().c.id]) for s in selects])
+
+    def _claim_returning(self, session, groups, order, key):
+        """Select and mark the first matching socks5s in the given order as
+        used in a single UPDATE ... RETURNING statement. SQLite executes a
+        statement atomically, so concurrent callers never claim the
+        same socks5."""
+        candidates = self._candidates(groups, order).compile(
+            dialect=sqlite.dialect(paramstyle="named")
+        )
+
+        columns = Socks5.__table__.columns
+        claim = text(
+            "UPDATE socks5s SET last_use = :claim_last_use WHERE id IN (%s) "
+            "RETURNING %s" % (candidates, ", ".join(c.name for c in columns))
+        ).bindparams(
+            bindparam("claim_last_use", datetime.now(), type_=DateTime()),
+            **candidates.params
+        ).columns(*columns)
+        claimed = session.query(Socks5).from_statement(claim).all()
+        return sorted(claimed, key=key)
+
+    @staticmethod
+    def _set_used_if_unchanged(session, socks5_id, last_use, now):
+        """Set the last_use of the socks5 to 'now' only if it still is
+        'last_use', the value it had when it was read
+        @return: True if the socks5 was updated"""
+        if last_use is None:
+            unchanged = Socks5.last_use.is_(None)
+        else:
+            unchanged = Socks5.last_use == last_use
+
+        return session.query(Socks5).filter(
+            Socks5.id == socks5_id, unchanged
+        ).update({"last_use": now}, synchronize_session=False) > 0
+
+    def _claim_compare_and_set(self, session, filters, limit, order):
+        """Fallback for SQLite versions without RETURNING support. Marks
+        candidates as used only if their last_use did not change since they
+        were selected, retrying with new candidates for those that were
+        claimed by another caller in the meantime."""
+        claimed = []
+        for attempt in range(self.CLAIM_ATTEMPTS):
+            candidates = session.query(Socks5.id, Socks5.last_use).filter(
+                *filters
+            ).filter(
+                ~Socks5.id.in_(claimed)
+            ).order_by(*order).limit(limit - len(claimed)).all()
+            if not candidates:
+                break
+
+            now = datetime.now()
+            for socks5_id, last_use in candidates:
+                if self._set_used_if_unchanged(
+                        session, socks5_id, last_use, now
+                ):
+                    claimed.append(socks5_id)
+
+            if len(claimed) >= limit:
+                break
+
+        if not claimed:
+            return []
+
+        return session.query(Socks5).filter(
+            Socks5.id.in_(claimed)
+        ).order_by(*order).all()
+
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="find_socks5")
     def find_socks5(self, country=None, country_code=None, city=None,
                     min_mbps_down=None, max_connect_time=None,
-                    update_usage=True, limit=1):
+                    update_usage=True, limit=1, quotas=None, min_uptime=None,
+                    max_connect_time_p95=None, max_check_failures=None,
+                    order_by=None):
         """Find one or more matching socks5 servers matching the provided
         filters. Names etc should be in English
         @param country: The country
@@ -236,46 +755,55 @@ class Database(object, metaclass=Singleton):
         @param max_connect_time: Max average connection time to
          the server (float)
         @param update_usage: Should the last_used field be updated
-         when finding a matching socks5? True by default
-        @param limit: The maximum number of socks5s to find and return"""
+         when finding a matching socks5? True by default. Finding and
+         updating is atomic, so concurrent callers get different socks5s
+        @param limit: The maximum number of socks5s to find and return
+        @param quotas: A dict of country codes and the maximum amount of
+         socks5s to find in that country. Example: {"DE": 50, "US": 100}.
+         If the limit is higher than the sum of the quotas, the rest is
+         found in other countries
+        @param min_uptime: The minimum ratio of successful checks in the
+         check history (0.0 - 1.0)
+        @param max_connect_time_p95: The maximum 95th percentile of the
+         latest measured connection times (float)
+        @param max_check_failures: The maximum amount of consecutive
+         failed checks
+        @param order_by: Find the socks5s with the best 'uptime',
+         'connect_time' (average) or 'connect_time_p95' instead of the
+         least recently used socks5s
+        @raise ValueError: if order_by is unknown"""
+        filters = self._find_filters(
+            country=country, country_code=country_code, city=city,
+            min_mbps_down=min_mbps_down, max_connect_time=max_connect_time,
+            min_uptime=min_uptime, max_connect_time_p95=max_connect_time_p95,
+            max_check_failures=max_check_failures
+        )
+        order, key = find_order(order_by)
+        groups = self._claim_groups(filters, limit, quotas=quotas)
+        if not groups:
+            return []
 
-        result = []
         session = self.Session()
-        socks5 = session.query(Socks5)
         try:
-            socks5 = socks5.filter_by(operational=True)
-            if country:
-                socks5 = socks5.filter(
-                    func.lower(Socks5.country) == func.lower(country)
-                )
-            if country_code:
-                socks5 = socks5.filter(
-                    func.lower(Socks5.country_code) == func.lower(country_code)
-                )
-            if city:
-                socks5 = socks5.filter(
-                    func.lower(Socks5.city) == func.lower(city)
-                )
-            if min_mbps_down:
-                socks5 = socks5.filter(Socks5.bandwidth >= min_mbps_down)
-            if max_connect_time:
-                socks5 = socks5.filter(Socks5.connect_time <= max_connect_time)
-
-            result = socks5.order_by(
-                Socks5.last_use.asc(), Socks5.last_check.desc(),
-                Socks5.connect_time.asc(), Socks5.bandwidth.desc()
-            ).limit(limit).all()
-
-            if result and update_usage:
-                for s in result:
-                    s.last_use = datetime.now()
-                session.commit()
+            if not update_usage:
+                result = session.query(Socks5).filter(
+                    Socks5.id.in_(self._candidates(groups, order))
+                ).order_by(*order).all()
+            elif self.supports_returning:
+                result = self._claim_returning(session, groups, order, key)
+            else:
+                result = []
+                for group_filters, group_limit in groups:
+                    result.extend(self._claim_compare_and_set(
+                        session, group_filters, group_limit, order
+                    ))
+                result.sort(key=key)
 
-            if result:
-                for s in result:
-                    if update_usage:
-                        session.refresh(s)
-                    session.expunge(s)
+            # Detach before committing, so the claimed socks5s keep their
+            # loaded values instead of being expired by the commit
+            for s in result:
+                session.expunge(s)
+            session.commit()
 
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError("Error finding socks5: %s" % e)
@@ -289,12 +817,188 @@ class Database(object, metaclass=Singleton):
         @param socks5_dict_list: A list of dictionaries containing
         all filled in columns for each socks5 entry."""
         try:
-            self.engine.execute(Socks5.__table__.insert(), socks5_dict_list)
+            with self.engine.begin() as conn:
+                conn.execute(Socks5.__table__.insert(), socks5_dict_list)
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError(
                 "Error bulk adding socks5 to database: %s" % e
             )
 
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="acquire_lease")
+    def acquire_lease(self, max_leases, duration, country=None,
+                      country_code=None, city=None, min_mbps_down=None,
+                      max_connect_time=None):
+        """Lease a matching socks5 and mark it as used. Socks5s without
+        active leases are leased first. Otherwise the socks5 with the least
+        load is leased: its active leases weighted by its average lease
+        latency, so faster socks5s get more concurrent leases. Socks5s with
+        'max_leases' or more active leases are skipped. Leasing is a single
+        INSERT ... SELECT statement, so concurrent callers never exceed
+        max_leases.
+        @param max_leases: The maximum amount of active leases per socks5
+        @param duration: The time in seconds until the lease expires
+        @return: A (socks5, lease) tuple or None if no socks5 is available"""
+        filters = self._find_filters(
+            country=country, country_code=country_code, city=city,
+            min_mbps_down=min_mbps_down, max_connect_time=max_connect_time
+        )
+        now = datetime.now()
+        active = and_(
+            Socks5Lease.socks5_id == Socks5.id, Socks5Lease.expires_on > now
+        )
+        active_count = select([func.count(Socks5Lease.id)]).where(
+            active
+        ).as_scalar()
+        load = active_count * func.coalesce(
+            Socks5.lease_latency, DEFAULT_LEASE_LATENCY
+        )
+        columns = [
+            Socks5.id, literal(now, type_=DateTime()),
+            literal(now + timedelta(seconds=duration), type_=DateTime())
+        ]
+        candidates = (
+            # Most socks5s have no active leases. This query uses the
+            # acquire index and stops at the first unleased socks5.
+            select(columns).where(
+                and_(*filters + [~exists().where(active)])
+            ).order_by(*ACQUIRE_ORDER).limit(1),
+            select(columns).where(
+                and_(*filters + [active_count < max_leases])
+            ).order_by(load, active_count, *ACQUIRE_ORDER).limit(1)
+        )
+
+        session = self.Session()
+        try:
+            session.query(Socks5Lease).filter(
+                Socks5Lease.expires_on <= now
+            ).delete(synchronize_session=False)
+
+            for candidate in candidates:
+                res = session.execute(
+                    Socks5Lease.__table__.insert().from_select(
+                        ["socks5_id", "acquired_on", "expires_on"], candidate
+                    )
+                )
+                if res.rowcount:
+                    break
+            else:
+                session.commit()
+                return None
+
+            lease = session.query(Socks5Lease).get(res.lastrowid)
+            socks5 = session.query(Socks5).get(lease.socks5_id)
+            socks5.last_use = now
+            session.flush()
+            session.expunge(lease)
+            session.expunge(socks5)
+            session.commit()
+            return socks5, lease
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise Socks5manDatabaseError("Error leasing socks5: %s" % e)
+        finally:
+            session.close()
+
+    def release_lease(self, lease_id, socks5_id, success=True, latency=None,
+                      max_failures=None):
+        """End a lease and store how the leased socks5 performed.
+        @param success: False if the socks5 failed while it was leased
+        @param latency: The latency in seconds observed while using the
+         socks5. Added to its average lease_latency
+        @param max_failures: Mark the socks5 as not operational after this
+         amount of consecutive failures"""
+        session = self.Session()
+        try:
+            session.query(Socks5Lease).filter_by(id=lease_id).delete()
+            socks5 = session.query(Socks5).get(socks5_id)
+            if socks5:
+                if latency is not None:
+                    if socks5.lease_latency is None:
+                        socks5.lease_latency = latency
+                    else:
+                        socks5.lease_latency = (
+                            LEASE_LATENCY_WEIGHT * latency +
+                            (1 - LEASE_LATENCY_WEIGHT) * socks5.lease_latency
+                        )
+
+                if success:
+                    socks5.lease_failures = 0
+                else:
+                    socks5.lease_failures = (socks5.lease_failures or 0) + 1
+                    socks5.last_failure = datetime.now()
+                    if max_failures and socks5.lease_failures >= max_failures:
+                        log.warning(
+                            "Marking socks5 %s as not operational after %s"
+                            " failures", socks5_id, socks5.lease_failures
+                        )
+                        socks5.operational = False
+
+            session.commit()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError("Error releasing lease: %s" % e)
+        finally:
+            session.close()
+
+    def count_leases(self, socks5_id=None):
+        """Return the amount of active leases, optionally for one socks5"""
+        session = self.Session()
+        try:
+            leases = session.query(func.count(Socks5Lease.id)).filter(
+                Socks5Lease.expires_on > datetime.now()
+            )
+            if socks5_id is not None:
+                leases = leases.filter(Socks5Lease.socks5_id == socks5_id)
+            return leases.scalar()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError("Error counting leases: %s" % e)
+        finally:
+            session.close()
+
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="mark_used")
+    def mark_used(self, socks5_id):
+        """Set the last_use of the given socks5 to now
+        @return: The new last_use value"""
+        now = datetime.now()
+        session = self.Session()
+        try:
+            session.query(Socks5).filter_by(id=socks5_id).update(
+                {"last_use": now}, synchronize_session=False
+            )
+            session.commit()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error updating socks5 usage in database: %s" % e
+            )
+        finally:
+            session.close()
+
+        return now
+
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="claim_socks5")
+    def claim_socks5(self, socks5_id, last_use):
+        """Mark a socks5 that was read without updating its usage as used,
+        unless another caller marked it as used since it was read. Use this
+        instead of mark_used when concurrent callers may choose the same
+        socks5
+        @param last_use: The last_use of the socks5 when it was read
+        @return: The new last_use, or None if the socks5 was claimed by
+        another caller"""
+        now = datetime.now()
+        session = self.Session()
+        try:
+            claimed = self._set_used_if_unchanged(
+                session, socks5_id, last_use, now
+            )
+            session.commit()
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error updating socks5 usage in database: %s" % e
+            )
+        finally:
+            session.close()
+
+        return now if claimed else None
+
     def set_operational(self, socks5_id, operational):
         """Change the operational status for the given socks5 to the
         given value False/True. The last_check value is automatically
@@ -306,6 +1010,12 @@ class Database(object, metaclass=Singleton):
                 return
             socks5.operational = operational
             socks5.last_check = datetime.now()
+            socks5.lease_failures = 0
+            session.flush()
+            self._record_results(session, [{
+                "id": socks5_id, "operational": operational,
+                "last_check": socks5.last_check
+            }])
             session.commit()
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError(
@@ -322,6 +1032,9 @@ class Database(object, metaclass=Singleton):
             session.query(Socks5).filter_by(
                 id=socks5_id
             ).update({"connect_time": connect_time})
+            self._record_results(
+                session, [{"id": socks5_id, "connect_time": connect_time}]
+            )
             session.commit()
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError(
@@ -330,14 +1043,22 @@ class Database(object, metaclass=Singleton):
         finally:
             session.close()
 
-    def set_approx_bandwidth(self, socks5_id, bandwidth):
+    def set_approx_bandwidth(self, socks5_id, bandwidth, ttfb=None):
         """Store the approximate Mbit/s speed down
-        @param bandwidth: float representing the mbit/s speed down."""
+        @param bandwidth: float representing the mbit/s speed down.
+        @param ttfb: The time in seconds until the first byte of the test
+        file was received. Not changed if None"""
+        values = {"bandwidth": bandwidth}
+        if ttfb is not None:
+            values["ttfb"] = ttfb
         session = self.Session()
         try:
             session.query(Socks5).filter_by(
                 id=socks5_id
-            ).update({"bandwidth": bandwidth})
+            ).update(values)
+            self._record_results(
+                session, [{"id": socks5_id, "bandwidth": bandwidth}]
+            )
             session.commit()
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError(
@@ -346,10 +1067,270 @@ class Database(object, metaclass=Singleton):
         finally:
             session.close()
 
+    @metrics.timed(metrics.DB_QUERY_DURATION, query="bulk_update_results")
+    def bulk_update_results(self, results):
+        """Store the results of multiple checks in a single transaction.
+        @param results: A list of dicts that contain the socks5 'id' and
+        one or more of the keys: operational, last_check, connect_time,
+        bandwidth, ttfb, last_use. Results with the same keys are updated using a
+        single executemany. Results are added to the check history, see
+        _record_results."""
+        groups = {}
+        for result in results:
+            keys = tuple(sorted(k for k in result if k != "id"))
+            if keys:
+                groups.setdefault(keys, []).append(result)
+
+        try:
+            with self.engine.begin() as conn:
+                for keys, group in groups.items():
+                    stmt = Socks5.__table__.update().where(
+                        Socks5.id == bindparam("b_id")
+                    ).values({k: bindparam("b_%s" % k) for k in keys})
+                    conn.execute(stmt, [
+                        dict(
+                            [("b_id", r["id"])] +
+                            [("b_%s" % k, r[k]) for k in keys]
+                        ) for r in group
+                    ])
+                self._record_results(conn, results)
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error bulk updating check results in database: %s" % e
+            )
+
+    def _record_results(self, conn, results):
+        """Add check results to the check history and update the rolling
+        statistics of the checked socks5s. Each result with an 'operational'
+        key is a new check. Connection times and bandwidths of results
+        without it belong to the latest check of their socks5.
+        @param conn: A connection or session in a running transaction
+        @param results: A list of result dicts, as bulk_update_results
+        takes"""
+        checks = [r for r in results if "operational" in r]
+        if checks:
+            now = datetime.now()
+            # Socks5s that were removed while being checked are skipped
+            columns = [
+                ("socks5_id", Integer()), ("checked_on", DateTime()),
+                ("successes", Integer()), ("connect_time", Float()),
+                ("bandwidth", Float())
+            ]
+            conn.execute(Socks5Check.__table__.insert().from_select(
+                [name for name, _ in columns] + ["checks", "downsampled"],
+                select([
+                    bindparam("b_%s" % name, type_=column_type)
+                    for name, column_type in columns
+                ] + [literal(1), literal(False)]).where(
+                    exists().where(Socks5.id == bindparam("b_socks5_id"))
+                )
+            ), [{
+                "b_socks5_id": r["id"],
+                "b_checked_on": r.get("last_check") or now,
+                "b_successes": 1 if r["operational"] else 0,
+                "b_connect_time": r.get("connect_time"),
+                "b_bandwidth": r.get("bandwidth")
+            } for r in checks])
+
+            update = Socks5.__table__.update().where(
+                Socks5.id == bindparam("b_id")
+            )
+            succeeded = [
+                {"b_id": r["id"]} for r in checks if r["operational"]
+            ]
+            failed = [{
+                "b_id": r["id"], "b_last_failure": r.get("last_check") or now
+            } for r in checks if not r["operational"]]
+            # The SET expressions use the values from before the update
+            count = cast(Socks5.check_count + 1, Float())
+            if succeeded:
+                conn.execute(update.values(
+                    check_failures=0, check_count=Socks5.check_count + 1,
+                    check_successes=Socks5.check_successes + 1,
+                    uptime=(Socks5.check_successes + 1) / count
+                ), succeeded)
+            if failed:
+                conn.execute(update.values(
+                    check_failures=Socks5.check_failures + 1,
+                    check_count=Socks5.check_count + 1,
+                    uptime=Socks5.check_successes / count,
+                    last_failure=bindparam(
+                        "b_last_failure", type_=DateTime()
+                    )
+                ), failed)
+
+        latest = select([func.max(Socks5Check.id)]).where(
+            Socks5Check.socks5_id == bindparam("b_id")
+        ).as_scalar()
+        for key in ("connect_time", "bandwidth"):
+            values = [
+                {"b_id": r["id"], "b_value": r[key]} for r in results
+                if "operational" not in r and key in r
+            ]
+            if values:
+                conn.execute(Socks5Check.__table__.update().where(
+                    Socks5Check.id == latest
+                ).values({key: bindparam("b_value")}), values)
+
+        self._update_connect_time_stats(conn, [
+            (r["id"], r["connect_time"]) for r in results
+            if r.get("connect_time") is not None
+        ])
+
+    def _update_connect_time_stats(self, conn, samples):
+        """Update the connect_time_ewma and connect_time_p95 of socks5s
+        @param samples: A list of (socks5 id, connection time) tuples"""
+        if not samples:
+            return
+
+        weighted = bindparam("b_connect_time", type_=Float())
+        conn.execute(Socks5.__table__.update().where(
+            Socks5.id == bindparam("b_id")
+        ).values(connect_time_ewma=case(
+            [(Socks5.connect_time_ewma.is_(None), weighted)],
+            else_=CONNECT_TIME_WEIGHT * weighted +
+            (1 - CONNECT_TIME_WEIGHT) * Socks5.connect_time_ewma
+        )), [
+            {"b_id": socks5_id, "b_connect_time": connect_time}
+            for socks5_id, connect_time in samples
+        ])
+
+        latest = select([Socks5Check.connect_time]).where(and_(
+            Socks5Check.socks5_id == bindparam("b_id"),
+            Socks5Check.connect_time.isnot(None)
+        )).order_by(Socks5Check.checked_on.desc()).limit(P95_SAMPLES)
+        p95 = []
+        for socks5_id in set(socks5_id for socks5_id, _ in samples):
+            p95.append({"b_id": socks5_id, "b_p95": percentile([
+                row[0] for row in conn.execute(latest, {"b_id": socks5_id})
+            ], 95)})
+
+        conn.execute(Socks5.__table__.update().where(
+            Socks5.id == bindparam("b_id")
+        ).values(connect_time_p95=bindparam("b_p95")), p95)
+
+    def compact_checks(self, retention, downsample_after, interval):
+        """Keep the check history bounded. Deletes checks older than
+        'retention' seconds and downsamples the checks older than
+        'downsample_after' seconds into a single row per socks5 per
+        'interval' seconds. Downsampled rows keep the amount of checks and
+        successes, so the uptime only changes when checks are deleted. Only
+        checks that were not downsampled yet are read, using the
+        downsampled index.
+        @return: A (deleted, downsampled) tuple of the amount of rows"""
+        now = datetime.now()
+        # Align the cutoff to a period boundary, so a period is only
+        # downsampled when all its checks are older than the cutoff. Like
+        # strftime('%s') in SQLite, the stored times are treated as UTC.
+        cutoff = now - timedelta(seconds=downsample_after)
+        cutoff = cutoff.replace(microsecond=0) - timedelta(
+            seconds=calendar.timegm(cutoff.timetuple()) % interval
+        )
+        table = Socks5Check.__table__
+        period = cast(
+            func.strftime("%s", Socks5Check.checked_on), Integer()
+        ) / interval
+
+        def measured(column):
+            # The amount of checks the average of the column is based on
+            return case([(column.isnot(None), Socks5Check.checks)])
+
+        try:
+            with self.engine.begin() as conn:
+                expired = Socks5Check.checked_on < now - timedelta(
+                    seconds=retention
+                )
+                self._remove_from_uptime(conn, expired)
+                deleted = conn.execute(table.delete().where(
+                    expired
+                )).rowcount
+
+                pending = and_(
+                    Socks5Check.downsampled == False,
+                    Socks5Check.checked_on < cutoff
+                )
+                max_id = conn.execute(
+                    select([func.max(Socks5Check.id)]).where(pending)
+                ).scalar()
+                if max_id is None:
+                    return deleted, 0
+
+                pending = and_(pending, Socks5Check.id <= max_id)
+                conn.execute(table.insert().from_select([
+                    "socks5_id", "checked_on", "checks", "successes",
+                    "connect_time", "bandwidth", "downsampled"
+                ], select([
+                    Socks5Check.socks5_id,
+                    func.min(Socks5Check.checked_on),
+                    func.sum(Socks5Check.checks),
+                    func.sum(Socks5Check.successes),
+                    func.sum(Socks5Check.connect_time * Socks5Check.checks) /
+                    func.sum(measured(Socks5Check.connect_time)),
+                    func.sum(Socks5Check.bandwidth * Socks5Check.checks) /
+                    func.sum(measured(Socks5Check.bandwidth)),
+                    literal(True)
+                ]).where(pending).group_by(Socks5Check.socks5_id, period)))
+                downsampled = conn.execute(
+                    table.delete().where(pending)
+                ).rowcount
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error compacting check history: %s" % e
+            )
+
+        return deleted, downsampled
+
+    def _remove_from_uptime(self, conn, clause):
+        """Remove the checks matching the given clause from the check
+        counts and uptime of their socks5s. Should be called before the
+        checks are deleted"""
+        socks5s = Socks5.id.in_(
+            select([Socks5Check.socks5_id]).where(clause)
+        )
+
+        def removed(column):
+            return select([func.total(column)]).where(and_(
+                Socks5Check.socks5_id == Socks5.id, clause
+            )).as_scalar()
+
+        conn.execute(Socks5.__table__.update().where(socks5s).values(
+            check_count=func.max(
+                Socks5.check_count - removed(Socks5Check.checks), 0
+            ),
+            check_successes=func.max(
+                Socks5.check_successes - removed(Socks5Check.successes), 0
+            )
+        ))
+        conn.execute(Socks5.__table__.update().where(socks5s).values(
+            uptime=case([(
+                Socks5.check_count > 0,
+                Socks5.check_successes / cast(Socks5.check_count, Float())
+            )])
+        ))
+
+    def list_checks(self, socks5_id):
+        """Return the check history of a socks5, newest first"""
+        session = self.Session()
+        try:
+            checks = session.query(Socks5Check).filter_by(
+                socks5_id=socks5_id
+            ).order_by(Socks5Check.checked_on.desc()).all()
+            for check in checks:
+                session.expunge(check)
+            return checks
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error retrieving check history: %s" % e
+            )
+        finally:
+            session.close()
+
     def delete_all_socks5(self):
         """Clear all socks5 server from the database"""
         session = self.Session()
         try:
+            session.query(Socks5Check).delete()
+            session.query(Socks5Lease).delete()
             session.query(Socks5).delete()
             session.commit()
         except SQLAlchemyError as e:
@@ -377,19 +1358,179 @@ class Database(object, metaclass=Singleton):
         finally:
             session.close()
 
+    def iter_socks5_geoinfo(self, chunk_size=10000):
+        """Yields lists of (id, host, country, country_code, city) rows of
+        all socks5s, ordered by id. Each list is read with a separate query
+        that continues after the last id of the previous list, so memory
+        usage does not depend on the amount of socks5s"""
+        last_id = 0
+        while True:
+            try:
+                rows = self.engine.execute(select([
+                    Socks5.id, Socks5.host, Socks5.country,
+                    Socks5.country_code, Socks5.city
+                ]).where(Socks5.id > last_id).order_by(Socks5.id).limit(
+                    chunk_size
+                )).fetchall()
+            except SQLAlchemyError as e:
+                raise Socks5manDatabaseError(
+                    "Error reading geo info of socks5s: %s" % e
+                )
+
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def bulk_update_geoinfo(self, geoinfos):
+        """Update the geoinfo fields of multiple socks5s in one transaction
+        @param geoinfos: A list of dicts with the id, country, country_code
+        and city of a socks5"""
+        if not geoinfos:
+            return
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    Socks5.__table__.update().where(
+                        Socks5.id == bindparam("b_id")
+                    ).values(
+                        country=bindparam("b_country"),
+                        country_code=bindparam("b_country_code"),
+                        city=bindparam("b_city")
+                    ), [
+                        dict(("b_%s" % k, v) for k, v in geoinfo.items())
+                        for geoinfo in geoinfos
+                    ]
+                )
+        except SQLAlchemyError as e:
+            raise Socks5manDatabaseError(
+                "Error while bulk updating geo info: %s" % e
+            )
+
     def bulk_delete_socks5(self, ids_list):
-        """Delete all socks5s specified by their ids in the list
+        """Delete all socks5s specified by their ids in the list, and their
+        checks and leases
         @param ids_list: A list of socks5 ids to delete"""
         chunk = 100
         try:
-            for c in range(0, len(ids_list), chunk):
-                self.engine.execute(
-                    Socks5.__table__.delete().where(
-                        Socks5.id.in_(ids_list[c:c+chunk])
-                    )
-                )
+            with self.engine.begin() as conn:
+                for c in range(0, len(ids_list), chunk):
+                    ids = ids_list[c:c+chunk]
+                    conn.execute(Socks5Check.__table__.delete().where(
+                        Socks5Check.socks5_id.in_(ids)
+                    ))
+                    conn.execute(Socks5Lease.__table__.delete().where(
+                        Socks5Lease.socks5_id.in_(ids)
+                    ))
+                    conn.execute(Socks5.__table__.delete().where(
+                        Socks5.id.in_(ids)
+                    ))
         except SQLAlchemyError as e:
             raise Socks5manDatabaseError(
                 "Error while trying to bulk-delete multiple socks5s."
                 " Error: %s" % e
             )
+
+    def delete_socks5_where(self, country=None, country_code=None,
+                            city=None, host=None, operational=None,
+                            unverified=None, description=None, dnsport=None,
+                            checked_before=None, min_id=None, max_id=None):
+        """Delete all socks5s matching the filters, and their checks and
+        leases. Takes the same filters as list_socks5. The socks5s are
+        deleted with a single statement, without reading them first.
+        @param checked_before: Only delete socks5s that were last checked
+        before this datetime. Socks5s that were never checked are not
+        matched, use 'unverified' for those
+        @param min_id: Only delete socks5s with this id or higher
+        @param max_id: Only delete socks5s with this id or lower
+        @return: The amount of deleted socks5s"""
+        session = self.Session()
+        try:
+            ids = self._list_filters(
+                session.query(Socks5.id), country=country,
+                country_code=country_code, city=city, host=host,
+                operational=operational, unverified=unverified,
+                description=description, dnsport=dnsport
+            )
+            if checked_before is not None:
+                ids = ids.filter(Socks5.last_check < checked_before)
+            if min_id is not None:
+                ids = ids.filter(Socks5.id >= min_id)
+            if max_id is not None:
+                ids = ids.filter(Socks5.id <= max_id)
+
+            ids = ids.subquery()
+            session.query(Socks5Check).filter(
+                Socks5Check.socks5_id.in_(ids)
+            ).delete(synchronize_session=False)
+            session.query(Socks5Lease).filter(
+                Socks5Lease.socks5_id.in_(ids)
+            ).delete(synchronize_session=False)
+            deleted = session.query(Socks5).filter(
+                Socks5.id.in_(ids)
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise Socks5manDatabaseError(
+                "Error while deleting socks5s: %s" % e
+            )
+        finally:
+            session.close()
+
+@metrics.REGISTRY.register_collector
+def collect_socks5_counts():
+    """Metric of the amount of socks5s per country code and operational
+    state. Read from the database each time the metrics are rendered"""
+    samples = [
+        ("socks5man_socks5s", [
+            ("country_code", country_code),
+            ("operational", "true" if operational else "false")
+        ], count) for country_code, operational, count in
+        Database().count_by_state()
+    ]
+    return [(
+        "socks5man_socks5s", "gauge",
+        "Socks5 servers by country code and operational state", samples
+    )]
+
+class ResultBatch(object):
+    """Collects the results of socks5 checks and writes them to the database
+    using Database.bulk_update_results. Results are written when 'size'
+    socks5s have pending results, when the oldest pending result is older
+    than 'interval' seconds, or when flush() is called."""
+
+    def __init__(self, size=500, interval=5):
+        self.size = size
+        self.interval = interval
+        self.pending = OrderedDict()
+        self.first_pending = None
+        self.lock = threading.Lock()
+
+    def add(self, socks5_id, **fields):
+        """Add one or more results for the given socks5 id. Results for the
+        same socks5 are merged"""
+        with self.lock:
+            if not self.pending:
+                self.first_pending = time.time()
+            self.pending.setdefault(socks5_id, {"id": socks5_id}).update(
+                fields
+            )
+            full = len(self.pending) >= self.size or \
+                time.time() - self.first_pending >= self.interval
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write all pending results to the database"""
+        with self.lock:
+            results = list(self.pending.values())
+            self.pending = OrderedDict()
+            self.first_pending = None
+
+        if results:
+            log.debug("Writing results for %s socks5s", len(results))
+            Database().bulk_update_results(results)
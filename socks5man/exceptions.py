@@ -11,3 +11,11 @@ class Socks5ConfigError(Socks5manError):
 class Socks5manDatabaseError(Socks5manError):
     """Error that should be raised when issue/exceptions occur when
     performing database operations"""
+
+class Socks5ClientError(Socks5manError):
+    """Error that should be raised when a socks5 server or the server it
+    connects to replies with an error or invalid message"""
+
+class Socks5GatewayError(Socks5manError):
+    """Error that should be raised when a client of the socks5man gateway
+    sends an invalid or unsupported request"""
@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+import csv
+import gzip
+import io
+import json
+import struct
+from datetime import datetime, timedelta
+
+from socks5man.database import Database, export_columns
+
+db = Database()
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Binary format: the magic and version, the amount of columns and the
+# column names, followed by the values of each row. Each value is a type
+# tag followed by its little endian encoded value.
+BINARY_MAGIC = b"S5MX"
+BINARY_VERSION = 1
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+# Microseconds since 1970-01-01 of a datetime without timezone
+TAG_DATETIME = 6
+EPOCH = datetime(1970, 1, 1)
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
+class Writer(object):
+    """Writes exported rows to a binary file object"""
+
+    def __init__(self, fileobj, columns):
+        self.fileobj = fileobj
+        self.columns = columns
+
+    def write(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        """Flush the written rows. Does not close the file object"""
+        self.fileobj.flush()
+
+class _TextWriter(Writer):
+
+    def __init__(self, fileobj, columns):
+        super(_TextWriter, self).__init__(fileobj, columns)
+        self.text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        super(_TextWriter, self).close()
+
+class CSVWriter(_TextWriter):
+    """Writes a header with the column names and a line per row. Empty
+    values are written as empty strings"""
+
+    def __init__(self, fileobj, columns):
+        super(CSVWriter, self).__init__(fileobj, columns)
+        self.csv = csv.writer(self.text)
+        self.csv.writerow(columns)
+
+    def write(self, row):
+        self.csv.writerow([format_value(value) for value in row])
+
+class JSONLinesWriter(_TextWriter):
+    """Writes a JSON object per line"""
+
+    def write(self, row):
+        self.text.write(json.dumps(dict(
+            zip(self.columns, [format_value(value) for value in row])
+        )))
+        self.text.write("\n")
+
+class BinaryWriter(Writer):
+    """Writes rows in a compact binary format that keeps the types of the
+    values. Read it with BinaryReader"""
+
+    def __init__(self, fileobj, columns):
+        super(BinaryWriter, self).__init__(fileobj, columns)
+        header = [
+            BINARY_MAGIC, struct.pack("<BH", BINARY_VERSION, len(columns))
+        ]
+        for column in columns:
+            name = column.encode("utf-8")
+            header.append(struct.pack("<B", len(name)) + name)
+        fileobj.write(b"".join(header))
+
+    @staticmethod
+    def encode(value):
+        if value is None:
+            return struct.pack("<B", TAG_NONE)
+        if value is True:
+            return struct.pack("<B", TAG_TRUE)
+        if value is False:
+            return struct.pack("<B", TAG_FALSE)
+        if isinstance(value, int):
+            return struct.pack("<Bq", TAG_INT, value)
+        if isinstance(value, float):
+            return struct.pack("<Bd", TAG_FLOAT, value)
+        if isinstance(value, datetime):
+            delta = value - EPOCH
+            return struct.pack("<Bq", TAG_DATETIME, (
+                delta.days * 86400 + delta.seconds
+            ) * 1000000 + delta.microseconds)
+
+        value = str(value).encode("utf-8")
+        return struct.pack("<BI", TAG_STR, len(value)) + value
+
+    def write(self, row):
+        self.fileobj.write(b"".join(self.encode(value) for value in row))
+
+class BinaryReader(object):
+    """Reads the rows of a file written by BinaryWriter. Iterating yields a
+    dict per row"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        if self._read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("Not a socks5man binary export")
+        version, amount = struct.unpack("<BH", self._read(3))
+        if version != BINARY_VERSION:
+            raise ValueError("Unsupported binary export version: %s" % version)
+        self.columns = []
+        for _ in range(amount):
+            length = self._read(1)[0]
+            self.columns.append(self._read(length).decode("utf-8"))
+
+    def _read(self, size):
+        data = self.fileobj.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated binary export")
+        return data
+
+    def _value(self, tag):
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_TRUE:
+            return True
+        if tag == TAG_FALSE:
+            return False
+        if tag == TAG_INT:
+            return struct.unpack("<q", self._read(8))[0]
+        if tag == TAG_FLOAT:
+            return struct.unpack("<d", self._read(8))[0]
+        if tag == TAG_DATETIME:
+            return EPOCH + timedelta(
+                microseconds=struct.unpack("<q", self._read(8))[0]
+            )
+        if tag == TAG_STR:
+            length = struct.unpack("<I", self._read(4))[0]
+            return self._read(length).decode("utf-8")
+        raise ValueError("Unknown value type in binary export: %s" % tag)
+
+    def __iter__(self):
+        while True:
+            tag = self.fileobj.read(1)
+            if not tag:
+                return
+
+            row = [self._value(tag[0])]
+            for _ in range(len(self.columns) - 1):
+                row.append(self._value(self._read(1)[0]))
+            yield dict(zip(self.columns, row))
+
+WRITERS = {
+    "csv": CSVWriter,
+    "jsonl": JSONLinesWriter,
+    "binary": BinaryWriter,
+}
+
+def export_socks5(fileobj, fmt="csv", columns=None, compress=False,
+                  batch_size=1000, **filters):
+    """Write the socks5s matching the filters to the binary file object.
+    The socks5s are streamed from the database, so memory usage does not
+    depend on the amount of socks5s.
+    @param fmt: csv, jsonl or binary
+    @param columns: A list or comma separated string of column names. All
+    columns if not given
+    @param compress: Compress the output with gzip
+    @param filters: The filters of Database.list_socks5
+    @return: The amount of exported socks5s
+    @raise ValueError: if the format or a column is unknown"""
+    if fmt not in WRITERS:
+        raise ValueError(
+            "Unknown export format '%s'. Choose from: %s" % (
+                fmt, ", ".join(sorted(WRITERS))
+            )
+        )
+    columns = export_columns(columns)
+
+    output = fileobj
+    if compress:
+        output = gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+    writer = WRITERS[fmt](output, columns)
+    exported = 0
+    try:
+        for row in db.export_socks5(
+                columns=columns, batch_size=batch_size, **filters
+        ):
+            writer.write(row)
+            exported += 1
+    finally:
+        writer.close()
+        if compress:
+            output.close()
+
+    return exported
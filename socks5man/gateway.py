@@ -0,0 +1,247 @@
+from __future__ import absolute_import
+import asyncio
+import logging
+import socket
+import struct
+
+from socks5man import aiosocks5
+from socks5man.config import cfg
+from socks5man.database import Database
+from socks5man.exceptions import Socks5ClientError, Socks5GatewayError
+
+log = logging.getLogger(__name__)
+
+db = Database()
+
+REPLY_SUCCEEDED = 0x00
+REPLY_HOST_UNREACHABLE = 0x04
+REPLY_COMMAND_NOT_SUPPORTED = 0x07
+REPLY_ADDRESS_NOT_SUPPORTED = 0x08
+
+# Username tags and the find_socks5 filter and type they map to
+TAGS = {
+    "country": ("country", str),
+    "code": ("country_code", str),
+    "country_code": ("country_code", str),
+    "city": ("city", str),
+    "min_mbps": ("min_mbps_down", float),
+    "min_mbps_down": ("min_mbps_down", float),
+    "max_connect": ("max_connect_time", float),
+    "max_connect_time": ("max_connect_time", float),
+}
+
+def parse_tags(username):
+    """Parse the filters for choosing an upstream socks5 server from a
+    SOCKS5 username. Example: 'country=germany,min_mbps=5'
+    @return: A dict of find_socks5 filters
+    @raise Socks5GatewayError: if a tag is unknown or has an invalid value"""
+    filters = {}
+    for tag in username.split(","):
+        tag = tag.strip()
+        if not tag:
+            continue
+
+        key, sep, value = tag.partition("=")
+        key = key.strip().lower()
+        if not sep or key not in TAGS:
+            raise Socks5GatewayError("Invalid filter tag: %s" % tag)
+
+        name, tag_type = TAGS[key]
+        try:
+            filters[name] = tag_type(value.strip())
+        except ValueError:
+            raise Socks5GatewayError("Invalid value for filter tag: %s" % tag)
+
+    return filters
+
+def encode_reply(reply):
+    return struct.pack(
+        "!BBBB4sH", aiosocks5.SOCKS_VERSION, reply, 0x00,
+        aiosocks5.ATYP_IPV4, b"\x00" * 4, 0
+    )
+
+async def read_address(reader, atyp):
+    """Read a SOCKS5 destination address of the given type
+    @return: A (host, port) tuple"""
+    if atyp == aiosocks5.ATYP_IPV4:
+        host = socket.inet_ntoa(await reader.readexactly(4))
+    elif atyp == aiosocks5.ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+    elif atyp == aiosocks5.ATYP_DOMAIN:
+        length = (await reader.readexactly(1))[0]
+        host = (await reader.readexactly(length)).decode("idna")
+    else:
+        raise Socks5GatewayError("Unknown address type: %s" % atyp)
+
+    port = struct.unpack("!H", await reader.readexactly(2))[0]
+    return host, port
+
+async def relay(reader, writer, buffer_size):
+    """Copy data from reader to writer until EOF. Each read chunk is
+    written as is, drain() only waits if the receiving side is slow"""
+    try:
+        while True:
+            data = await reader.read(buffer_size)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+class Gateway(object):
+    """Local SOCKS5 server that relays each CONNECT through an operational
+    socks5 server. The socks5 server is chosen using Database.find_socks5.
+    Clients can give filters as username. Example: 'country=germany'.
+    The password is ignored. If connecting through a socks5 server fails,
+    the next matching socks5 server is tried."""
+
+    def __init__(self, host=None, port=None, connect_attempts=None,
+                 connect_timeout=None, buffer_size=None):
+        self.host = host or cfg("gateway", "host")
+        self.port = cfg("gateway", "port") if port is None else port
+        self.connect_attempts = max(
+            1, connect_attempts or cfg("gateway", "connect_attempts")
+        )
+        self.connect_timeout = connect_timeout or cfg(
+            "gateway", "connect_timeout"
+        )
+        self.buffer_size = buffer_size or cfg("gateway", "buffer_size")
+        self.server = None
+        self.clients = set()
+
+    def _accept(self, reader, writer):
+        task = asyncio.ensure_future(self.handle(reader, writer))
+        self.clients.add(task)
+        task.add_done_callback(self.clients.discard)
+
+    async def start(self):
+        """Start listening. Returns the port that is listened on"""
+        self.server = await asyncio.start_server(
+            self._accept, self.host, self.port
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info("Gateway listening on %s:%s", self.host, self.port)
+        return self.port
+
+    async def close(self):
+        """Stop listening and close all relayed connections"""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+        for task in self.clients:
+            task.cancel()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+
+    async def serve_forever(self):
+        await self.start()
+        await self.server.wait_closed()
+
+    async def negotiate(self, reader, writer):
+        """Perform the greeting and optional username/password
+        authentication with a client
+        @return: A dict of find_socks5 filters"""
+        version, nmethods = await reader.readexactly(2)
+        if version != aiosocks5.SOCKS_VERSION:
+            raise Socks5GatewayError("Unsupported SOCKS version: %s" % version)
+
+        methods = await reader.readexactly(nmethods)
+        if aiosocks5.AUTH_USERPASS in methods:
+            writer.write(struct.pack(
+                "!BB", aiosocks5.SOCKS_VERSION, aiosocks5.AUTH_USERPASS
+            ))
+            _, ulen = await reader.readexactly(2)
+            username = (await reader.readexactly(ulen)).decode("utf-8")
+            plen = (await reader.readexactly(1))[0]
+            await reader.readexactly(plen)
+            try:
+                filters = parse_tags(username)
+            except Socks5GatewayError:
+                writer.write(b"\x01\x01")
+                raise
+            writer.write(b"\x01\x00")
+            return filters
+
+        if aiosocks5.AUTH_NONE in methods:
+            writer.write(struct.pack(
+                "!BB", aiosocks5.SOCKS_VERSION, aiosocks5.AUTH_NONE
+            ))
+            return {}
+
+        writer.write(struct.pack(
+            "!BB", aiosocks5.SOCKS_VERSION, aiosocks5.AUTH_NO_ACCEPTABLE
+        ))
+        raise Socks5GatewayError("No acceptable authentication method")
+
+    async def open_upstream(self, filters, dest_host, dest_port):
+        """Connect to the destination through a matching socks5 server.
+        Tries up to connect_attempts different socks5 servers.
+        @return: A (StreamReader, StreamWriter) tuple or None"""
+        loop = asyncio.get_event_loop()
+        for _ in range(self.connect_attempts):
+            found = await loop.run_in_executor(
+                None, lambda: db.find_socks5(**filters)
+            )
+            if not found:
+                log.warning("No socks5 server matches filters: %s", filters)
+                return None
+
+            socks5 = found[0]
+            try:
+                return await asyncio.wait_for(
+                    aiosocks5.open_connection(
+                        socks5.host, socks5.port, dest_host, dest_port,
+                        username=socks5.username, password=socks5.password
+                    ), self.connect_timeout
+                )
+            except (asyncio.TimeoutError, OSError, Socks5ClientError) as e:
+                log.warning(
+                    "Connecting to %s:%s through socks5 %s:%s failed: %s",
+                    dest_host, dest_port, socks5.host, socks5.port, e
+                )
+
+        return None
+
+    async def handle(self, reader, writer):
+        upstream_writer = None
+        try:
+            filters = await self.negotiate(reader, writer)
+            _, cmd, _, atyp = await reader.readexactly(4)
+            if cmd != aiosocks5.CMD_CONNECT:
+                writer.write(encode_reply(REPLY_COMMAND_NOT_SUPPORTED))
+                return
+            try:
+                dest_host, dest_port = await read_address(reader, atyp)
+            except Socks5GatewayError:
+                writer.write(encode_reply(REPLY_ADDRESS_NOT_SUPPORTED))
+                return
+
+            upstream = await self.open_upstream(filters, dest_host, dest_port)
+            if not upstream:
+                writer.write(encode_reply(REPLY_HOST_UNREACHABLE))
+                return
+
+            upstream_reader, upstream_writer = upstream
+            writer.write(encode_reply(REPLY_SUCCEEDED))
+            await writer.drain()
+            await asyncio.gather(
+                relay(reader, upstream_writer, self.buffer_size),
+                relay(upstream_reader, writer, self.buffer_size)
+            )
+        except Socks5GatewayError as e:
+            log.debug("Refused gateway client: %s", e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            log.exception("Unexpected error handling gateway client")
+        finally:
+            if upstream_writer:
+                upstream_writer.close()
+            writer.close()
+
+def serve(host=None, port=None):
+    """Run the gateway until interrupted"""
+    aiosocks5.run(Gateway(host=host, port=port).serve_forever())
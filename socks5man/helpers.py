@@ -1,18 +1,29 @@
 from __future__ import absolute_import
+import asyncio
+import bisect
 import logging
+import os
 import socket
-import socks
 import struct
+import threading
 import time
-import urllib.request
-import urllib.error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from socks5man import aiosocks5, metrics
 from socks5man.config import cfg
 from socks5man.constants import IANA_RESERVERD_IPV4_RANGES
+from socks5man.exceptions import Socks5ClientError
 from socks5man.misc import cwd
 
-from geoip2 import database as geodatabase
-from geoip2.errors import GeoIP2Error
+import maxminddb
+from geoip2 import models as geomodels
+
+try:
+    import maxminddb.extension
+    GEODB_MODE = maxminddb.MODE_MMAP_EXT
+except ImportError:
+    GEODB_MODE = maxminddb.MODE_MMAP
 
 log = logging.getLogger(__name__)
 
@@ -25,26 +36,89 @@ class Dictionary(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+def ipv4_to_int(ip):
+    """Convert an IPv4 string to an integer. Raises ValueError if the
+    IP is invalid"""
+    try:
+        return struct.unpack("!I", socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        raise ValueError("Invalid IPv4 address: %r" % (ip,))
+
+class IPv4RangeMatcher(object):
+    """Matches IPv4 addresses against a list of CIDR ranges. The ranges
+    are compiled once into a sorted table of merged integer intervals, so
+    a match is a single binary search."""
+
+    def __init__(self, ranges):
+        self.ranges = list(ranges)
+        intervals = []
+        for addr_block in self.ranges:
+            netaddr, _, bits = addr_block.partition("/")
+            bits = int(bits) if bits else 32
+            if bits < 0 or bits > 32:
+                raise ValueError("Invalid CIDR range: %r" % addr_block)
+
+            mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+            low = ipv4_to_int(netaddr) & mask
+            intervals.append((low, low | (~mask & 0xFFFFFFFF)))
+
+        self.starts = []
+        self.ends = []
+        for low, high in sorted(intervals):
+            if self.ends and low <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], high)
+            else:
+                self.starts.append(low)
+                self.ends.append(high)
+
+    def with_ranges(self, ranges):
+        """Returns a new matcher that also matches the given extra
+        CIDR ranges"""
+        return IPv4RangeMatcher(self.ranges + list(ranges))
+
+    def match_int(self, ipaddr):
+        """Returns True if the given integer IPv4 is in one of the ranges"""
+        pos = bisect.bisect_right(self.starts, ipaddr) - 1
+        return pos >= 0 and ipaddr <= self.ends[pos]
+
+    def match(self, ip):
+        """Returns True if the given IPv4 string is in one of the ranges.
+        Invalid IPs never match"""
+        try:
+            return self.match_int(ipv4_to_int(ip))
+        except ValueError:
+            return False
+
+    def classify(self, ips):
+        """Match a list of IPv4 strings at once.
+        @return: A list of booleans in the order of the given IPs"""
+        starts = self.starts
+        ends = self.ends
+        bisect_right = bisect.bisect_right
+        results = []
+        for ip in ips:
+            try:
+                ipaddr = ipv4_to_int(ip)
+            except ValueError:
+                results.append(False)
+                continue
+
+            pos = bisect_right(starts, ipaddr) - 1
+            results.append(pos >= 0 and ipaddr <= ends[pos])
+
+        return results
+
+    __contains__ = match
+
+reserved_ipv4 = IPv4RangeMatcher(IANA_RESERVERD_IPV4_RANGES)
+
 def is_reserved_ipv4(ip):
     """Check if the IP belongs to reserved addr_block.
     @param ip: IP address to verify.
     @return: boolean representing whether the IP belongs to
     a private addr_block or not.
     """
-
-    for addr_block in IANA_RESERVERD_IPV4_RANGES:
-        try:
-            ipaddr = struct.unpack(">I", socket.inet_aton(ip))[0]
-            netaddr, bits = addr_block.split("/")
-            network_low = struct.unpack(">I", socket.inet_aton(netaddr))[0]
-            network_high = network_low | (1 << (32 - int(bits))) - 1
-
-            if ipaddr <= network_high and ipaddr >= network_low:
-                return True
-        except:
-            continue
-
-    return False
+    return reserved_ipv4.match(ip)
 
 def is_ipv4(ip):
     """Try to parse string as Ipv4. Return True if success, False
@@ -57,47 +131,322 @@ def is_ipv4(ip):
     except socket.error:
         return False
 
+class LRUCache(object):
+    """Thread-safe bounded cache that evicts the least recently used entries
+    and counts its hits and misses"""
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def lookup(self, *keys):
+        """Returns the value of the first of the given keys that is cached.
+        Counts as a single hit or miss"""
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dict with the size, hits, and misses of the cache"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
 class GeoInfo(object):
+    """Geo IP lookups using the MaxMind geodb. The database is opened once
+    per process and reopened when the file on disk is replaced. Lookups are
+    cached per IP, or per /24 network if the geodb has a single record for
+    the whole /24."""
+
+    # The opened geodb reader and the version of the file it was opened
+    # from. Replaced as a whole, so the pair can be read without the lock
+    opened = None
+    last_version_check = 0
+    cache = LRUCache(65536)
+    lock = threading.Lock()
 
-    georeader = None
+    # Seconds between checks if the geodb file on disk was replaced
+    VERSION_CHECK_INTERVAL = 5
 
     @staticmethod
-    def ipv4info(ip):
-        """Returns a dict containing the country, country_code, and city for
-        a given IPv4 address"""
-        result = {
+    def _file_version(path):
+        st = os.stat(path)
+        return path, st.st_ino, st.st_mtime, st.st_size
+
+    @staticmethod
+    def reset():
+        """Forget the geodb reader and clear the lookup cache. The geodb is
+        reopened on the next lookup. The reader is not closed, as other
+        threads may still be using it. It is closed when it is garbage
+        collected"""
+        with GeoInfo.lock:
+            GeoInfo.cache.clear()
+            GeoInfo.opened = None
+
+    @staticmethod
+    def reader():
+        """Returns the opened geodb reader. Opens the geodb file memory
+        mapped if it was not opened yet or if the file has changed"""
+        now = time.time()
+        path = cwd("geodb", "extracted", "geodblite.mmdb")
+        opened = GeoInfo.opened
+        if opened and opened[1][0] == path and \
+                now - GeoInfo.last_version_check < \
+                GeoInfo.VERSION_CHECK_INTERVAL:
+            return opened[0]
+
+        with GeoInfo.lock:
+            GeoInfo.last_version_check = now
+            version = GeoInfo._file_version(path)
+            if GeoInfo.opened and version == GeoInfo.opened[1]:
+                return GeoInfo.opened[0]
+
+            if GeoInfo.opened:
+                log.debug("GeoIP database changed on disk, reopening")
+
+            # The previous reader is not closed, as other threads may still
+            # be using it. The cache is cleared before the new reader is
+            # used, so no lookups of the previous geodb remain
+            georeader = maxminddb.open_database(path, GEODB_MODE)
+            GeoInfo.cache.clear()
+            GeoInfo.opened = (georeader, version)
+            return georeader
+
+    @staticmethod
+    def cache_stats():
+        """Returns the hits and misses of the lookup cache"""
+        return GeoInfo.cache.stats()
+
+    @staticmethod
+    def unknown():
+        return {
             "country": "unknown",
             "country_code": "unknown",
             "city": "unknown"
         }
 
-        if not GeoInfo.georeader:
-            georeader = geodatabase.Reader(
-                cwd("geodb", "extracted", "geodblite.mmdb")
-            )
+    @staticmethod
+    @metrics.timed(metrics.GEOIP_LOOKUP_DURATION)
+    def ipv4info(ip):
+        """Returns a dict containing the country, country_code, and city for
+        a given IPv4 address"""
+        georeader = GeoInfo.reader()
 
         if is_reserved_ipv4(ip):
+            return GeoInfo.unknown()
+
+        return GeoInfo._lookup(georeader, ip)
+
+    @staticmethod
+    def ipv4info_many(ips):
+        """Returns a list of dicts containing the country, country_code, and
+        city for each of the given IPv4 addresses"""
+        georeader = GeoInfo.reader()
+        return [
+            GeoInfo.unknown() if reserved else GeoInfo._lookup(georeader, ip)
+            for ip, reserved in zip(ips, reserved_ipv4.classify(ips))
+        ]
+
+    @staticmethod
+    def _lookup(georeader, ip):
+        result = GeoInfo.unknown()
+        try:
+            network = "%s.0/24" % ip[:ip.rindex(".")]
+        except (ValueError, TypeError, AttributeError):
             return result
 
+        cached = GeoInfo.cache.lookup(network, ip)
+        if cached:
+            return dict(cached)
+
         try:
-            geodata = georeader.city(ip)
+            record, prefix_len = georeader.get_with_prefix_len(ip)
+        except ValueError:
+            return result
+
+        if record:
+            geodata = geomodels.City(record, locales=["en"])
             if geodata.country.name:
                 result["country"] = geodata.country.name
             if geodata.country.iso_code:
                 result["country_code"] = geodata.country.iso_code
             if geodata.city.name:
                 result["city"] = geodata.city.name
-        except (GeoIP2Error, ValueError):
-            return result
 
+        # All IPs in the /24 share this record if the network of the
+        # record is at least as large as the /24. Results of a reader that
+        # was replaced during the lookup are not cached
+        with GeoInfo.lock:
+            if GeoInfo.opened and GeoInfo.opened[0] is georeader:
+                GeoInfo.cache.set(
+                    network if prefix_len <= 24 else ip, dict(result)
+                )
         return result
 
+@metrics.REGISTRY.register_collector
+def collect_geoip_cache():
+    """Metrics of the GeoIP lookup cache. The hit ratio is the amount of
+    hits divided by the sum of the hits and misses"""
+    stats = GeoInfo.cache_stats()
+    return [
+        ("socks5man_geoip_cache_hits_total", "counter",
+         "Lookups answered by the GeoIP cache",
+         [("socks5man_geoip_cache_hits_total", [], stats["hits"])]),
+        ("socks5man_geoip_cache_misses_total", "counter",
+         "Lookups not answered by the GeoIP cache",
+         [("socks5man_geoip_cache_misses_total", [], stats["misses"])]),
+        ("socks5man_geoip_cache_entries", "gauge",
+         "Entries in the GeoIP cache",
+         [("socks5man_geoip_cache_entries", [], stats["size"])]),
+    ]
+
+class Resolver(object):
+    """Resolves hostnames to IPv4 addresses and caches the results. The
+    system resolver does not expose the TTL of DNS records, so results are
+    cached for a configured amount of seconds. Failed lookups are cached
+    for a shorter time."""
+
+    def __init__(self, ttl=300, negative_ttl=60, workers=16,
+                 maxsize=65536):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.cache = LRUCache(maxsize)
+
+    def _cached(self, hostname):
+        """Returns a (found, ip) tuple for the given hostname"""
+        entry = self.cache.get(hostname)
+        if entry and entry[1] > time.time():
+            return True, entry[0]
+        return False, None
+
+    def _store(self, hostname, ip):
+        ttl = self.ttl if ip else self.negative_ttl
+        self.cache.set(hostname, (ip, time.time() + ttl))
+        return ip
+
+    def resolve(self, hostname):
+        """Get IPv4 for specified hostname. Return None on fail"""
+        found, ip = self._cached(hostname)
+        if found:
+            return ip
+
+        try:
+            ip = socket.gethostbyname(hostname)
+        except (socket.gaierror, UnicodeError):
+            ip = None
+
+        return self._store(hostname, ip)
+
+    async def aresolve(self, hostname):
+        """Same as resolve, but does not block the running event loop"""
+        found, ip = self._cached(hostname)
+        if found:
+            return ip
+
+        loop = asyncio.get_event_loop()
+        try:
+            infos = await loop.getaddrinfo(
+                hostname, None, family=socket.AF_INET,
+                type=socket.SOCK_STREAM
+            )
+            ip = infos[0][4][0] if infos else None
+        except (socket.gaierror, UnicodeError):
+            ip = None
+
+        return self._store(hostname, ip)
+
+    def resolve_many(self, hostnames):
+        """Resolve multiple hostnames concurrently. IPv4 addresses are
+        returned as is.
+        @return: A dict of hostname to IPv4 (or None on fail)"""
+        result = {}
+        unresolved = set()
+        for hostname in hostnames:
+            if is_ipv4(hostname):
+                result[hostname] = hostname
+                continue
+
+            found, ip = self._cached(hostname)
+            if found:
+                result[hostname] = ip
+            else:
+                unresolved.add(hostname)
+
+        if len(unresolved) == 1:
+            hostname = unresolved.pop()
+            result[hostname] = self.resolve(hostname)
+        elif unresolved:
+            with ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(unresolved))
+            ) as pool:
+                unresolved = list(unresolved)
+                for hostname, ip in zip(
+                        unresolved, pool.map(self.resolve, unresolved)
+                ):
+                    result[hostname] = ip
+
+        return result
+
+    def clear(self):
+        self.cache.clear()
+
+_resolver = None
+
+def get_resolver():
+    """Returns the resolver of this process, configured using the [dns]
+    section of the config"""
+    global _resolver
+    if not _resolver:
+        _resolver = Resolver(
+            ttl=cfg("dns", "cache_ttl"),
+            negative_ttl=cfg("dns", "negative_ttl"),
+            workers=cfg("dns", "workers")
+        )
+    return _resolver
+
 def get_ipv4_hostname(hostname):
     """Get IPv4 for specified hostname. Return None on fail"""
-    try:
-        return socket.gethostbyname(hostname)
-    except socket.gaierror:
-        return None
+    return get_resolver().resolve(hostname)
 
 def validify_host_port(host, port):
     """Returns a dict with ip and port if both are valid, otherwise
@@ -127,66 +476,206 @@ def validify_host_port(host, port):
         port=port
     )
 
+async def aget_over_socks5(url, host, port, username=None, password=None,
+                           timeout=3):
+    """Make a HTTP GET request over socks5 of the given URL on the running
+    event loop. Returns the response body or None on failure"""
+    try:
+        return await asyncio.wait_for(
+            aiosocks5.http_get(
+                url, host, port, username=username, password=password
+            ), timeout
+        )
+    except (asyncio.TimeoutError, socket.error, EOFError,
+            Socks5ClientError) as e:
+        log.error("Error making HTTP GET over socks5: %s", e)
+    return None
+
 def get_over_socks5(url, host, port, username=None, password=None, timeout=3):
     """Make a HTTP GET request over socks5 of the given URL"""
+    return aiosocks5.run(aget_over_socks5(
+        url, host, port, username=username, password=password,
+        timeout=timeout
+    ))
+
+async def ameasure_connect_time(host, port, dest_host, dest_port,
+                                username=None, password=None, timeout=3):
+    """Measure the time it takes to set up a TCP connection to
+    dest_host:dest_port through the given socks5 server on the running event
+    loop. Returns None on failure"""
+    start = time.time()
+    try:
+        sock = await asyncio.wait_for(
+            aiosocks5.connect(
+                host, port, dest_host, dest_port, username=username,
+                password=password
+            ), timeout
+        )
+        sock.close()
+    except (asyncio.TimeoutError, socket.error, Socks5ClientError) as e:
+        log.error("Error connecting in connection time test: %s", e)
+        return None
 
-    socks.set_default_proxy(socks.SOCKS5, host, port, username=username, password=password)
-
-    response = None
-    clean_socket = socket.socket
+    return time.time() - start
+
+def calculate_mbps(size, took):
+    """Calculate the approximate Mbit/s for 'size' bytes downloaded in
+    'took' seconds"""
+    # Can be thrown if the download was instant. To still calculate
+    # a speed, use 0.001 as the time it took
+    if not took:
+        took = 0.001
+
+    speed = (size / took) / 1000000 * 8
+
+    # If the used file to measure is smaller than approx 1 MB,
+    # add a small amount as the small size might cause the TCP window
+    # to stay small
+    if size < 1000000:
+        speed += speed * 0.1
+
+    return speed
+
+async def ameasure_download(url, host, port, username=None, password=None,
+                            timeout=10, max_bytes=None, max_time=None,
+                            chunk_size=65536):
+    """Download the given URL through the given socks5 server on the running
+    event loop. The body is read in chunks of 'chunk_size' bytes that are
+    not kept, so memory use does not depend on the file size. The download
+    stops after 'max_bytes' bytes, after transferring for 'max_time'
+    seconds or after 'timeout' seconds in total.
+    @return: A (mbps, ttfb) tuple or None on failure. The ttfb is the time
+    in seconds until the first chunk of the body was received. The Mbit/s
+    is calculated from the data received after the first chunk, so the
+    connection setup does not affect it"""
+    start = time.time()
+    deadline = start + timeout
     try:
-        socket.socket = socks.socksocket
-        response = urllib.request.urlopen(url, timeout=timeout).read()
-    except urllib.error.URLError as e:
+        response = await asyncio.wait_for(
+            aiosocks5.http_open(
+                url, host, port, username=username, password=password
+            ), timeout
+        )
+    except (asyncio.TimeoutError, socket.error, EOFError,
+            Socks5ClientError) as e:
         log.error("Error making HTTP GET over socks5: %s", e)
+        return None
+
+    try:
+        first = await asyncio.wait_for(
+            response.read(chunk_size), deadline - time.time()
+        )
+        if not first:
+            log.error("Empty response body downloading: %s", url)
+            return None
+
+        first_byte = time.time()
+        ttfb = first_byte - start
+        if max_time:
+            deadline = min(deadline, first_byte + max_time)
+
+        received = len(first)
+        size = 0
+        end = first_byte
+        while not max_bytes or received < max_bytes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            read_size = chunk_size
+            if max_bytes:
+                read_size = min(chunk_size, max_bytes - received)
+            try:
+                data = await asyncio.wait_for(
+                    response.read(read_size), remaining
+                )
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+
+            received += len(data)
+            size += len(data)
+            end = time.time()
+    except (asyncio.TimeoutError, socket.error, EOFError,
+            Socks5ClientError) as e:
+        log.error("Error downloading over socks5: %s", e)
+        return None
     finally:
-        socket.socket = clean_socket
-    return response
+        response.close()
 
-def approximate_bandwidth(host, port, username=None, password=None,
-                          maxfail=1, times=2, timeout=10):
-    """Tries to determine the average download speed in Mbit/s.
-    Higher 'times' values will result in more accurate speeds, but will
-    take a longer time.
-    specified socks5. This value is subtracted from the total time it takes
-    to download a test file.
+    # The complete body was received at once. Fall back to the time
+    # including the connection setup.
+    if not size:
+        return calculate_mbps(received, ttfb), ttfb
+
+    return calculate_mbps(size, end - first_byte), ttfb
+
+async def ameasure_bandwidth(host, port, username=None, password=None,
+                             maxfail=1, times=2, timeout=10, max_bytes=None,
+                             max_time=None, chunk_size=65536):
+    """Tries to determine the average download speed in Mbit/s and time to
+    first byte by downloading the configured test file 'times' times,
+    using ameasure_download.
     @param maxfail: The maximum amount of times the socks5 is allowed to
-    timeout before the measurement should stop
+    fail before the measurement should stop
     @param times: The amount of times the test file should be downloaded.
     Optimal amount would be 3-4.
-    """
+    @return: A (mbps, ttfb) tuple or None on failure. A failed download
+    counts as 0 Mbit/s"""
     total = 0
+    total_ttfb = 0
+    measured = 0
     fails = 0
     test_url = cfg("bandwidth", "download_url")
 
     for t in range(times):
-        start = time.time()
-        response = get_over_socks5(
+        result = await ameasure_download(
             test_url, host, port, username=username, password=password,
-            timeout=timeout
+            timeout=timeout, max_bytes=max_bytes, max_time=max_time,
+            chunk_size=chunk_size
         )
-        if not response:
+        if not result:
             if fails >= maxfail:
                 return None
             fails += 1
             continue
 
-        took = time.time() - start
+        mbps, ttfb = result
+        total += mbps
+        total_ttfb += ttfb
+        measured += 1
 
-        # Calculate the approximate Mbit/s
-        try:
-            speed = (len(response) / took) / 1000000 * 8
-        except ZeroDivisionError:
-            # Can be thrown if the download was instant. To still calculate
-            # a speed, use 0.001 as the time it took
-            speed = (len(response) / 0.001) / 1000000 * 8
+    if not measured:
+        return None
 
-        # If the used file to measure is smaller than approx 1 MB,
-        # add a small amount as the small size might cause the TCP window
-        # to stay small
-        if len(response) < 1000000:
-            speed += speed * 0.1
+    return total / times, total_ttfb / measured
 
-        total += speed
+def measure_bandwidth(host, port, username=None, password=None, maxfail=1,
+                      times=2, timeout=10, max_bytes=None, max_time=None,
+                      chunk_size=65536):
+    """Same as ameasure_bandwidth, but runs on a new event loop"""
+    return aiosocks5.run(ameasure_bandwidth(
+        host, port, username=username, password=password, maxfail=maxfail,
+        times=times, timeout=timeout, max_bytes=max_bytes,
+        max_time=max_time, chunk_size=chunk_size
+    ))
 
-    return total / times
+def approximate_bandwidth(host, port, username=None, password=None,
+                          maxfail=1, times=2, timeout=10):
+    """Tries to determine the average download speed in Mbit/s. See
+    measure_bandwidth. Returns None on failure"""
+    result = measure_bandwidth(
+        host, port, username=username, password=password, maxfail=maxfail,
+        times=times, timeout=timeout
+    )
+    return result[0] if result else None
+
+async def aapproximate_bandwidth(host, port, username=None, password=None,
+                                 maxfail=1, times=2, timeout=10):
+    """Same as approximate_bandwidth, but runs on the running event loop"""
+    result = await ameasure_bandwidth(
+        host, port, username=username, password=password, maxfail=maxfail,
+        times=times, timeout=timeout
+    )
+    return result[0] if result else None
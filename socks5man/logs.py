@@ -33,3 +33,9 @@ def init_loggers(level=logging.INFO):
     shandler = ConsoleHandler(sys.stdout)
     shandler.setFormatter(fmt)
     logger.addHandler(shandler)
+
+def log_to_stderr():
+    """Write console logging to stderr, so stdout can be used for output"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, ConsoleHandler):
+            handler.stream = sys.stderr
@@ -2,15 +2,20 @@ from __future__ import absolute_import
 from __future__ import print_function
 import click
 import csv
+import datetime
+import itertools
 import logging
 import os
 import sys
 import subprocess
 
-from socks5man.database import Database, SCHEMA_VERSION
+from socks5man.database import Database, SCHEMA_VERSION, export_columns
 from socks5man.exceptions import Socks5manError
-from socks5man.logs import init_loggers
+from socks5man.export import export_socks5
+from socks5man.gateway import serve as serve_gateway
+from socks5man.logs import init_loggers, log_to_stderr
 from socks5man.manager import Manager
+from socks5man.metrics import start_exporter
 from socks5man.tools import verify_all, update_geodb
 from socks5man.misc import cwd
 
@@ -41,23 +46,35 @@ def main(ctx, debug):
         if ctx.invoked_subcommand != "migrate":
             exit(1)
 
+def _start_metrics():
+    try:
+        return start_exporter()
+    except OSError as e:
+        log.error("Failed to start metrics exporter: %s", e)
+        sys.exit(1)
+
 @main.command()
-@click.option("-r", "--repeated", is_flag=True, help="Continuously keep verifying all servers at the interval specified in the config")
+@click.option("-r", "--repeated", is_flag=True, help="Continuously keep verifying each server when it is due, using the intervals specified in the config")
 @click.option("--operational", is_flag=True, help="Only verify socks5 servers that are currently marked as operational")
 @click.option("--non-operational", is_flag=True, help="Only verify socks5 servers that are currently marked as not operational")
 @click.option("--unverified", is_flag=True, help="Only verify socks5 servers that have never been verified/tested to be operational")
-def verify(repeated, operational, non_operational, unverified):
+@click.option("-w", "--workers", type=click.INT, help="The amount of socks5 servers to verify concurrently. Overrides verify_workers in the config")
+def verify(repeated, operational, non_operational, unverified, workers):
     """Verify if the servers are operational."""
     if operational:
         operational = True
     elif non_operational:
         operational = False
 
+    exporter = _start_metrics()
     try:
-        verify_all(repeated, operational, unverified)
+        verify_all(repeated, operational, unverified, workers=workers)
     except KeyboardInterrupt:
         log.warning("CTRL+C detected! exiting.")
         sys.exit(0)
+    finally:
+        if exporter:
+            exporter.close()
 
 @main.command()
 @click.argument("host")
@@ -92,7 +109,9 @@ def add(host, port, username, password, description, private):
 @main.command("bulk-add")
 @click.argument("file_path")
 @click.option("-d", "--description", help="Description for this socks5 server bulk")
-def bulk_add(file_path, description):
+@click.option("-b", "--batch-size", type=click.INT, help="Amount of servers to insert per transaction. Overrides bulk_batch_size in the config")
+@click.option("--rejects", type=click.Path(), help="Write rejected rows and the reason they were rejected as CSV to the given file path")
+def bulk_add(file_path, description, batch_size, rejects):
     """Bulk add socks5 servers from CSV file. It does not verify if any of
      the provided servers already exist."""
     if not os.path.isfile(file_path):
@@ -103,28 +122,47 @@ def bulk_add(file_path, description):
         log.error("No read access on file '%s'", file_path)
         sys.exit(1)
 
-    with open(file_path, "rb") as fp:
-        try:
-            socks5s = [socks5 for socks5 in csv.DictReader(fp)]
-        except csv.Error as e:
-            log.error("Error reading CSV file: %s", e)
-            sys.exit(1)
-
-    if not socks5s:
-        log.warning("No socks5 servers to add")
+    if rejects and os.path.exists(rejects):
+        log.error("Path '%s' exists", rejects)
         sys.exit(1)
 
+    reject_writer = None
+    reject_fp = None
+    if rejects:
+        reject_fp = open(rejects, "w", newline="")
+        reject_writer = csv.writer(reject_fp)
+        reject_writer.writerow(["row", "reason", "host", "port"])
+
+    def on_reject(row, entry, reason):
+        log.warning("Skipping CSV row %s: %s", row, reason)
+        if reject_writer:
+            reject_writer.writerow(
+                [row, reason, entry.get("host"), entry.get("port")]
+            )
+
+    def on_progress(added, processed):
+        log.info("Processed %s rows, added %s servers", processed, added)
+
     try:
-        count = m.bulk_add(socks5s, description=description)
-        if count:
-            log.info("Successfully bulk added %s servers", count)
-        else:
-            log.error(
-                "Failed to bulk add servers. See log for more information"
+        with open(file_path, "r", newline="") as fp:
+            count = m.bulk_add(
+                csv.DictReader(fp), description=description,
+                batch_size=batch_size, progress=on_progress,
+                on_reject=on_reject
             )
+        log.info("Successfully bulk added %s servers", count)
+    except csv.Error as e:
+        log.error(
+            "Error reading CSV file: %s. Servers of batches before the error"
+            " were added", e
+        )
+        sys.exit(1)
     except Socks5manError as e:
         log.error("Failed to bulk add: %s", e)
         sys.exit(1)
+    finally:
+        if reject_fp:
+            reject_fp.close()
 
 @main.command("update-geodb")
 def geo():
@@ -137,9 +175,15 @@ def geo():
 @click.option("--everything", is_flag=True, help="Delete all socks5 servers")
 @click.option("--non-operational", is_flag=True, help="Delete all socks5 servers that are not operational")
 @click.option("--idrange", help="Delete the given range of socks5 ids. Example: 5-10")
-def delete(socks5_ids, everything, non_operational, idrange):
+@click.option("--code", help="Only delete socks5 servers with this 2-letter country code")
+@click.option("--description", help="Only delete socks5 servers with this description")
+@click.option("--checked-days-ago", type=click.INT, help="Only delete socks5 servers that were last checked more than this amount of days ago")
+def delete(socks5_ids, everything, non_operational, idrange, code,
+           description, checked_days_ago):
     """Remove the specified socks5 servers. The deletion flags and paramaters
-    cannot be mixed."""
+    cannot be mixed, except for the --code, --description and
+    --checked-days-ago filters. These can be combined with each other and
+    with --non-operational or --idrange."""
     if socks5_ids:
         for socksid in socks5_ids:
             log.info("Deleting socks5 server with id: %s", socksid)
@@ -148,37 +192,38 @@ def delete(socks5_ids, everything, non_operational, idrange):
             except Socks5manError as e:
                 log.error("Error deleting socks5 id %s. Error: %s", e)
 
-    elif non_operational:
-        to_delete = [s.id for s in m.list_socks5(operational=False)]
-        try:
-            db.bulk_delete_socks5(to_delete)
-        except Socks5manError as e:
-            log.error(
-                "Error bulk deleting socks5s. Error: %s", e
-            )
-            sys.exit(1)
-
-        log.info("Removed %s non-operational socks5 servers", len(to_delete))
+    elif non_operational or idrange or code or description or \
+            checked_days_ago is not None:
+        filters = {
+            "country_code": code,
+            "description": description,
+        }
+        if non_operational:
+            filters["operational"] = False
+        if checked_days_ago is not None:
+            filters["checked_before"] = datetime.datetime.now() - \
+                datetime.timedelta(days=checked_days_ago)
+
+        if idrange:
+            intrange = idrange.split("-")
+            if len(intrange) != 2:
+                log.error("Invalid integer range. Must provide 2 integers")
+                sys.exit(1)
 
-    elif idrange:
-        intrange = idrange.split("-")
-        if len(intrange) < 2:
-            log.error("Invalid integer range. Must provide 2 integers")
-            sys.exit(1)
+            for i in intrange:
+                if not i.isdigit():
+                    log.error("Invalid integer: %s", i)
+                    sys.exit(1)
 
-        for i in intrange:
-            if not i.isdigit():
-                log.error("Invalid integer: %s", i)
-                sys.exit(1)
+            filters["min_id"], filters["max_id"] = [int(i) for i in intrange]
 
-        start, end = intrange
         try:
-            db.bulk_delete_socks5([s for s in range(int(start), int(end)+1)])
+            deleted = db.delete_socks5_where(**filters)
         except Socks5manError as e:
             log.error("Error bulk deleting socks5s. Error: %s", e)
             sys.exit(1)
 
-        log.info("Deleted socks5 servers matching the ID range")
+        log.info("Removed %s socks5 servers", deleted)
 
     elif everything:
         try:
@@ -197,62 +242,109 @@ def delete(socks5_ids, everything, non_operational, idrange):
 @click.option("--operational", is_flag=True, help="Filter by socks5 servers that were tested to be operational")
 @click.option("--non-operational", is_flag=True, help="Filter by socks5 servers that are not operational or untested")
 @click.option("--count", is_flag=True, help="Display the number of matching socks5s")
-@click.option("--export", type=click.Path(), help="Export as CSV to given file path")
+@click.option("--limit", type=click.INT, help="Only list this amount of socks5s")
+@click.option("--after-id", type=click.INT, help="Only list socks5s with a higher ID. Use the last listed ID to view the next page")
+@click.option("--export", type=click.Path(), help="Export to the given file path. Use - to write to stdout")
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl", "binary"]), default="csv", help="The export format. Default: csv")
+@click.option("--columns", help="Comma separated columns to export. Exports all columns if not given")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the export with gzip")
 def list(country, code, city, host, operational, non_operational, count,
-         export):
+         limit, after_id, export, fmt, columns, compress):
     """List or export all socks5 servers."""
-    if not operational:
-        operational = None
+    if operational:
+        operational = True
     elif non_operational:
         operational = False
+    else:
+        operational = None
 
-    socks5s = m.list_socks5(
-        country=country, country_code=code, city=city,
-        host=host, operational=operational
+    filters = dict(
+        country=country, country_code=code, city=city, host=host,
+        operational=operational
     )
-
-    if not socks5s:
-        log.warning("No (matching) socks5 servers found")
-        sys.exit(1)
+    if export:
+        _export(export, fmt, columns, compress, limit, after_id, filters)
+        sys.exit(0)
 
     if count:
-        log.info("%s matching socks5 servers found.", len(socks5s))
+        amount = m.count_socks5(**filters)
+        if not amount:
+            log.warning("No (matching) socks5 servers found")
+            sys.exit(1)
+
+        log.info("%s matching socks5 servers found.", amount)
         sys.exit(0)
 
-    if not export:
-        print((
-            "{:<4} {:<12} {:<20} {:<5} {:<16} {:<12} {:<16} {:<16} {:<16}{:<16}".format(
-                "ID", "Operational", "Host", "Port", "Country", "Country Code", "City",
-                "Username", "Password", "Description",
-            )
-        ))
-        for socks5 in socks5s:
-            print(
-                "{:<4} {:<12} {:<20} {:<5} {:<16} {:<12} {:<16} {:<16} {:<16} {:<16}".format(
-                    socks5.id, "Yes" if socks5.operational else "No", socks5.host, socks5.port,
-                    socks5.country, socks5.country_code, socks5.city,
-                    socks5.username if socks5.username else "", socks5.password if socks5.password else "",
-                    socks5.description if socks5.description else ""
-                )
+    socks5s = m.iter_socks5(limit=limit, after_id=after_id, **filters)
+    first = next(socks5s, None)
+    if not first:
+        log.warning("No (matching) socks5 servers found")
+        sys.exit(1)
+    socks5s = itertools.chain([first], socks5s)
+
+    print((
+        "{:<4} {:<12} {:<20} {:<5} {:<16} {:<12} {:<16} {:<16} {:<16}{:<16}".format(
+            "ID", "Operational", "Host", "Port", "Country", "Country Code", "City",
+            "Username", "Password", "Description",
+        )
+    ))
+    for socks5 in socks5s:
+        print(
+            "{:<4} {:<12} {:<20} {:<5} {:<16} {:<12} {:<16} {:<16} {:<16} {:<16}".format(
+                socks5.id, "Yes" if socks5.operational else "No", socks5.host, socks5.port,
+                socks5.country, socks5.country_code, socks5.city or "",
+                socks5.username if socks5.username else "", socks5.password if socks5.password else "",
+                socks5.description if socks5.description else ""
             )
+        )
 
-        sys.exit(0)
 
-    if os.path.exists(export):
-        log.error("Path '%s' exists", export)
+def _export(path, fmt, columns, compress, limit, after_id, filters):
+    try:
+        columns = export_columns(columns)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+    if path == "-":
+        log_to_stderr()
+        fileobj = sys.stdout.buffer
+    elif os.path.exists(path):
+        log.error("Path '%s' exists", path)
         sys.exit(1)
+    else:
+        fileobj = open(path, "wb")
 
-    with open(export, "wb") as fw:
-        csv_w = csv.writer(fw)
-        header = True
-        for socks5 in socks5s:
-            socks5_d = socks5.to_dict()
-            if header:
-                csv_w.writerow(list(socks5_d.keys()))
-                header = False
+    try:
+        exported = export_socks5(
+            fileobj, fmt=fmt, columns=columns, compress=compress,
+            limit=limit, after_id=after_id, **filters
+        )
+    finally:
+        if fileobj is not sys.stdout.buffer:
+            fileobj.close()
 
-            csv_w.writerow(list(socks5_d.values()))
+    log.info("Exported %s socks5 servers", exported)
 
+@main.command()
+@click.option("-H", "--host", help="Address to listen on. Overrides the gateway host in the config")
+@click.option("-p", "--port", type=click.INT, help="Port to listen on. Overrides the gateway port in the config")
+def serve(host, port):
+    """Run a local SOCKS5 gateway that relays connections through the
+    operational socks5 servers. Filters can be given as username, such as:
+    country=germany,min_mbps=5"""
+    exporter = _start_metrics()
+    try:
+        serve_gateway(host=host, port=port)
+    except OSError as e:
+        log.error("Failed to start gateway: %s", e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        log.warning("CTRL+C detected! exiting.")
+        sys.exit(0)
+    finally:
+        if exporter:
+            exporter.close()
 
 @main.command()
 @click.option("--revision", default="head", help="Migrate to a specific version")
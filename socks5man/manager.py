@@ -1,11 +1,17 @@
 from __future__ import absolute_import
 import logging
+import time
+from itertools import islice
 
+from socks5man import metrics
+from socks5man.config import cfg
 from socks5man.database import Database
 from socks5man.exceptions import Socks5CreationError
 from socks5man.helpers import (
-    Dictionary, GeoInfo, validify_host_port
+    Dictionary, GeoInfo, validify_host_port, get_resolver, is_ipv4
 )
+from socks5man.policies import get_policy
+from socks5man.pool import Socks5Pool
 from socks5man.socks5 import Socks5
 
 log = logging.getLogger(__name__)
@@ -17,10 +23,28 @@ class Manager(object):
     A helper class that should be used to interact with Socks5man. All returned
     socks5 servers will be returned in a socks5man.socks5.Socks5 wrapper. This
     allows for direct usage of the retrieved information.
+
+    :param pool: Acquire socks5 servers from an in-memory pool instead of
+        the database. The pool is loaded once and kept up to date in a
+        background thread. Usage is written to the database in batches.
+        Use this if many servers are acquired per second. (bool)
     """
 
+    def __init__(self, pool=False):
+        self.pool = None
+        if pool:
+            self.pool = Socks5Pool()
+            self.pool.start()
+
+    def close(self):
+        """Stop the pool, if used, and write its pending usage to the
+        database."""
+        if self.pool:
+            self.pool.close()
+
     def acquire(self, country=None, country_code=None, city=None,
-                min_mbps_down=None, max_connect_time=None, update_usage=True):
+                min_mbps_down=None, max_connect_time=None, update_usage=True,
+                lease=False, policy=None):
         """
         Acquire a socks5 server that was tested to be operational. The
         returned socks5 server will automatically be marked as used.
@@ -34,6 +58,17 @@ class Manager(object):
         :param max_connect_time: The maximum average connection time in seconds
             a socks5 server should have (float).
         :param update_usage: Mark retrieved socks5 as used. (bool).
+        :param lease: Lease the server. Servers that have the configured
+            maximum amount of active leases are skipped, and the server with
+            the least active leases is returned. The lease must be released
+            with release() or by using the server as a context manager.
+            Leases are always acquired from the database. (bool).
+        :param policy: The selection policy that chooses the server:
+            round_robin, weighted_random, power_of_two or
+            least_recently_failed. A socks5man.policies.Policy object can
+            also be given. Uses the configured policy if not given. Policies
+            choose from the configured amount of least recently used
+            matching servers. Ignored when leasing.
         :return: A Socks5 object containing information about the server. None
             if no matching Socks5 server was found.
         :rtype: Socks5
@@ -43,15 +78,148 @@ class Manager(object):
         >>> from socks5man.manager import Manager
         >>> Manager().acquire(country="Germany")
         """
+        start = time.perf_counter()
+        source, socks5 = self._acquire(
+            country=country, country_code=country_code, city=city,
+            min_mbps_down=min_mbps_down, max_connect_time=max_connect_time,
+            update_usage=update_usage, lease=lease, policy=policy
+        )
+        metrics.ACQUIRE_DURATION.observe(
+            time.perf_counter() - start, source=source
+        )
+        metrics.ACQUIRES.inc(
+            source=source, result="found" if socks5 else "none"
+        )
+        return socks5
+
+    def _acquire(self, country, country_code, city, min_mbps_down,
+                 max_connect_time, update_usage, lease, policy):
+        """Acquire a socks5 server from a lease, the pool or the database
+        @return: A tuple of the source and a Socks5 object or None"""
+        if lease:
+            leased = db.acquire_lease(
+                cfg("leases", "max_per_socks5"), cfg("leases", "expire"),
+                country=country, country_code=country_code, city=city,
+                min_mbps_down=min_mbps_down, max_connect_time=max_connect_time
+            )
+            if not leased:
+                return "lease", None
+            db_socks5, db_lease = leased
+            return "lease", Socks5(db_socks5, lease=db_lease)
+
+        policy = get_policy(policy)
+        candidates = 1
+        if policy.uses_candidates:
+            candidates = cfg("socks5man", "policy_candidates")
+
+        if self.pool:
+            db_socks5 = self.pool.acquire(
+                country=country, country_code=country_code, city=city,
+                min_mbps_down=min_mbps_down,
+                max_connect_time=max_connect_time, update_usage=update_usage,
+                policy=policy, candidates=candidates
+            )
+            return "pool", Socks5(db_socks5) if db_socks5 else None
+
+        if policy.uses_candidates:
+            db_socks5 = self._choose(
+                policy, candidates, update_usage, country=country,
+                country_code=country_code, city=city,
+                min_mbps_down=min_mbps_down,
+                max_connect_time=max_connect_time
+            )
+            return "database", Socks5(db_socks5) if db_socks5 else None
+
         db_socks5 = db.find_socks5(
             country=country, country_code=country_code, city=city,
             min_mbps_down=min_mbps_down, max_connect_time=max_connect_time,
             update_usage=update_usage
         )
         if db_socks5:
-            return Socks5(db_socks5[0])
+            return "database", Socks5(db_socks5[0])
         else:
-            return None
+            return "database", None
+
+    def _choose(self, policy, candidates, update_usage, **filters):
+        """Let the policy choose from 'candidates' matching socks5s and
+        claim the chosen socks5. Concurrent callers can choose the same
+        socks5, so the claim only succeeds if the socks5 was not used since
+        it was read. If it was, the policy chooses from the remaining
+        candidates. New candidates are read if all were claimed by others.
+        @return: A socks5 database object or None"""
+        for _ in range(db.CLAIM_ATTEMPTS):
+            found = db.find_socks5(
+                update_usage=False, limit=candidates, **filters
+            )
+            if not found:
+                return None
+
+            while found:
+                db_socks5 = policy.choose(found)
+                if not update_usage:
+                    return db_socks5
+
+                last_use = db.claim_socks5(db_socks5.id, db_socks5.last_use)
+                if last_use:
+                    db_socks5.last_use = last_use
+                    return db_socks5
+
+                found.remove(db_socks5)
+
+        return None
+
+    def acquire_many(self, n=None, quotas=None, country=None,
+                     country_code=None, city=None, min_mbps_down=None,
+                     max_connect_time=None, update_usage=True):
+        """
+        Acquire multiple distinct socks5 servers that were tested to be
+        operational. The servers are selected and marked as used in a single
+        database write, so concurrent callers never receive the same server.
+        Servers are always acquired from the database, also if the pool is
+        used.
+
+        :param n: The amount of servers to acquire. Defaults to the sum of
+            the quotas.
+        :param quotas: A dict of 2-letter country codes and the amount of
+            servers to acquire in that country. If n is higher than the sum
+            of the quotas, the remaining servers are acquired in other
+            countries. Example: {"DE": 50, "US": 100}.
+        :param country: Country the socks5 servers should be in.
+        :param country_code: 2-letter country code (ISO 3166-1 alpha-2).
+        :param city: City the socks5 servers should be in.
+        :param min_mbps_down: The minimum average download speed in mbits
+            (float).
+        :param max_connect_time: The maximum average connection time in
+            seconds a socks5 server should have (float).
+        :param update_usage: Mark retrieved socks5s as used. (bool).
+        :return: A list of Socks5 objects. The list is shorter than n if
+            not enough matching servers are available.
+        :rtype: list
+
+        :raises: ValueError
+
+        :Example:
+
+        >>> from socks5man.manager import Manager
+        >>> Manager().acquire_many(200, quotas={"DE": 50, "US": 100})
+        """
+        quota_total = sum(quotas.values()) if quotas else 0
+        if n is None:
+            n = quota_total
+        if n < quota_total:
+            raise ValueError(
+                "The amount of servers (%s) is lower than the sum of the"
+                " quotas (%s)" % (n, quota_total)
+            )
+
+        return [
+            Socks5(db_socks5) for db_socks5 in db.find_socks5(
+                country=country, country_code=country_code, city=city,
+                min_mbps_down=min_mbps_down,
+                max_connect_time=max_connect_time, update_usage=update_usage,
+                limit=n, quotas=quotas
+            )
+        ]
 
     def add(self, host, port, username=None, password=None, dnsport=None,
             description=None, private=False):
@@ -136,12 +304,25 @@ class Manager(object):
         entry["id"] = socksid
         return entry
 
-    def bulk_add(self, socks5_dict_list, description=None):
+    def bulk_add(self, socks5_dict_list, description=None, batch_size=None,
+                 progress=None, on_reject=None):
         """Bulk add multiple socks5 server. No duplicate checking is done.
-
-        :param socks5_dict_list: A list of dictionaries that at a minimum
-            contain the keys and valid values for 'host' and 'port'.
+        The servers are read from the given iterable, validated, geolocated,
+        and inserted in batches. Each batch is inserted in a single
+        transaction, so memory usage does not depend on the amount of
+        servers.
+
+        :param socks5_dict_list: An iterable of dictionaries that at a minimum
+            contain the keys and valid values for 'host' and 'port'. Can be a
+            generator, such as a csv.DictReader.
         :param description: A description to be added to all provided servers
+        :param batch_size: The amount of servers to insert per transaction.
+            Uses bulk_batch_size from the config if not provided.
+        :param progress: Optional callable that is called after each
+            inserted batch with the amount of added and processed servers.
+        :param on_reject: Optional callable that is called with the (1-based)
+            position, the dictionary, and the reason for each server that is
+            skipped. Rejected servers are logged if it is not provided.
         :returns: The amount of socks5 server that were successfully added
         :rtype: int
 
@@ -159,51 +340,86 @@ class Manager(object):
             hostnames or missing fields will be skipped. Socks5CreationError
             is raised if no valid servers are in the list.
         """
-        new = []
-        for entry in socks5_dict_list:
-            if "host" not in entry or "port" not in entry:
-                continue
-
-            password = entry.get("password")
-            username = entry.get("username")
-            if (not username and password) or (not password and username):
-                log.warning(
-                    "Either no password and no password or both a password "
-                    "and a username should be provided on socks5 creation. It "
-                    "is not possible to provide only a username or password"
-                )
-                continue
-
-            valid_entry = validify_host_port(entry["host"], entry["port"])
-
-            if not valid_entry:
-                log.error("Invalid host or port provided")
-                continue
-
-            if description:
-                entry["description"] = description
-
-            new_entry = {
-                "host": entry["host"],
-                "port": valid_entry.port,
-                "country": None,
-                "country_code": None,
-                "city": None,
-                "username": username,
-                "password": password,
-                "operational": False,
-                "dnsport": entry.get("dnsport"),
-                "description": entry.get("description"),
-                "private": entry.get("private"),
-            }
-            new_entry.update(GeoInfo.ipv4info(valid_entry.ip))
-            new.append(new_entry)
+        if not batch_size:
+            batch_size = cfg("socks5man", "bulk_batch_size")
+
+        def reject(position, entry, reason):
+            if on_reject:
+                on_reject(position, entry, reason)
+            else:
+                log.warning("Skipping socks5 server %s: %s", position, reason)
+
+        added = 0
+        processed = 0
+        entries = enumerate(socks5_dict_list, start=1)
+        while True:
+            chunk = list(islice(entries, batch_size))
+            if not chunk:
+                break
+
+            # Resolve all hostnames of the chunk concurrently, so validating
+            # the entries below uses the cached results
+            get_resolver().resolve_many(
+                entry["host"] for _, entry in chunk
+                if entry.get("host") and not is_ipv4(entry["host"])
+            )
 
-        if not new:
+            batch = []
+            ips = []
+            for position, entry in chunk:
+                if not entry.get("host") or not entry.get("port"):
+                    reject(position, entry, "Missing host or port")
+                    continue
+
+                password = entry.get("password")
+                username = entry.get("username")
+                if (not username and password) or (not password and username):
+                    reject(
+                        position, entry,
+                        "Either no password and no password or both a "
+                        "password and a username should be provided on socks5"
+                        " creation. It is not possible to provide only a "
+                        "username or password"
+                    )
+                    continue
+
+                valid_entry = validify_host_port(entry["host"], entry["port"])
+                if not valid_entry:
+                    reject(position, entry, "Invalid host or port provided")
+                    continue
+
+                batch.append({
+                    "host": entry["host"],
+                    "port": valid_entry.port,
+                    "country": None,
+                    "country_code": None,
+                    "city": None,
+                    "username": username,
+                    "password": password,
+                    "operational": False,
+                    "dnsport": entry.get("dnsport"),
+                    "description": description or entry.get("description"),
+                    "private": entry.get("private"),
+                })
+                ips.append(valid_entry.ip)
+
+            processed = chunk[-1][0]
+            if batch:
+                added += self._insert_batch(batch, ips)
+            if progress:
+                progress(added, processed)
+
+        if not added:
             raise Socks5CreationError("No socks5 servers to add provided")
 
-        db.bulk_add_socks5(new)
-        return len(new)
+        return added
+
+    def _insert_batch(self, batch, ips):
+        for new_entry, geoinfo in zip(batch, GeoInfo.ipv4info_many(ips)):
+            new_entry.update(geoinfo)
+
+        db.bulk_add_socks5(batch)
+        return len(batch)
 
     def delete(self, socks5_id):
         """Delete socks5 with given id
@@ -228,11 +444,13 @@ class Manager(object):
         db.delete_all_socks5()
 
     def list_socks5(self, country=None, country_code=None, city=None,
-                    host=None, operational=None, description=None):
+                    host=None, operational=None, description=None,
+                    limit=None, after_id=None):
         """Retrieve list of existing socks5 servers using the specified
         filters. This does not mark them as used. It only retrieves a list of
         matching servers. Returns an empty list if no matches were found.
-        Returns all servers if no filters were provided.
+        Returns all servers if no filters were provided. Servers are ordered
+        by id.
 
         :param country: Country of a socks5 server
         :param country_code: 2-letter country code (ISO 3166-1 alpha-2)
@@ -241,6 +459,9 @@ class Manager(object):
         :param operational: Operational or not (bool).
             Is ignored if value is None
         :param description: socks server description
+        :param limit: The maximum amount of servers to return (int).
+        :param after_id: Only return servers with a higher id (int). Use the
+            id of the last server of a page to retrieve the next page.
         :returns: A list of Socks5 objects containing the information of the
             matching servers.
         :rtype: list
@@ -264,5 +485,57 @@ class Manager(object):
         socks5s = db.list_socks5(
             country=country, country_code=country_code, city=city,
             host=host, operational=operational, description=description,
+            limit=limit, after_id=after_id
         )
         return [Socks5(s) for s in socks5s]
+
+    def iter_socks5(self, country=None, country_code=None, city=None,
+                    host=None, operational=None, description=None,
+                    limit=None, after_id=None, page_size=1000):
+        """Iterate over existing socks5 servers using the specified filters.
+        The servers are retrieved in pages of page_size servers, so memory
+        usage does not depend on the amount of servers. Takes the same
+        filters as :meth:`list_socks5`.
+
+        :param page_size: The amount of servers retrieved per query (int).
+        :returns: A generator of Socks5 objects, ordered by id.
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(
+                page_size, remaining
+            )
+            page = self.list_socks5(
+                country=country, country_code=country_code, city=city,
+                host=host, operational=operational, description=description,
+                limit=size, after_id=after_id
+            )
+            for socks5 in page:
+                yield socks5
+
+            if len(page) < size:
+                break
+
+            after_id = page[-1].id
+            if remaining is not None:
+                remaining -= len(page)
+
+    def count_socks5(self, country=None, country_code=None, city=None,
+                     host=None, operational=None, description=None):
+        """Count existing socks5 servers using the specified filters. Takes
+        the same filters as :meth:`list_socks5`. The servers are counted by
+        the database and are not retrieved.
+
+        :returns: The amount of matching servers
+        :rtype: int
+
+        :example:
+
+        >>> from socks5man.manager import Manager
+        >>> Manager().count_socks5(country="united states")
+        2
+        """
+        return db.count_socks5(
+            country=country, country_code=country_code, city=city,
+            host=host, operational=operational, description=description
+        )
@@ -0,0 +1,423 @@
+from __future__ import absolute_import
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from socks5man.config import cfg
+from socks5man.exceptions import Socks5ConfigError
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0
+)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n"
+    ).replace("\"", "\\\"")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, _escape(value)) for name, value in labels
+    )
+
+def render_family(name, metric_type, documentation, samples):
+    """Render a metric family in the Prometheus text format
+    @param samples: A list of (name, labels, value) tuples. Labels is a list
+    of (label name, label value) tuples
+    @return: A list of lines"""
+    lines = [
+        "# HELP %s %s" % (name, _escape(documentation)),
+        "# TYPE %s %s" % (name, metric_type)
+    ]
+    for sample_name, labels, value in samples:
+        lines.append("%s%s %s" % (
+            sample_name, _format_labels(labels), _format_value(value)
+        ))
+    return lines
+
+class Metric(object):
+    """Base of all metrics. Values are kept per combination of label
+    values. All labels given in 'labelnames' must be given when changing a
+    value"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is None:
+            registry = REGISTRY
+        if registry is not False:
+            registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                "Metric %s requires the labels: %s" % (
+                    self.name, ", ".join(self.labelnames)
+                )
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def samples(self):
+        """Returns a list of (name, labels, value) tuples"""
+        with self.lock:
+            return [
+                (self.name, self._labels(key), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+    def render(self):
+        return render_family(
+            self.name, self.type, self.documentation, self.samples()
+        )
+
+class Counter(Metric):
+    """A value that only increases, such as the amount of checks"""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """A value that can go up and down, such as the amount of socks5s"""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+class Histogram(Metric):
+    """Counts observed values, such as durations, in buckets. The count of
+    a histogram also gives the rate of the observed events"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(
+            name, documentation, labelnames=labelnames, registry=registry
+        )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Bucket counts, with a last bucket for +Inf, and the sum
+                state = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[key] = state
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """Returns a context manager that observes the time spent in its
+        block"""
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        """Returns the count and sum of the observed values"""
+        state = self.values.get(self._key(labels))
+        if state is None:
+            return 0, 0.0
+        return sum(state[0]), state[1]
+
+    def samples(self):
+        samples = []
+        bounds = self.buckets + (float("inf"),)
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    samples.append((
+                        "%s_bucket" % self.name,
+                        labels + [("le", _format_value(bound))], cumulative
+                    ))
+                samples.append(("%s_count" % self.name, labels, cumulative))
+                samples.append(("%s_sum" % self.name, labels, total))
+        return samples
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(
+            time.perf_counter() - self.start, **self.labels
+        )
+
+def timed(histogram, **labels):
+    """Decorator that observes the duration of each call of a function or
+    coroutine function in the given histogram"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(
+                        time.perf_counter() - start, **labels
+                    )
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(
+                        time.perf_counter() - start, **labels
+                    )
+        return wrapper
+    return decorator
+
+class Registry(object):
+    """All metrics of the process. Collectors are functions that return
+    values that are read when the metrics are rendered, such as the amount
+    of socks5s in the database. A collector returns a list of
+    (name, type, documentation, samples) tuples"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def register_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                log.error("Error collecting metrics: %s", e)
+                continue
+            for family in families:
+                lines.extend(render_family(*family))
+
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+VERIFICATIONS = Counter(
+    "socks5man_verifications_total",
+    "Operationality checks of socks5 servers by result", ("result",)
+)
+PROBE_DURATION = Histogram(
+    "socks5man_probe_duration_seconds",
+    "Duration of the operationality, connection time and bandwidth probes",
+    ("probe",)
+)
+ACQUIRE_DURATION = Histogram(
+    "socks5man_acquire_duration_seconds",
+    "Duration of acquiring a socks5 server by source", ("source",)
+)
+ACQUIRES = Counter(
+    "socks5man_acquires_total",
+    "Acquired socks5 servers by source and whether a server was found",
+    ("source", "result")
+)
+DB_QUERY_DURATION = Histogram(
+    "socks5man_db_query_duration_seconds",
+    "Duration of database queries", ("query",)
+)
+GEOIP_LOOKUP_DURATION = Histogram(
+    "socks5man_geoip_lookup_duration_seconds",
+    "Duration of GeoIP lookups of single IPs"
+)
+
+class _Handler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request from %s: %s", self.client_address[0],
+                  format % args)
+
+class _MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def write_textfile(path, registry=REGISTRY):
+    """Write the metrics to a file for the node_exporter textfile
+    collector. The file is replaced atomically"""
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        fp.write(registry.render())
+    os.replace(tmp_path, path)
+
+class Exporter(object):
+    """Serves the metrics over HTTP and/or periodically writes them to a
+    textfile in background threads. A port of 0 disables the HTTP endpoint,
+    an empty textfile path disables writing the textfile"""
+
+    def __init__(self, host=None, port=None, textfile=None,
+                 textfile_interval=None, registry=REGISTRY):
+        self.host = host or cfg("metrics", "host")
+        self.port = cfg("metrics", "port") if port is None else port
+        self.textfile = cfg("metrics", "textfile") if textfile is None \
+            else textfile
+        self.textfile_interval = textfile_interval or cfg(
+            "metrics", "textfile_interval"
+        )
+        self.registry = registry
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        """Start serving and/or writing the metrics. Returns the port the
+        metrics are served on, or None"""
+        self._stop.clear()
+        if self.port:
+            handler = type("Handler", (_Handler,), {
+                "registry": self.registry
+            })
+            self.server = _MetricsServer((self.host, self.port), handler)
+            self.port = self.server.server_address[1]
+            self._thread(self.server.serve_forever, "socks5man-metrics")
+            log.info(
+                "Serving metrics on http://%s:%s/metrics", self.host,
+                self.port
+            )
+
+        if self.textfile:
+            self._thread(self._write_textfile, "socks5man-metrics-textfile")
+
+        return self.port or None
+
+    def _write(self):
+        try:
+            write_textfile(self.textfile, self.registry)
+        except (IOError, OSError) as e:
+            log.error(
+                "Error writing metrics textfile '%s': %s", self.textfile, e
+            )
+
+    def _write_textfile(self):
+        self._write()
+        while not self._stop.wait(self.textfile_interval):
+            self._write()
+
+    def close(self):
+        """Stop serving the metrics and write the textfile a final time"""
+        self._stop.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.textfile:
+            self._write()
+
+def start_exporter():
+    """Start an Exporter if metrics are enabled in the config. Metrics are
+    disabled if the config has no [metrics] section
+    @return: The started Exporter or None"""
+    try:
+        enabled = cfg("metrics", "enabled")
+    except Socks5ConfigError:
+        return None
+    if not enabled:
+        return None
+
+    exporter = Exporter()
+    exporter.start()
+    return exporter
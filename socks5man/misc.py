@@ -37,25 +37,49 @@ def md5(fname):
 
     return hash_md5.hexdigest()
 
-def unpack_mmdb(tarpath, to):
-    with tarfile.open(tarpath) as tar:
-        for member in tar:
-            if not member.isfile():
-                continue
-
-            if os.path.splitext(member.name)[1] == ".mmdb":
-                with open(to, "wb") as fw:
-                    shutil.copyfileobj(tar.fileobj, fw, member.size)
-                break
-
-    geodb_hash = md5(tarpath)
-    with open(cwd("geodb", ".version"), "w") as fw:
-        fw.write(geodb_hash)
+def unpack_mmdb(tarpath, to, version=None):
+    """Extract the first .mmdb file in the tar to 'to' and store the version
+    of the tar. The file is extracted next to 'to' and then renamed over
+    it, so readers of 'to' always see a complete file.
+    @param version: The md5 of the tar. Calculated if not given
+    @return: True if a .mmdb file was extracted"""
+    staging = "%s.%s.tmp" % (to, os.getpid())
+    extracted = False
+    try:
+        with tarfile.open(tarpath) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                if os.path.splitext(member.name)[1] == ".mmdb":
+                    with open(staging, "wb") as fw:
+                        shutil.copyfileobj(tar.extractfile(member), fw)
+                    extracted = True
+                    break
+
+        if not extracted:
+            return False
+
+        os.replace(staging, to)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+    version_file = cwd("geodb", ".version")
+    with open("%s.tmp" % version_file, "w") as fw:
+        fw.write(version or md5(tarpath))
+    os.replace("%s.tmp" % version_file, version_file)
+    return True
 
 def set_cwd(path):
     global _path
     _path = os.path.expanduser(path)
 
+    # The config of the previous cwd must not be used anymore. Imported
+    # here, as the config module uses cwd()
+    from socks5man.config import Config
+    Config._cache = {}
+
 def cwd(*args, **kwargs):
     if kwargs.get("internal"):
         return os.path.join(socks5man.__path__[0], "setupdata", *args)
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import random
+
+from socks5man.config import cfg, cfg_default
+from socks5man.exceptions import Socks5ConfigError
+
+# Values used to score socks5s of which the bandwidth or connection time
+# was not measured yet
+DEFAULT_BANDWIDTH = 1.0
+DEFAULT_CONNECT_TIME = 1.0
+
+def score(socks5):
+    """Score a socks5 by its approximate bandwidth divided by its connection
+    time. A higher score is better"""
+    bandwidth = socks5.bandwidth or DEFAULT_BANDWIDTH
+    connect_time = socks5.connect_time or DEFAULT_CONNECT_TIME
+    return bandwidth / max(connect_time, 0.001)
+
+class Policy(object):
+    """A selection policy chooses which socks5 is acquired. Policies choose
+    from a small amount of candidates: the least recently used matching
+    socks5s, in the order Database.find_socks5 uses. The candidates are
+    read using the acquire index or the heaps of the pool, so choosing does
+    not depend on the total amount of socks5s."""
+
+    name = None
+    # If False, the first candidate is always chosen and only one candidate
+    # has to be retrieved
+    uses_candidates = True
+
+    def __init__(self, rng=None):
+        self.random = rng or random.Random()
+
+    def choose(self, candidates):
+        """Choose a socks5 from the given non-empty list of candidates"""
+        raise NotImplementedError
+
+class RoundRobin(Policy):
+    """Choose the least recently used socks5"""
+
+    name = "round_robin"
+    uses_candidates = False
+
+    def choose(self, candidates):
+        return candidates[0]
+
+class WeightedRandom(Policy):
+    """Choose a random socks5, weighted by its score. Fast socks5s are
+    chosen more often, but slow socks5s are still used"""
+
+    name = "weighted_random"
+
+    def choose(self, candidates):
+        return self.random.choices(
+            candidates, weights=[score(c) for c in candidates]
+        )[0]
+
+class PowerOfTwoChoices(Policy):
+    """Choose two random socks5s and use the one with the best score"""
+
+    name = "power_of_two"
+
+    def choose(self, candidates):
+        if len(candidates) < 2:
+            return candidates[0]
+
+        first, second = self.random.sample(candidates, 2)
+        if score(second) > score(first):
+            return second
+        return first
+
+class LeastRecentlyFailed(Policy):
+    """Choose the socks5 of which the last failed check or lease is the
+    oldest. Socks5s that never failed are chosen first, least recently
+    used first"""
+
+    name = "least_recently_failed"
+
+    def choose(self, candidates):
+        for candidate in candidates:
+            if candidate.last_failure is None:
+                return candidate
+        return min(candidates, key=lambda c: c.last_failure)
+
+POLICIES = dict(
+    (policy.name, policy) for policy in (
+        RoundRobin, WeightedRandom, PowerOfTwoChoices, LeastRecentlyFailed
+    )
+)
+
+def get_policy(policy=None):
+    """Return a Policy for the given policy name or Policy. Uses the
+    configured policy if None is given, or the default policy if the config
+    does not exist yet
+    @raise ValueError: if the policy name is unknown"""
+    if isinstance(policy, Policy):
+        return policy
+
+    name = policy
+    if not name:
+        try:
+            name = cfg("socks5man", "policy")
+        except Socks5ConfigError:
+            name = cfg_default("socks5man", "policy")
+    if name not in POLICIES:
+        raise ValueError(
+            "Unknown selection policy '%s'. Choose from: %s" % (
+                name, ", ".join(sorted(POLICIES))
+            )
+        )
+    return POLICIES[name]()
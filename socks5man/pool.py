@@ -0,0 +1,218 @@
+from __future__ import absolute_import
+import atexit
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+from socks5man.config import cfg
+from socks5man.database import Database, acquire_order_key
+from socks5man.exceptions import Socks5manError
+
+log = logging.getLogger(__name__)
+
+db = Database()
+
+class Socks5Pool(object):
+    """In-memory snapshot of the operational socks5 servers. Acquiring
+    from the pool does not use the database. Each combination of filters
+    has its own heap that is ordered like Database.find_socks5 orders
+    socks5s.
+
+    A background thread writes the last_use of acquired socks5s to the
+    database every 'sync_interval' seconds. The snapshot is loaded again
+    when the verifier changes the operational state of socks5s, which is
+    checked every 'refresh_interval' seconds, and at least every 'max_age'
+    seconds."""
+
+    def __init__(self, sync_interval=None, refresh_interval=None,
+                 max_age=None):
+        self.sync_interval = sync_interval or cfg("pool", "sync_interval")
+        self.refresh_interval = refresh_interval or cfg(
+            "pool", "refresh_interval"
+        )
+        self.max_age = max_age or cfg("pool", "max_age")
+        self.lock = threading.Lock()
+        self.socks5s = {}
+        self.heaps = {}
+        self.pending = {}
+        self.state = None
+        self.loaded_at = 0
+        self.last_refresh_check = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Load the snapshot and start the background sync thread"""
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="socks5man-pool"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop the background thread and write all pending usage"""
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Socks5manError as e:
+                log.error("Error syncing socks5 pool with database: %s", e)
+
+    def load(self):
+        """Load all operational socks5s from the database. Usage that is
+        not written yet is kept"""
+        # Read the state first, so changes made while loading are detected
+        # by the next refresh
+        state = db.operational_state()
+        socks5s = db.list_socks5(operational=True)
+        with self.lock:
+            for socks5 in socks5s:
+                last_use = self.pending.get(socks5.id)
+                if last_use and (
+                        socks5.last_use is None or last_use > socks5.last_use
+                ):
+                    socks5.last_use = last_use
+
+            self.socks5s = dict((s.id, s) for s in socks5s)
+            self.heaps = {}
+            self.state = state
+            self.loaded_at = time.time()
+            self.last_refresh_check = self.loaded_at
+
+        log.debug("Loaded %s socks5s into pool", len(socks5s))
+
+    def sync(self):
+        """Write pending usage and reload the snapshot if the operational
+        state in the database has changed"""
+        self.flush()
+        now = time.time()
+        if now - self.loaded_at >= self.max_age:
+            self.load()
+        elif now - self.last_refresh_check >= self.refresh_interval:
+            self.last_refresh_check = now
+            if db.operational_state() != self.state:
+                self.load()
+
+    def flush(self):
+        """Write the last_use of all socks5s acquired since the previous
+        flush to the database in a single transaction"""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        if not pending:
+            return
+
+        try:
+            db.bulk_update_results([
+                {"id": socks5_id, "last_use": last_use}
+                for socks5_id, last_use in pending.items()
+            ])
+        except Socks5manError:
+            with self.lock:
+                for socks5_id, last_use in pending.items():
+                    self.pending.setdefault(socks5_id, last_use)
+            raise
+
+    @staticmethod
+    def filter_key(country=None, country_code=None, city=None,
+                   min_mbps_down=None, max_connect_time=None):
+        return (
+            country.lower() if country else None,
+            country_code.lower() if country_code else None,
+            city.lower() if city else None,
+            min_mbps_down or None, max_connect_time or None
+        )
+
+    @staticmethod
+    def matches(socks5, key):
+        """Returns True if the socks5 matches the filters of the given
+        filter key, in the same way as Database.find_socks5 filters"""
+        country, country_code, city, min_mbps_down, max_connect_time = key
+        if country and (socks5.country or "").lower() != country:
+            return False
+        if country_code and \
+                (socks5.country_code or "").lower() != country_code:
+            return False
+        if city and (socks5.city or "").lower() != city:
+            return False
+        if min_mbps_down and (
+                socks5.bandwidth is None or socks5.bandwidth < min_mbps_down
+        ):
+            return False
+        if max_connect_time and (
+                socks5.connect_time is None or
+                socks5.connect_time > max_connect_time
+        ):
+            return False
+        return True
+
+    def _entry(self, socks5):
+        # The last_use is stored in the entry. Socks5s acquired through
+        # another heap have a newer last_use, which marks their entry in
+        # this heap as outdated. Equal keys are ordered by id, like the
+        # acquire index does.
+        return (
+            acquire_order_key(socks5), socks5.id, socks5.last_use, socks5
+        )
+
+    def _heap(self, key):
+        heap = self.heaps.get(key)
+        if heap is None:
+            heap = [
+                self._entry(s) for s in self.socks5s.values()
+                if self.matches(s, key)
+            ]
+            heapq.heapify(heap)
+            self.heaps[key] = heap
+        return heap
+
+    def acquire(self, country=None, country_code=None, city=None,
+                min_mbps_down=None, max_connect_time=None,
+                update_usage=True, policy=None, candidates=1):
+        """Find a socks5 matching the filters. Takes the same filters as
+        Database.find_socks5
+        @param policy: A socks5man.policies.Policy that chooses from the
+         'candidates' least recently used socks5s. The least recently used
+         socks5 is chosen if not given
+        @return: A socks5 database object or None"""
+        key = self.filter_key(
+            country=country, country_code=country_code, city=city,
+            min_mbps_down=min_mbps_down, max_connect_time=max_connect_time
+        )
+        if policy is None or not policy.uses_candidates:
+            candidates = 1
+
+        with self.lock:
+            heap = self._heap(key)
+            popped = []
+            while heap and len(popped) < candidates:
+                entry = heapq.heappop(heap)
+                socks5 = entry[-1]
+                if entry[2] != socks5.last_use:
+                    heapq.heappush(heap, self._entry(socks5))
+                    continue
+                popped.append(socks5)
+
+            if not popped:
+                return None
+
+            chosen = policy.choose(popped) if policy else popped[0]
+            if update_usage:
+                chosen.last_use = datetime.now()
+                self.pending[chosen.id] = chosen.last_use
+            for socks5 in popped:
+                heapq.heappush(heap, self._entry(socks5))
+
+            return chosen
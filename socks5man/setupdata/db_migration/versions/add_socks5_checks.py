@@ -0,0 +1,72 @@
+"""add socks5 check history
+
+Revision ID: c41e8d5f2a17
+Revises: 6b7add3ba978
+Create Date: 2026-10-18 16:41:09.530118
+
+"""
+
+# Revision identifiers, used by Alembic.
+from __future__ import absolute_import
+revision = 'c41e8d5f2a17'
+down_revision = '6b7add3ba978'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        "socks5_checks",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("socks5_id", sa.Integer(), nullable=False),
+        sa.Column("checked_on", sa.DateTime(), nullable=False),
+        sa.Column("checks", sa.Integer(), nullable=False),
+        sa.Column("successes", sa.Integer(), nullable=False),
+        sa.Column("connect_time", sa.Float(), nullable=True),
+        sa.Column("bandwidth", sa.Float(), nullable=True),
+        sa.Column(
+            "downsampled", sa.Boolean(), nullable=False, server_default="0"
+        ),
+        sa.ForeignKeyConstraint(["socks5_id"], ["socks5s.id"]),
+        sa.PrimaryKeyConstraint("id")
+    )
+    op.create_index(
+        "ix_socks5_checks_socks5_id", "socks5_checks",
+        ["socks5_id", "checked_on"]
+    )
+    op.create_index(
+        "ix_socks5_checks_checked_on", "socks5_checks", ["checked_on"]
+    )
+    op.create_index(
+        "ix_socks5_checks_downsampled", "socks5_checks",
+        ["downsampled", "checked_on"]
+    )
+    op.add_column("socks5s", sa.Column("uptime", sa.Float(), nullable=True))
+    op.add_column(
+        "socks5s", sa.Column("connect_time_ewma", sa.Float(), nullable=True)
+    )
+    op.add_column(
+        "socks5s", sa.Column("connect_time_p95", sa.Float(), nullable=True)
+    )
+    for column in ("check_failures", "check_count", "check_successes"):
+        op.add_column(
+            "socks5s", sa.Column(
+                column, sa.Integer(), nullable=False, server_default="0"
+            )
+        )
+    # Start the rolling connection time average at the last measurement
+    op.execute("UPDATE socks5s SET connect_time_ewma = connect_time")
+
+
+def downgrade():
+    op.drop_column("socks5s", "check_successes")
+    op.drop_column("socks5s", "check_count")
+    op.drop_column("socks5s", "check_failures")
+    op.drop_column("socks5s", "connect_time_p95")
+    op.drop_column("socks5s", "connect_time_ewma")
+    op.drop_column("socks5s", "uptime")
+    op.drop_index("ix_socks5_checks_downsampled", "socks5_checks")
+    op.drop_index("ix_socks5_checks_checked_on", "socks5_checks")
+    op.drop_index("ix_socks5_checks_socks5_id", "socks5_checks")
+    op.drop_table("socks5_checks")
@@ -0,0 +1,25 @@
+"""add socks5 last failure
+
+Revision ID: 4d1f6b8e3a29
+Revises: e9a3b7c2d054
+Create Date: 2026-10-19 10:21:07.418935
+
+"""
+
+# Revision identifiers, used by Alembic.
+from __future__ import absolute_import
+revision = '4d1f6b8e3a29'
+down_revision = 'e9a3b7c2d054'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        "socks5s", sa.Column("last_failure", sa.DateTime(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("socks5s", "last_failure")
@@ -0,0 +1,51 @@
+"""add socks5 leases
+
+Revision ID: 6b7add3ba978
+Revises: 7b84d21a4baf
+Create Date: 2026-10-18 14:02:17.209541
+
+"""
+
+# Revision identifiers, used by Alembic.
+from __future__ import absolute_import
+revision = '6b7add3ba978'
+down_revision = '7b84d21a4baf'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        "socks5_leases",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("socks5_id", sa.Integer(), nullable=False),
+        sa.Column("acquired_on", sa.DateTime(), nullable=False),
+        sa.Column("expires_on", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["socks5_id"], ["socks5s.id"]),
+        sa.PrimaryKeyConstraint("id")
+    )
+    op.create_index(
+        "ix_socks5_leases_socks5_id", "socks5_leases",
+        ["socks5_id", "expires_on"]
+    )
+    op.create_index(
+        "ix_socks5_leases_expires_on", "socks5_leases", ["expires_on"]
+    )
+    op.add_column(
+        "socks5s", sa.Column("lease_latency", sa.Float(), nullable=True)
+    )
+    op.add_column(
+        "socks5s", sa.Column(
+            "lease_failures", sa.Integer(), nullable=False,
+            server_default="0"
+        )
+    )
+
+
+def downgrade():
+    op.drop_column("socks5s", "lease_failures")
+    op.drop_column("socks5s", "lease_latency")
+    op.drop_index("ix_socks5_leases_expires_on", "socks5_leases")
+    op.drop_index("ix_socks5_leases_socks5_id", "socks5_leases")
+    op.drop_table("socks5_leases")
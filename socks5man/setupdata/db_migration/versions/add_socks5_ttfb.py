@@ -0,0 +1,23 @@
+"""add socks5 time to first byte
+
+Revision ID: e9a3b7c2d054
+Revises: c41e8d5f2a17
+Create Date: 2026-10-18 18:12:44.806212
+
+"""
+
+# Revision identifiers, used by Alembic.
+from __future__ import absolute_import
+revision = 'e9a3b7c2d054'
+down_revision = 'c41e8d5f2a17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column("socks5s", sa.Column("ttfb", sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("socks5s", "ttfb")
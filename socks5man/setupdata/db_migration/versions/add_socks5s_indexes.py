@@ -0,0 +1,39 @@
+"""add socks5s indexes
+
+Revision ID: 7b84d21a4baf
+Revises: 2910ee00d182
+Create Date: 2026-10-18 10:12:41.503318
+
+"""
+
+# Revision identifiers, used by Alembic.
+from __future__ import absolute_import
+revision = '7b84d21a4baf'
+down_revision = '2910ee00d182'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index(
+        "ix_socks5s_acquire", "socks5s", [
+            "operational", "last_use", sa.text("last_check DESC"),
+            "connect_time", sa.text("bandwidth DESC")
+        ]
+    )
+    op.create_index(
+        "ix_socks5s_country", "socks5s", [sa.text("lower(country)")]
+    )
+    op.create_index(
+        "ix_socks5s_country_code", "socks5s",
+        [sa.text("lower(country_code)")]
+    )
+    op.create_index("ix_socks5s_city", "socks5s", [sa.text("lower(city)")])
+
+
+def downgrade():
+    op.drop_index("ix_socks5s_city", "socks5s")
+    op.drop_index("ix_socks5s_country_code", "socks5s")
+    op.drop_index("ix_socks5s_country", "socks5s")
+    op.drop_index("ix_socks5s_acquire", "socks5s")
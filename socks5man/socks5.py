@@ -1,14 +1,15 @@
 from __future__ import absolute_import
 import logging
-import socks
 import sys
-import time
+from datetime import datetime
 
+from socks5man import aiosocks5, metrics
 from socks5man.config import cfg
 from socks5man.database import Database
 from socks5man.helpers import (
-    get_over_socks5, is_ipv4, get_ipv4_hostname, approximate_bandwidth,
-    is_reserved_ipv4
+    get_over_socks5, is_ipv4, get_ipv4_hostname, measure_bandwidth,
+    is_reserved_ipv4, aget_over_socks5, ameasure_bandwidth,
+    ameasure_connect_time, get_resolver
 )
 
 log = logging.getLogger(__name__)
@@ -24,11 +25,89 @@ class Socks5(object):
     Socks5 wrapper class. Retrieve info and verify if socks
     is operational. Object is initialized with a socks5 database object by the
     manager class.
+
+    Check results are written to the database directly, unless a
+    :class:`socks5man.database.ResultBatch` is given as 'results'. The
+    results are then added to the batch, which writes them in bulk.
+
+    A Socks5 acquired with a lease can be used as a context manager. The
+    lease is released when the block exits. An exception in the block is
+    reported as a failure of the server.
+
+    :Example:
+
+    >>> from socks5man.manager import Manager
+    >>> with Manager().acquire(country="Germany", lease=True) as socks5:
+    ...     pass
     """
 
-    def __init__(self, db_socks5):
+    def __init__(self, db_socks5, results=None, lease=None):
         self.db_socks5 = db_socks5
+        self.results = results
+        self.lease = lease
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release(success=exc_type is None)
+
+    def release(self, success=True, latency=None):
+        """
+        Release the lease on this server, if it has one. The server is
+        marked as not operational after the configured amount of
+        consecutive failed leases.
+
+        :param success: False if the server failed while it was used (bool).
+        :param latency: The latency in seconds observed while using the
+            server (float). Optional.
+        """
+        if self.lease is None:
+            return
+
+        db.release_lease(
+            self.lease.id, self.id, success=success, latency=latency,
+            max_failures=cfg("leases", "max_failures")
+        )
+        self.lease = None
+
+    def _store_operational(self, operational):
+        if self.results is not None:
+            self.results.add(
+                self.id, operational=operational, last_check=datetime.now(),
+                lease_failures=0
+            )
+        else:
+            db.set_operational(self.id, operational)
+
+    def _store_connect_time(self, connect_time):
+        if self.results is not None:
+            self.results.add(self.id, connect_time=connect_time)
+        else:
+            db.set_connect_time(self.id, connect_time)
+
+    def _store_bandwidth(self, result):
+        bandwidth, ttfb = result or (None, None)
+        if self.results is not None:
+            if ttfb is None:
+                self.results.add(self.id, bandwidth=bandwidth)
+            else:
+                self.results.add(self.id, bandwidth=bandwidth, ttfb=ttfb)
+        else:
+            db.set_approx_bandwidth(self.id, bandwidth, ttfb=ttfb)
+        return bandwidth
+
+    def _bandwidth_options(self):
+        return dict(
+            username=self.username, password=self.password,
+            times=cfg("bandwidth", "times"),
+            timeout=cfg("bandwidth", "timeout"),
+            max_bytes=cfg("bandwidth", "max_bytes"),
+            max_time=cfg("bandwidth", "max_time"),
+            chunk_size=cfg("bandwidth", "chunk_size")
+        )
+
+    @metrics.timed(metrics.PROBE_DURATION, probe="operational")
     def verify(self):
         """
         Test if this socks5 can be connected to and retrieve its own
@@ -38,49 +117,85 @@ class Socks5(object):
         :returns: True if server is operational, false otherwise
         :rtype: bool
         """
-        operational = False
         ip = self.host
         if not is_ipv4(ip):
             ip = get_ipv4_hostname(ip)
 
-        try:
-            response = get_over_socks5(
-                cfg("operationality", "ip_api"), self.host, self.port,
-                username=self.username, password=self.password,
-                timeout=cfg("operationality", "timeout")
-            )
-        except AttributeError:
-            return operational
+        response = get_over_socks5(
+            cfg("operationality", "ip_api"), self.host, self.port,
+            username=self.username, password=self.password,
+            timeout=cfg("operationality", "timeout")
+        )
+        operational = self._is_operational(ip, response)
+        self._store_operational(operational)
+        return operational
 
-        if response:
-            if ip == response.decode("utf-8"):
-                operational = True
+    @metrics.timed(metrics.PROBE_DURATION, probe="operational")
+    async def verify_async(self):
+        """
+        Same as :meth:`verify`, but runs on the running asyncio event loop.
+        Use this to verify many servers concurrently.
 
-            # If a private ip is used, the api response will not match with
-            # the configured host or its ip. There was however a response,
-            # therefore we still mark it as operational
-            elif self.private or (is_reserved_ipv4(ip) and is_ipv4(response.decode("utf-8"))):
-                operational = True
+        :returns: True if server is operational, false otherwise
+        :rtype: bool
+        """
+        ip = self.host
+        if not is_ipv4(ip):
+            ip = await get_resolver().aresolve(ip)
 
-        db.set_operational(self.id, operational)
+        response = await aget_over_socks5(
+            cfg("operationality", "ip_api"), self.host, self.port,
+            username=self.username, password=self.password,
+            timeout=cfg("operationality", "timeout")
+        )
+        operational = self._is_operational(ip, response)
+        self._store_operational(operational)
         return operational
 
+    def _is_operational(self, ip, response):
+        if not response:
+            return False
+
+        if ip == response.decode("utf-8"):
+            return True
+
+        # If a private ip is used, the api response will not match with
+        # the configured host or its ip. There was however a response,
+        # therefore we still mark it as operational
+        if self.private or (
+                is_reserved_ipv4(ip) and is_ipv4(response.decode("utf-8"))
+        ):
+            return True
+
+        return False
+
+    @metrics.timed(metrics.PROBE_DURATION, probe="bandwidth")
     def approx_bandwidth(self):
         """
         Calculate an approximate Mbit/s download speed using
-        the file specified in the config to download. Automatically
-        updated in the database
+        the file specified in the config to download. The file is streamed
+        until the configured byte or time limit is reached. The speed and
+        the time to first byte are automatically updated in the database
 
         :returns: An approximate download speed in Mbit/s
         :rtype: float
         """
-        approx_bandwidth = approximate_bandwidth(
-            self.host, self.port, username=self.username,
-            password=self.password, times=cfg("bandwidth", "times"),
-            timeout=cfg("bandwidth", "timeout")
-        )
-        db.set_approx_bandwidth(self.id, approx_bandwidth)
-        return approx_bandwidth
+        return self._store_bandwidth(measure_bandwidth(
+            self.host, self.port, **self._bandwidth_options()
+        ))
+
+    @metrics.timed(metrics.PROBE_DURATION, probe="bandwidth")
+    async def approx_bandwidth_async(self):
+        """
+        Same as :meth:`approx_bandwidth`, but runs on the running asyncio
+        event loop.
+
+        :returns: An approximate download speed in Mbit/s
+        :rtype: float
+        """
+        return self._store_bandwidth(await ameasure_bandwidth(
+            self.host, self.port, **self._bandwidth_options()
+        ))
 
     def measure_connection_time(self):
         """
@@ -91,28 +206,23 @@ class Socks5(object):
         :returns: An approximate connection time in seconds
         :rtype: float
         """
-        s = socks.socksocket()
-        s.set_proxy(
-            socks.SOCKS5, self.host, self.port, username=self.username,
-            password=self.password
-        )
+        return aiosocks5.run(self.measure_connection_time_async())
 
-        s.settimeout(cfg("connection_time", "timeout"))
-        start = time.time()
-        try:
-            s.connect((
-                    cfg("connection_time", "hostname"),
-                    cfg("connection_time", "port")
-            ))
-            s.close()
-        # socket.error, socks.ProxyError
-        except Exception as e:
-            log.error("Error connecting in connection time test: %s", e)
-            connect_time = None
-        else:
-            connect_time = time.time() - start
+    @metrics.timed(metrics.PROBE_DURATION, probe="connect_time")
+    async def measure_connection_time_async(self):
+        """
+        Same as :meth:`measure_connection_time`, but runs on the running
+        asyncio event loop.
 
-        db.set_connect_time(self.id, connect_time)
+        :returns: An approximate connection time in seconds
+        :rtype: float
+        """
+        connect_time = await ameasure_connect_time(
+            self.host, self.port, cfg("connection_time", "hostname"),
+            cfg("connection_time", "port"), username=self.username,
+            password=self.password, timeout=cfg("connection_time", "timeout")
+        )
+        self._store_connect_time(connect_time)
         return connect_time
 
     def to_dict(self):
@@ -273,6 +383,97 @@ class Socks5(object):
             return self.db_socks5.description
         return None
 
+    @property
+    def lease_latency(self):
+        """
+        The average latency in seconds reported when releasing leases on
+        this server
+
+        :rtype: float
+        """
+        return self.db_socks5.lease_latency
+
+    @property
+    def lease_failures(self):
+        """
+        The amount of consecutive leases on this server that were released
+        as failed
+
+        :rtype: int
+        """
+        return self.db_socks5.lease_failures
+
+    @property
+    def last_failure(self):
+        """
+        The time of the last failed check or failed lease of this server.
+        None if it never failed
+
+        :rtype: datetime.datetime
+        """
+        return self.db_socks5.last_failure
+
+    @property
+    def ttfb(self):
+        """
+        The time in seconds until the first byte of the bandwidth test file
+        was received
+
+        :rtype: float
+        """
+        return self.db_socks5.ttfb
+
+    @property
+    def uptime(self):
+        """
+        The ratio of successful checks in the check history of this server,
+        from 0.0 to 1.0
+
+        :rtype: float
+        """
+        return self.db_socks5.uptime
+
+    @property
+    def connect_time_ewma(self):
+        """
+        The exponentially weighted moving average of the measured
+        connection times in seconds
+
+        :rtype: float
+        """
+        return self.db_socks5.connect_time_ewma
+
+    @property
+    def connect_time_p95(self):
+        """
+        The 95th percentile of the latest measured connection times in
+        seconds
+
+        :rtype: float
+        """
+        return self.db_socks5.connect_time_p95
+
+    @property
+    def check_failures(self):
+        """
+        The amount of consecutive failed operationality checks
+
+        :rtype: int
+        """
+        return self.db_socks5.check_failures
+
+    @property
+    def lease_expires_on(self):
+        """
+        The date and time the lease on this server expires. None if the
+        server was not acquired with a lease or if it was released
+
+        :rtype: DateTime
+        """
+        if self.lease is None:
+            return None
+        return self.lease.expires_on
+
     @property
     def private(self):
         """
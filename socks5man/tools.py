@@ -1,112 +1,568 @@
 from __future__ import absolute_import
+import asyncio
+import hashlib
+import heapq
+import http.client
 import logging
 import os
 import socket
-import shutil
+import tarfile
+import tempfile
+import threading
 import time
-import urllib
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from socks5man import aiosocks5, metrics
 from socks5man.config import cfg
-from socks5man.database import Database
-from socks5man.helpers import GeoInfo, is_ipv4, get_ipv4_hostname
+from socks5man.database import Database, ResultBatch
+from socks5man.helpers import GeoInfo, get_resolver
 from socks5man.misc import cwd, unpack_mmdb
 from socks5man.socks5 import Socks5
 
 log = logging.getLogger(__name__)
 db = Database()
 
-def verify_all(repeated=False, operational=None, unverified=None):
+class BandwidthState(object):
+    """Keeps track of when the bandwidth of servers was last measured and if
+    the configured test file is reachable. Shared by all verification
+    workers of a single verify_all run."""
 
-    last_bandwidth = None
-    bandwidth_checked = False
-    download_verified = False
-    if repeated:
-        log.info("Starting continuous verification")
+    def __init__(self):
+        self.last_bandwidth = None
+        self.bandwidth_checked = False
+        self.download_verified = False
+        self.lock = threading.Lock()
+
+    def due(self):
+        """Returns True if the bandwidth interval has passed"""
+        if not self.last_bandwidth:
+            return True
+
+        waited = time.time() - self.last_bandwidth
+        return waited >= cfg("socks5man", "bandwidth_interval")
+
+    def verify_download(self):
+        """Verify the speed test file can be downloaded. Only one worker
+        performs the check at a time and a successful check is remembered"""
+        with self.lock:
+            if self.download_verified:
+                return True
+
+            download_url = cfg("bandwidth", "download_url")
+            try:
+                urllib.request.urlopen(download_url, timeout=5)
+                self.download_verified = True
+            except (socket.error, urllib.error.URLError) as e:
+                log.error(
+                    "Failed to download speed test file: '%s'. Please"
+                    " verify the configured file is still online!"
+                    " Without this file, it is not possible to"
+                    " approximate the bandwidth of a socsk5 server."
+                    " Error: %s", download_url, e
+                )
 
-    while True:
-        socks5_list = db.list_socks5(
-            operational=operational, unverified=unverified
+            return self.download_verified
+
+    def pass_done(self):
+        """Should be called after each verification pass"""
+        if self.bandwidth_checked:
+            self.bandwidth_checked = False
+            self.last_bandwidth = time.time()
+
+def _operational_result(socks5, operational):
+    metrics.VERIFICATIONS.inc(
+        result="operational" if operational else "failed"
+    )
+    if operational:
+        log.info("Operationality check: OK")
+    else:
+        log.warning(
+            "Operationality check (%s:%s): FAILED",
+            socks5.host, socks5.port
         )
-        log.debug("Verifying %s socks5 servers", len(socks5_list))
-        for socks5 in socks5_list:
-            socks5 = Socks5(socks5)
+    return operational
 
-            log.info(
-                "Testing socks5 server: '%s:%s'", socks5.host, socks5.port
-            )
-            if socks5.verify():
-                log.info("Operationality check: OK")
-            else:
-                log.warning(
-                    "Operationality check (%s:%s): FAILED",
+def _connect_time_result(socks5, con_time):
+    if con_time:
+        log.debug("Measured connection time: %s", con_time)
+    else:
+        log.warning(
+            "Connection time measurement failed for: '%s:%s'",
+            socks5.host, socks5.port
+        )
+    return con_time
+
+def _bandwidth_result(socks5, bandwidth):
+    if bandwidth:
+        log.debug(
+            "Approximate bandwidth: %s Mbit/s down", bandwidth
+        )
+    else:
+        log.warning(
+            "Bandwidth approximation test failed for: '%s:%s'",
+            socks5.host, socks5.port
+        )
+    return bandwidth
+
+def verify_socks5(socks5, bandwidth_state):
+    """Perform the operationality, connection time and bandwidth checks
+    for a single socks5 server.
+    @param socks5: A socks5man.socks5.Socks5 object
+    @param bandwidth_state: The BandwidthState of the current run
+    @return: True if the socks5 server is operational"""
+    log.info(
+        "Testing socks5 server: '%s:%s'", socks5.host, socks5.port
+    )
+    if not _operational_result(socks5, socks5.verify()):
+        return False
+
+    if cfg("connection_time", "enabled"):
+        if not _connect_time_result(
+                socks5, socks5.measure_connection_time()
+        ):
+            return True
+
+    if cfg("bandwidth", "enabled"):
+        if not bandwidth_state.due():
+            return True
+
+        if not bandwidth_state.verify_download():
+            return True
+
+        bandwidth_state.bandwidth_checked = True
+        _bandwidth_result(socks5, socks5.approx_bandwidth())
+
+    return True
+
+async def averify_socks5(socks5, bandwidth_state):
+    """Same as verify_socks5, but uses the asynchronous checks of the
+    socks5 server so many servers can be verified on one event loop"""
+    log.info(
+        "Testing socks5 server: '%s:%s'", socks5.host, socks5.port
+    )
+    if not _operational_result(socks5, await socks5.verify_async()):
+        return False
+
+    if cfg("connection_time", "enabled"):
+        if not _connect_time_result(
+                socks5, await socks5.measure_connection_time_async()
+        ):
+            return True
+
+    if cfg("bandwidth", "enabled"):
+        if not bandwidth_state.due():
+            return True
+
+        loop = asyncio.get_event_loop()
+        if not await loop.run_in_executor(
+                None, bandwidth_state.verify_download
+        ):
+            return True
+
+        bandwidth_state.bandwidth_checked = True
+        _bandwidth_result(socks5, await socks5.approx_bandwidth_async())
+
+    return True
+
+async def averify_many(socks5_list, bandwidth_state, workers):
+    """Verify all given socks5 servers with at most 'workers' servers
+    being verified at the same time"""
+    semaphore = asyncio.Semaphore(workers)
+
+    async def _verify(socks5):
+        async with semaphore:
+            try:
+                await averify_socks5(socks5, bandwidth_state)
+            except Exception:
+                log.exception(
+                    "Unexpected error verifying socks5 server: '%s:%s'",
                     socks5.host, socks5.port
                 )
+
+    await asyncio.gather(*[_verify(socks5) for socks5 in socks5_list])
+
+def compact_history():
+    """Remove and downsample old check history, as configured in the
+    [history] config section"""
+    deleted, downsampled = db.compact_checks(
+        retention=cfg("history", "retention"),
+        downsample_after=cfg("history", "downsample_after"),
+        interval=cfg("history", "downsample_interval")
+    )
+    log.debug(
+        "Removed %s and downsampled %s check history entries", deleted,
+        downsampled
+    )
+
+def _timestamp(value):
+    return time.mktime(value.timetuple()) if value else None
+
+class Schedule(object):
+    """The verification schedule of a single socks5 server"""
+
+    def __init__(self, socks5, flap_window):
+        self.socks5 = socks5
+        self.next_due = 0
+        self.last_check = None
+        self.last_use = _timestamp(socks5.last_use)
+        self.last_bandwidth = None
+        # Consecutive failed and successful checks
+        self.failures = 0
+        self.successes = 0
+        self.results = deque(maxlen=flap_window)
+        # Heap entries with an older version are outdated
+        self.version = 0
+        self.checking = False
+
+    @property
+    def changes(self):
+        """The amount of times the operationality changed in the latest
+        checks"""
+        results = list(self.results)
+        return sum(1 for a, b in zip(results, results[1:]) if a != b)
+
+    def record(self, operational, now):
+        self.last_check = now
+        self.results.append(operational)
+        if operational:
+            self.successes += 1
+            self.failures = 0
+        else:
+            self.failures += 1
+            self.successes = 0
+
+class ScheduledBandwidth(object):
+    """Used as the bandwidth state of a single scheduled check. The
+    bandwidth of each socks5 server is measured once every
+    bandwidth_interval seconds."""
+
+    def __init__(self, state, schedule):
+        self.state = state
+        self.schedule = schedule
+
+    def due(self):
+        if not self.schedule.last_bandwidth:
+            return True
+
+        waited = time.time() - self.schedule.last_bandwidth
+        return waited >= cfg("socks5man", "bandwidth_interval")
+
+    def verify_download(self):
+        return self.state.verify_download()
+
+    @property
+    def bandwidth_checked(self):
+        return self.schedule.last_bandwidth is not None
+
+    @bandwidth_checked.setter
+    def bandwidth_checked(self, checked):
+        if checked:
+            self.schedule.last_bandwidth = time.time()
+
+class VerifyScheduler(object):
+    """Continuously verifies socks5 servers, each when it is due. The
+    schedules are kept in a heap ordered by the time they are due.
+
+    Operational servers are checked every verify_interval seconds. The
+    interval of servers that stay operational grows up to
+    'stable_interval'. Servers that were recently acquired or of which
+    the operationality keeps changing are checked every 'min_interval'
+    seconds. The interval of servers that are not operational is
+    multiplied by 'backoff_factor' after each failed check, up to
+    'max_interval'. The list of servers is read from the database every
+    'refresh_interval' seconds to find added, removed and acquired
+    servers."""
+
+    def __init__(self, operational=None, unverified=None, workers=None,
+                 results=None, bandwidth_state=None):
+        self.operational = operational
+        self.unverified = unverified
+        self.workers = max(1, workers or cfg("socks5man", "verify_workers"))
+        self.results = results or ResultBatch(
+            size=cfg("socks5man", "result_batch_size"),
+            interval=cfg("socks5man", "result_flush_interval")
+        )
+        self.bandwidth_state = bandwidth_state or BandwidthState()
+        self.verify_interval = cfg("socks5man", "verify_interval")
+        self.min_interval = cfg("scheduler", "min_interval")
+        self.max_interval = cfg("scheduler", "max_interval")
+        self.stable_interval = cfg("scheduler", "stable_interval")
+        self.stable_checks = cfg("scheduler", "stable_checks")
+        self.backoff_factor = cfg("scheduler", "backoff_factor")
+        self.flap_window = cfg("scheduler", "flap_window")
+        self.recent_use = cfg("scheduler", "recent_use")
+        self.refresh_interval = cfg("scheduler", "refresh_interval")
+        self.compact_interval = cfg("history", "compact_interval")
+        self.schedules = {}
+        self.heap = []
+        self._stopped = False
+
+    def _backoff(self, exponent, maximum):
+        return min(
+            self.verify_interval * self.backoff_factor ** min(exponent, 64),
+            maximum
+        )
+
+    def recently_used(self, schedule, now):
+        return schedule.last_use is not None and \
+            now - schedule.last_use < self.recent_use
+
+    def interval(self, schedule, now):
+        """The time in seconds after the last check the given socks5 server
+        should be checked again"""
+        if schedule.changes >= 2:
+            return self.min_interval
+        if schedule.failures:
+            return self._backoff(schedule.failures - 1, self.max_interval)
+        if self.recently_used(schedule, now):
+            return self.min_interval
+        if not self.stable_checks:
+            return self.verify_interval
+        return max(self._backoff(
+            schedule.successes // self.stable_checks, self.stable_interval
+        ), self.verify_interval)
+
+    def push(self, schedule, next_due):
+        schedule.version += 1
+        schedule.next_due = next_due
+        heapq.heappush(
+            self.heap, (next_due, schedule.socks5.id, schedule.version)
+        )
+
+    def load(self):
+        """Read the socks5 servers to verify from the database and resolve
+        their hostnames"""
+        socks5s = db.list_socks5(
+            operational=self.operational, unverified=self.unverified
+        )
+        get_resolver().resolve_many(set(s.host for s in socks5s))
+        return socks5s
+
+    def refresh(self, socks5s=None, now=None):
+        """Update the schedules with the given or loaded socks5 servers. New
+        servers are scheduled using their last check. Servers that were
+        acquired since the previous refresh are checked sooner"""
+        now = now or time.time()
+        if socks5s is None:
+            socks5s = self.load()
+        current = {}
+        for socks5 in socks5s:
+            schedule = self.schedules.get(socks5.id)
+            if not schedule:
+                schedule = Schedule(socks5, self.flap_window)
+                last_check = _timestamp(socks5.last_check)
+                if last_check:
+                    schedule.record(socks5.operational, last_check)
+                    next_due = last_check + self.interval(schedule, now)
+                else:
+                    next_due = now
+                self.push(schedule, next_due)
+                current[socks5.id] = schedule
+                continue
+
+            current[socks5.id] = schedule
+            schedule.socks5 = socks5
+            last_use = _timestamp(socks5.last_use)
+            if last_use == schedule.last_use:
                 continue
 
-            if cfg("connection_time", "enabled"):
-                con_time = socks5.measure_connection_time()
-                if con_time:
-                    log.debug("Measured connection time: %s", con_time)
+            schedule.last_use = last_use
+            if schedule.checking or not self.recently_used(schedule, now):
+                continue
+
+            next_due = (schedule.last_check or now) + self.interval(
+                schedule, now
+            )
+            if next_due < schedule.next_due:
+                self.push(schedule, next_due)
+
+        self.schedules = current
+        log.debug("Scheduling verification of %s socks5 servers", len(current))
+
+    def _valid(self, entry):
+        _, socks5_id, version = entry
+        schedule = self.schedules.get(socks5_id)
+        return schedule is not None and schedule.version == version
+
+    def next_due(self):
+        """The time the next socks5 server is due, or None"""
+        while self.heap and not self._valid(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        """Return the schedule of the socks5 server that is due first or
+        None if no server is due yet"""
+        now = now or time.time()
+        next_due = self.next_due()
+        if next_due is None or next_due > now:
+            return None
+
+        _, socks5_id, _ = heapq.heappop(self.heap)
+        schedule = self.schedules[socks5_id]
+        schedule.checking = True
+        return schedule
+
+    def record(self, schedule, operational, now=None):
+        """Store the result of a check and schedule the next check"""
+        now = now or time.time()
+        schedule.checking = False
+        schedule.record(operational, now)
+        if self.schedules.get(schedule.socks5.id) is schedule:
+            self.push(schedule, now + self.interval(schedule, now))
+
+    async def check(self, schedule):
+        socks5 = Socks5(schedule.socks5, results=self.results)
+        try:
+            operational = await averify_socks5(
+                socks5, ScheduledBandwidth(self.bandwidth_state, schedule)
+            )
+        except Exception:
+            log.exception(
+                "Unexpected error verifying socks5 server: '%s:%s'",
+                socks5.host, socks5.port
+            )
+            operational = False
+        self.record(schedule, operational)
+
+    def stop(self):
+        """Stop after the running checks are done"""
+        self._stopped = True
+
+    async def run(self):
+        """Keep verifying due socks5 servers until stop() is called"""
+        self._stopped = False
+        loop = asyncio.get_event_loop()
+        checks = set()
+        next_refresh = 0
+        next_compact = 0
+        try:
+            while not self._stopped:
+                now = time.time()
+                if now >= next_refresh:
+                    self.refresh(await loop.run_in_executor(None, self.load))
+                    next_refresh = now + self.refresh_interval
+                if now >= next_compact:
+                    await loop.run_in_executor(None, compact_history)
+                    next_compact = now + self.compact_interval
+
+                while len(checks) < self.workers:
+                    schedule = self.pop_due()
+                    if not schedule:
+                        break
+                    checks.add(asyncio.ensure_future(self.check(schedule)))
+
+                if len(checks) < self.workers:
+                    self.results.flush()
+                    wakeup = min(self.next_due() or next_refresh, next_refresh)
                 else:
-                    log.warning(
-                        "Connection time measurement failed for: '%s:%s'",
-                        socks5.host, socks5.port
-                    )
-                    continue
+                    wakeup = next_refresh
+                timeout = max(0, wakeup - time.time())
 
-            if cfg("bandwidth", "enabled"):
-                if last_bandwidth:
-                    waited = time.time() - last_bandwidth
-                    if waited < cfg("socks5man", "bandwidth_interval"):
-                        continue
-
-                if not download_verified:
-                    download_url = cfg("bandwidth", "download_url")
-                    try:
-                        urllib.request.urlopen(download_url, timeout=5)
-                        download_verified = True
-                    except (socket.error, urllib.error.URLError) as e:
-                        log.error(
-                            "Failed to download speed test file: '%s'. Please"
-                            " verify the configured file is still online!"
-                            " Without this file, it is not possible to"
-                            " approximate the bandwidth of a socsk5 server."
-                            " Error: %s", download_url, e
-                        )
-                        continue
-
-                bandwidth_checked = True
-                bandwidth = socks5.approx_bandwidth()
-                if bandwidth:
-                    log.debug(
-                        "Approximate bandwidth: %s Mbit/s down", bandwidth
+                if checks:
+                    _, checks = await asyncio.wait(
+                        checks, timeout=timeout,
+                        return_when=asyncio.FIRST_COMPLETED
                     )
                 else:
-                    log.warning(
-                        "Bandwidth approximation test failed for: '%s:%s'",
-                        socks5.host, socks5.port
-                    )
+                    await asyncio.sleep(timeout)
+        finally:
+            for task in checks:
+                task.cancel()
+            await asyncio.gather(*checks, return_exceptions=True)
+            self.results.flush()
 
-        if bandwidth_checked:
-            bandwidth_checked = False
-            last_bandwidth = time.time()
+def verify_all(repeated=False, operational=None, unverified=None,
+               workers=None):
+    """Verify all socks5 servers matching the given filters.
+    @param repeated: Keep verifying each server when it is due, using
+    the VerifyScheduler
+    @param workers: The amount of servers that are verified concurrently.
+    Uses the configured verify_workers if not provided."""
+    if not workers:
+        workers = cfg("socks5man", "verify_workers")
+    workers = max(1, workers)
 
-        if not repeated:
-            break
+    bandwidth_state = BandwidthState()
+    results = ResultBatch(
+        size=cfg("socks5man", "result_batch_size"),
+        interval=cfg("socks5man", "result_flush_interval")
+    )
+    if repeated:
+        log.info("Starting continuous verification")
+        scheduler = VerifyScheduler(
+            operational=operational, unverified=unverified, workers=workers,
+            results=results, bandwidth_state=bandwidth_state
+        )
+        try:
+            aiosocks5.run(scheduler.run())
+        finally:
+            results.flush()
+        return
 
-        time.sleep(cfg("socks5man", "verify_interval"))
+    socks5_list = db.list_socks5(
+        operational=operational, unverified=unverified
+    )
+    log.debug(
+        "Verifying %s socks5 servers using %s worker(s)",
+        len(socks5_list), workers
+    )
+    get_resolver().resolve_many(set(s.host for s in socks5_list))
+    try:
+        if workers == 1:
+            for socks5 in socks5_list:
+                verify_socks5(
+                    Socks5(socks5, results=results), bandwidth_state
+                )
+        else:
+            aiosocks5.run(averify_many(
+                [Socks5(s, results=results) for s in socks5_list],
+                bandwidth_state, workers
+            ))
+    finally:
+        results.flush()
+
+    bandwidth_state.pass_done()
+    compact_history()
+
+def download(url, fileobj, chunk_size=65536):
+    """Stream the contents of the URL to the file object while calculating
+    its md5
+    @return: The md5 hexdigest of the downloaded data"""
+    hash_md5 = hashlib.md5()
+    response = urllib.request.urlopen(url)
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            hash_md5.update(chunk)
+            fileobj.write(chunk)
+    finally:
+        response.close()
+
+    return hash_md5.hexdigest()
 
 def update_geodb():
+    """Download and use the latest geodb if its version differs from the
+    current version. The download is streamed to a temporary file and the
+    new .mmdb file replaces the current one in a single rename. Running
+    processes reopen the geodb when they notice the file was replaced."""
     version_file = cwd("geodb", ".version")
     if not os.path.isfile(version_file):
         log.error("No geodb version file '%s' is missing", version_file)
         return
 
-    with open(version_file, "rb") as fp:
-        current_version = fp.read()
+    with open(version_file, "r") as fp:
+        current_version = fp.read().strip()
 
     try:
-        latest_version = urllib.request.urlopen(cfg("geodb", "geodb_md5_url")).read()
+        latest_version = urllib.request.urlopen(
+            cfg("geodb", "geodb_md5_url")
+        ).read().decode("utf-8", "replace").strip()
     except urllib.error.URLError as e:
         log.error("Error retrieving latest geodb version hash: %s", e)
         return
@@ -115,61 +571,105 @@ def update_geodb():
         log.info("GeoIP database at latest version")
         return
 
-    extracted = cwd("geodb", "extracted")
-    renamed = None
-    if os.path.exists(extracted):
-        renamed = cwd("geodb", "old-extracted")
-        os.rename(extracted, renamed)
-
+    url = cfg("geodb", "geodb_url")
+    # Read before the geodb is replaced, so a config error cannot leave the
+    # servers annotated with the geo IP info of the previous geodb
+    chunk_size = cfg("geodb", "update_chunk_size")
+    log.info("Downloading latest version: '%s'", url)
+    fd, download_path = tempfile.mkstemp(
+        suffix=".download", dir=cwd("geodb")
+    )
     try:
-        url = cfg("geodb", "geodb_url")
-        log.info("Downloading latest version: '%s'", url)
-        mmdbtar = urllib.request.urlopen(url).read()
-    except urllib.error.URLError as e:
+        with os.fdopen(fd, "wb") as fw:
+            digest = download(url, fw)
+
+        if digest != latest_version:
+            log.error(
+                "Downloaded geodb md5 '%s' does not match the latest version"
+                " '%s'. Keeping the current version", digest, latest_version
+            )
+            return
+
+        extracted = cwd("geodb", "extracted")
+        if not os.path.isdir(extracted):
+            os.makedirs(extracted)
+
+        if not unpack_mmdb(
+                download_path, os.path.join(extracted, "geodblite.mmdb"),
+                version=digest
+        ):
+            log.error("No .mmdb file in downloaded geodb tar '%s'", url)
+            return
+
+        # Keep the tar, so a new cwd can be created from it
+        os.replace(download_path, cwd("geodb", "geodblite.tar.gz"))
+    except (urllib.error.URLError, http.client.HTTPException, OSError,
+            tarfile.TarError) as e:
         log.error(
             "Failed to download new mmdb tar. Is the URL correct? %s", e
         )
-        if renamed:
-            log.error("Restoring old version..")
-            os.rename(renamed, extracted)
         return
+    finally:
+        if os.path.exists(download_path):
+            os.remove(download_path)
 
-    tarpath = cwd("geodb", "geodblite.tar.gz")
-    with open(tarpath, "wb") as fw:
-        fw.write(mmdbtar)
+    log.info("Version update complete")
+    log.info("Updating geo IP information for all existing servers")
+    reannotate_geoinfo(chunk_size)
 
-    os.mkdir(extracted)
+def reannotate_geoinfo(chunk_size=None):
+    """Update the country, country code and city of all socks5 servers
+    using the current geodb. Servers are read in chunks. While a chunk is
+    looked up and written, the next chunk is read and its hostnames are
+    resolved in another thread. Only changed servers are written, using one
+    transaction per chunk.
+    @param chunk_size: The amount of servers per chunk. Uses
+    update_chunk_size of the geodb config if not provided.
+    @return: The amount of servers of which the geo IP info changed"""
+    if not chunk_size:
+        chunk_size = cfg("geodb", "update_chunk_size")
 
-    unpack_mmdb(tarpath, cwd("geodb", "extracted", "geodblite.mmdb"))
-    log.info("Version update complete")
+    GeoInfo.reset()
+    resolver = get_resolver()
+    chunks = db.iter_socks5_geoinfo(chunk_size)
 
-    if renamed:
-        log.debug("Removing old version")
-        shutil.rmtree(renamed)
+    def read_chunk():
+        rows = next(chunks, None)
+        if not rows:
+            return None
 
-    log.info("Updating geo IP information for all existing servers")
-    GeoInfo.georeader = None
-    for socks5 in db.list_socks5():
-        log.debug(
-            "Updating server: '%s'. Current country: %s",
-            socks5.host, socks5.country
-        )
-        ip = socks5.host
-        if not is_ipv4(ip):
-            ip = get_ipv4_hostname(ip)
+        ips = resolver.resolve_many(set(row.host for row in rows))
+        return rows, [ips.get(row.host) for row in rows]
 
-        geoinfo = GeoInfo.ipv4info(ip)
-        old = (socks5.country, socks5.country_code, socks5.city)
-        new = (geoinfo["country"], geoinfo["country_code"], geoinfo["city"])
-        if old == new:
-            log.debug("Geo IP info unchanged")
-            continue
+    changed = 0
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(read_chunk)
+        while True:
+            chunk = future.result()
+            if not chunk:
+                break
 
-        log.debug(
-            "Geo IP info changed. New country=%s, country_code=%s, city=%s",
-            geoinfo["country"], geoinfo["country_code"], geoinfo["city"]
-        )
-        db.update_geoinfo(
-            socks5.id, country=geoinfo["country"],
-            country_code=geoinfo["country_code"], city=geoinfo["city"]
-        )
+            future = pool.submit(read_chunk)
+            rows, ips = chunk
+            changes = []
+            for row, geoinfo in zip(rows, GeoInfo.ipv4info_many(ips)):
+                new = (
+                    geoinfo["country"], geoinfo["country_code"],
+                    geoinfo["city"]
+                )
+                if (row.country, row.country_code, row.city) == new:
+                    continue
+
+                changes.append({
+                    "id": row.id, "country": new[0], "country_code": new[1],
+                    "city": new[2]
+                })
+
+            db.bulk_update_geoinfo(changes)
+            changed += len(changes)
+            log.debug(
+                "Updated geo IP info of %s of %s servers up to id %s",
+                len(changes), len(rows), rows[-1].id
+            )
+
+    return changed
@@ -1,8 +1,12 @@
 from __future__ import absolute_import
+import asyncio
 import os
 import shutil
+import struct
 import tempfile
 
+from socks5man import aiosocks5
+
 
 class CleanedTempFile(object):
 
@@ -28,3 +32,75 @@ class CleanedTempFile(object):
         fd, path = tempfile.mkstemp()
         self.files.append(path)
         return fd, path
+
+
+class FakeSocks5(object):
+    """In-process socks5 server that answers every CONNECT itself with the
+    configured raw HTTP response"""
+
+    def __init__(self, response=b"", username=None, password=None,
+                 reply=0x00):
+        self.response = response
+        self.username = username
+        self.password = password
+        self.reply = reply
+        self.requests = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, "127.0.0.1", 0
+        )
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            _, nmethods = await reader.readexactly(2)
+            methods = await reader.readexactly(nmethods)
+            if self.username:
+                if aiosocks5.AUTH_USERPASS not in methods:
+                    writer.write(b"\x05\xff")
+                    return
+                writer.write(b"\x05\x02")
+                _, ulen = await reader.readexactly(2)
+                user = await reader.readexactly(ulen)
+                plen = (await reader.readexactly(1))[0]
+                passwd = await reader.readexactly(plen)
+                if (user.decode(), passwd.decode()) != (
+                        self.username, self.password
+                ):
+                    writer.write(b"\x01\x01")
+                    return
+                writer.write(b"\x01\x00")
+            else:
+                writer.write(b"\x05\x00")
+
+            _, cmd, _, atyp = await reader.readexactly(4)
+            if atyp == aiosocks5.ATYP_IPV4:
+                host = ".".join(str(b) for b in await reader.readexactly(4))
+            else:
+                length = (await reader.readexactly(1))[0]
+                host = (await reader.readexactly(length)).decode()
+            port = struct.unpack("!H", await reader.readexactly(2))[0]
+            self.requests.append((cmd, host, port))
+
+            writer.write(
+                struct.pack("!BBBB4sH", 5, self.reply, 0, 1, b"\x00" * 4, 0)
+            )
+            if self.reply != 0x00:
+                return
+
+            request = b""
+            while not request.endswith(b"\r\n\r\n"):
+                data = await reader.read(1024)
+                if not data:
+                    return
+                request += data
+            self.requests.append(request)
+            writer.write(self.response)
+            await writer.drain()
+        finally:
+            writer.close()
@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+import mock
+import pytest
+
+from socks5man import aiosocks5, helpers
+from socks5man.exceptions import Socks5ClientError
+from tests.helpers import FakeSocks5
+
+def run_with_server(fake, func):
+    async def _run():
+        port = await fake.start()
+        try:
+            return await func(port)
+        finally:
+            fake.stop()
+
+    return aiosocks5.run(_run())
+
+def test_http_get():
+    fake = FakeSocks5(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\n8.8.8.8"
+    )
+    res = run_with_server(fake, lambda port: aiosocks5.http_get(
+        "http://api.example.com/ip?format=text", "127.0.0.1", port
+    ))
+    assert res == b"8.8.8.8"
+    assert fake.requests[0] == (aiosocks5.CMD_CONNECT, "api.example.com", 80)
+    assert fake.requests[1].startswith(
+        b"GET /ip?format=text HTTP/1.1\r\nHost: api.example.com\r\n"
+    )
+
+def test_http_get_chunked():
+    fake = FakeSocks5(
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"4\r\nmany\r\n5\r\n doge\r\n0\r\n\r\n"
+    )
+    res = run_with_server(fake, lambda port: aiosocks5.http_get(
+        "http://10.0.0.1:8080/", "127.0.0.1", port
+    ))
+    assert res == b"many doge"
+    assert fake.requests[0] == (aiosocks5.CMD_CONNECT, "10.0.0.1", 8080)
+
+def test_http_get_until_close():
+    fake = FakeSocks5(b"HTTP/1.0 200 OK\r\n\r\nsuch wow")
+    res = run_with_server(fake, lambda port: aiosocks5.http_get(
+        "http://example.com", "127.0.0.1", port
+    ))
+    assert res == b"such wow"
+
+def test_http_get_error_status():
+    fake = FakeSocks5(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+    with pytest.raises(Socks5ClientError):
+        run_with_server(fake, lambda port: aiosocks5.http_get(
+            "http://example.com", "127.0.0.1", port
+        ))
+
+def test_http_get_header_too_long():
+    fake = FakeSocks5(
+        b"HTTP/1.1 200 OK\r\nX-Doge: " + b"a" * 70000 + b"\r\n\r\nwow"
+    )
+    with pytest.raises(Socks5ClientError):
+        run_with_server(fake, lambda port: aiosocks5.http_get(
+            "http://example.com", "127.0.0.1", port
+        ))
+    assert run_with_server(fake, lambda port: helpers.aget_over_socks5(
+        "http://example.com", "127.0.0.1", port
+    )) is None
+
+def test_http_open_invalid_content_length():
+    fake = FakeSocks5(b"HTTP/1.1 200 OK\r\nContent-Length: many\r\n\r\n")
+    writers = []
+    open_connection = aiosocks5.open_connection
+
+    async def _open_connection(*args, **kwargs):
+        reader, writer = await open_connection(*args, **kwargs)
+        writers.append(writer)
+        return reader, writer
+
+    with mock.patch(
+            "socks5man.aiosocks5.open_connection", _open_connection
+    ):
+        with pytest.raises(Socks5ClientError):
+            run_with_server(fake, lambda port: aiosocks5.http_open(
+                "http://example.com", "127.0.0.1", port
+            ))
+    assert writers[0].is_closing()
+
+def test_auth():
+    fake = FakeSocks5(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nwow",
+        username="doge", password="suchpass"
+    )
+    res = run_with_server(fake, lambda port: aiosocks5.http_get(
+        "http://example.com", "127.0.0.1", port, username="doge",
+        password="suchpass"
+    ))
+    assert res == b"wow"
+
+def test_auth_fail():
+    fake = FakeSocks5(username="doge", password="suchpass")
+    with pytest.raises(Socks5ClientError):
+        run_with_server(fake, lambda port: aiosocks5.http_get(
+            "http://example.com", "127.0.0.1", port, username="doge",
+            password="wrong"
+        ))
+
+def test_auth_required():
+    fake = FakeSocks5(username="doge", password="suchpass")
+    with pytest.raises(Socks5ClientError):
+        run_with_server(fake, lambda port: aiosocks5.http_get(
+            "http://example.com", "127.0.0.1", port
+        ))
+
+def test_connect_refused_reply():
+    fake = FakeSocks5(reply=0x05)
+    with pytest.raises(Socks5ClientError):
+        run_with_server(fake, lambda port: aiosocks5.connect(
+            "127.0.0.1", port, "example.com", 80
+        ))
+
+def test_encode_address():
+    assert aiosocks5.encode_address("8.8.8.8", 80) == (
+        b"\x01\x08\x08\x08\x08\x00\x50"
+    )
+    assert aiosocks5.encode_address("example.com", 443) == (
+        b"\x03\x0bexample.com\x01\xbb"
+    )
+    assert aiosocks5.encode_address("::1", 80)[0] == aiosocks5.ATYP_IPV6
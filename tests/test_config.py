@@ -3,7 +3,7 @@ import os
 import copy
 import pytest
 
-from socks5man.config import Config, cfg, confbool
+from socks5man.config import Config, cfg, cfg_default, confbool
 from socks5man.database import Database
 from socks5man.exceptions import Socks5ConfigError
 from socks5man.misc import set_cwd, create_cwd, cwd
@@ -33,6 +33,20 @@ class TestConfig(object):
         create_cwd(cwd())
         assert isinstance(cfg("socks5man", "verify_interval"), int)
         assert isinstance(cfg("socks5man", "bandwidth_interval"), int)
+        assert isinstance(cfg("socks5man", "verify_workers"), int)
+        assert isinstance(cfg("socks5man", "result_batch_size"), int)
+        assert isinstance(cfg("socks5man", "result_flush_interval"), int)
+        assert cfg("socks5man", "policy") == "round_robin"
+        assert cfg("socks5man", "policy_candidates") == 16
+        assert cfg("scheduler", "min_interval") == 60
+        assert cfg("scheduler", "backoff_factor") == 2.0
+        assert isinstance(cfg("scheduler", "max_interval"), int)
+        assert cfg("history", "retention") == 2592000
+        assert isinstance(cfg("history", "downsample_interval"), int)
+        assert cfg("geodb", "update_chunk_size") == 10000
+        assert cfg("metrics", "enabled") is False
+        assert cfg("metrics", "port") == 9478
+        assert cfg("metrics", "textfile") == ""
         assert isinstance(cfg("operationality", "ip_api"), (str))
         assert isinstance(cfg("operationality", "timeout"), int)
         assert isinstance(cfg("connection_time", "enabled"), bool)
@@ -43,8 +57,13 @@ class TestConfig(object):
         assert isinstance(cfg("bandwidth", "download_url"), (str))
         assert isinstance(cfg("bandwidth", "times"), int)
         assert isinstance(cfg("bandwidth", "timeout"), int)
+        assert cfg("bandwidth", "max_bytes") == 5000000
+        assert isinstance(cfg("bandwidth", "chunk_size"), int)
         assert isinstance(cfg("geodb", "geodb_url"), (str))
         assert isinstance(cfg("geodb", "geodb_md5_url"), (str))
+        assert isinstance(cfg("dns", "cache_ttl"), int)
+        assert isinstance(cfg("dns", "negative_ttl"), int)
+        assert isinstance(cfg("dns", "workers"), int)
 
     def test_cfg_values(self):
         create_cwd(cwd())
@@ -68,6 +87,39 @@ class TestConfig(object):
         Config._cache["operationality"]["ip_api"] = "http://example.com"
         assert cfg("operationality", "ip_api") == "http://example.com"
 
+    def test_set_cwd_clears_cache(self):
+        create_cwd(cwd())
+        assert cfg("socks5man", "verify_interval") == 300
+        set_cwd(self.tempfile.mkdtemp())
+        assert Config._cache == {}
+        create_cwd(cwd())
+        with open(cwd("conf", "socks5man.conf"), "w") as fw:
+            fw.write("[socks5man]\nverify_interval = 100\n")
+        assert cfg("socks5man", "verify_interval") == 100
+
+    def test_cfg_missing_options(self):
+        create_cwd(cwd())
+        Config._cache = {}
+        with open(cwd("conf", "socks5man.conf"), "w") as fw:
+            fw.write(
+                "[socks5man]\nverify_interval = 100\n\n"
+                "[operationality]\nip_api = http://example.com\n"
+            )
+        assert cfg("socks5man", "verify_interval") == 100
+        assert cfg("operationality", "ip_api") == "http://example.com"
+        assert cfg("operationality", "timeout") == 3
+        assert cfg("socks5man", "verify_workers") == 10
+        assert cfg("metrics", "enabled") is False
+        assert cfg("database", "journal_mode") == "wal"
+
+    def test_cfg_default(self):
+        create_cwd(cwd())
+        os.remove(cwd("conf", "socks5man.conf"))
+        assert cfg_default("database", "journal_mode") == "wal"
+        assert cfg_default("socks5man", "policy") == "round_robin"
+        with pytest.raises(Socks5ConfigError):
+            cfg_default("socks5man", "nonexistingkeystuffdogestosti")
+
     def test_missing_conf(self):
         create_cwd(cwd())
         os.remove(cwd("conf", "socks5man.conf"))
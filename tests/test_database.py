@@ -1,13 +1,39 @@
 from __future__ import absolute_import
+import subprocess
+import sys
+import threading
 import time
+from datetime import datetime, timedelta
 
 import pytest
 
-from socks5man.database import Database, AlembicVersion, SCHEMA_VERSION
+from socks5man.database import (
+    Database, AlembicVersion, SCHEMA_VERSION, ResultBatch, Socks5Lease,
+    Socks5Check, EXPORT_COLUMNS, percentile
+)
 from socks5man.exceptions import Socks5manDatabaseError
-from socks5man.misc import set_cwd
+from socks5man.misc import set_cwd, cwd
 from tests.helpers import CleanedTempFile
 
+VERIFIER_SCRIPT = """
+import os
+import sys
+from datetime import datetime
+from socks5man.database import Database
+from socks5man.misc import set_cwd, cwd
+
+set_cwd(sys.argv[1])
+ids = [int(i) for i in sys.argv[2].split(",")]
+db = Database()
+print("started")
+sys.stdout.flush()
+while not os.path.exists(cwd("stop")):
+    db.bulk_update_results([
+        {"id": i, "operational": True, "last_check": datetime.now()}
+        for i in ids
+    ])
+    db.set_operational(ids[-1], True)
+"""
 
 class TestSocks5(object):
     def setup_class(self):
@@ -107,11 +133,13 @@ class TestSocks5(object):
     def test_remove_socks5(self):
         id1 = self.db.add_socks5(
             "9.8.8.8", 4141, "Germany", "DE", city="Berlin",
-            description="Very wow" * 100
+            description="Very wow" * 100, operational=True
         )
+        self.db.acquire_lease(1, 60)
         assert self.db.view_socks5(id1).id == id1
         self.db.remove_socks5(id1)
         assert self.db.view_socks5(id1) is None
+        assert self.db.count_leases() == 0
 
     def test_list_socks5_operational(self):
         s1id = self.db.add_socks5(
@@ -239,6 +267,62 @@ class TestSocks5(object):
         assert res[1].id == s2id
         assert res[2].id == s3id
 
+    def test_list_socks5_pages(self):
+        for port in range(5):
+            self.db.add_socks5(
+                "9.8.8.8", port, "Germany", "DE", operational=port % 2 == 0
+            )
+
+        assert [s.id for s in self.db.list_socks5(limit=2)] == [1, 2]
+        assert [
+            s.id for s in self.db.list_socks5(limit=2, after_id=2)
+        ] == [3, 4]
+        assert [s.id for s in self.db.list_socks5(after_id=4)] == [5]
+        assert self.db.list_socks5(after_id=5) == []
+        assert [
+            s.id for s in self.db.list_socks5(
+                operational=True, limit=2, after_id=1
+            )
+        ] == [3, 5]
+
+    def test_export_socks5(self):
+        for port in range(5):
+            self.db.add_socks5(
+                "9.8.8.8", port, "Germany", "DE", operational=port % 2 == 0
+            )
+
+        rows = self.db.export_socks5(
+            columns=["id", "port", "operational"], batch_size=2
+        )
+        assert not isinstance(rows, list)
+        assert list(rows) == [
+            (1, 0, True), (2, 1, False), (3, 2, True), (4, 3, False),
+            (5, 4, True)
+        ]
+        assert list(self.db.export_socks5(
+            columns="id,host", operational=True, limit=1, after_id=1
+        )) == [(3, "9.8.8.8")]
+        row, = self.db.export_socks5(limit=1)
+        assert len(row) == len(EXPORT_COLUMNS)
+        with pytest.raises(ValueError):
+            list(self.db.export_socks5(columns=["id", "nope"]))
+
+    def test_count_socks5(self):
+        self.db.add_socks5(
+            "9.8.8.8", 1, "Germany", "DE", city="Berlin", operational=True
+        )
+        self.db.add_socks5("9.8.8.8", 2, "Germany", "DE", city="Berlin")
+        self.db.add_socks5("9.10.8.8", 3, "France", "FR", city="Paris")
+
+        assert self.db.count_socks5() == 3
+        assert self.db.count_socks5(country="germany") == 2
+        assert self.db.count_socks5(country_code="fr") == 1
+        assert self.db.count_socks5(city="berlin", operational=True) == 1
+        assert self.db.count_socks5(operational=False) == 2
+        assert self.db.count_socks5(host=["9.8.8.8", "9.10.8.8"]) == 3
+        assert self.db.count_socks5(unverified=True) == 3
+        assert self.db.count_socks5(country="italy") == 0
+
     def test_view_socks5(self):
         s1id = self.db.add_socks5(
             "9.8.8.8", 4141, "Germany", "DE", city="Berlin",
@@ -273,6 +357,225 @@ class TestSocks5(object):
         assert self.db.find_socks5()[0].id == s2id
         assert len(self.db.find_socks5(limit=1000)) == 2
 
+    def test_find_socks5_compare_and_set(self):
+        self.db.supports_returning = False
+        s1id = self.db.add_socks5(
+            "9.8.8.8", 4141, "France", "FR", operational=True
+        )
+        s2id = self.db.add_socks5(
+            "9.8.8.8", 4241, "France", "FR", operational=True
+        )
+        socks5 = self.db.find_socks5()
+        assert socks5[0].id == s1id
+        assert socks5[0].last_use is not None
+        assert self.db.find_socks5()[0].id == s2id
+        assert self.db.find_socks5()[0].id == s1id
+        assert len(self.db.find_socks5(limit=1000)) == 2
+
+    def test_find_socks5_quotas(self):
+        for code, amount in (("DE", 5), ("US", 5), ("NL", 3)):
+            for i in range(amount):
+                self.db.add_socks5(
+                    "9.8.8.8", i, "Unknown", code, operational=True
+                )
+
+        for supports_returning in (True, False):
+            self.db.supports_returning = supports_returning
+            found = self.db.find_socks5(
+                limit=6, quotas={"DE": 2, "us": 3}
+            )
+            codes = [s.country_code for s in found]
+            assert len(set(s.id for s in found)) == 6
+            assert codes.count("DE") == 2
+            assert codes.count("US") == 3
+            assert codes.count("NL") == 1
+            assert all(s.last_use is not None for s in found)
+
+        # Quotas higher than available return what is available
+        found = self.db.find_socks5(limit=20, quotas={"NL": 10})
+        assert len(found) == 13
+        assert [s.country_code for s in found].count("NL") == 3
+        assert self.db.find_socks5(limit=0) == []
+
+    def test_find_socks5_quotas_no_usage_update(self):
+        s1 = self.db.add_socks5("9.8.8.8", 1, "Unknown", "DE", operational=True)
+        s2 = self.db.add_socks5("9.8.8.8", 2, "Unknown", "US", operational=True)
+        self.db.add_socks5("9.8.8.8", 3, "Unknown", "US", operational=True)
+        found = self.db.find_socks5(
+            update_usage=False, limit=2, quotas={"DE": 1, "US": 1}
+        )
+        assert sorted(s.id for s in found) == [s1, s2]
+        assert all(s.last_use is None for s in found)
+
+    def test_find_socks5_concurrent(self):
+        ids = [
+            self.db.add_socks5(
+                "9.8.8.%s" % i, 4141, "France", "FR", operational=True
+            ) for i in range(20)
+        ]
+        for supports_returning in (True, False):
+            self.db.supports_returning = supports_returning
+            found = []
+            def acquire():
+                found.extend(s.id for s in self.db.find_socks5())
+
+            threads = [threading.Thread(target=acquire) for _ in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            assert sorted(found) == ids
+
+    def test_acquire_lease(self):
+        s1 = self.db.add_socks5("9.8.8.8", 1, "France", "FR", operational=True)
+        s2 = self.db.add_socks5("9.8.8.8", 2, "France", "FR", operational=True)
+        self.db.add_socks5("9.8.8.8", 3, "Germany", "DE", operational=True)
+        self.db.add_socks5("9.8.8.8", 4, "France", "FR")
+        past = datetime.now()
+
+        socks5, lease = self.db.acquire_lease(2, 60, country="france")
+        assert socks5.id == s1
+        assert socks5.last_use > past
+        assert lease.socks5_id == s1
+        assert lease.expires_on > lease.acquired_on
+        # Socks5s with the least active leases are leased first
+        leased = [
+            self.db.acquire_lease(2, 60, country="france")[0].id
+            for _ in range(3)
+        ]
+        assert leased == [s2, s1, s2]
+        assert self.db.acquire_lease(2, 60, country="france") is None
+        assert self.db.count_leases() == 4
+        assert self.db.count_leases(s1) == 2
+
+        self.db.release_lease(lease.id, s1)
+        assert self.db.acquire_lease(2, 60, country="france")[0].id == s1
+
+    def test_acquire_lease_latency(self):
+        slow = self.db.add_socks5(
+            "9.8.8.8", 1, "France", "FR", operational=True
+        )
+        fast = self.db.add_socks5(
+            "9.8.8.8", 2, "France", "FR", operational=True
+        )
+        for socks5_id, latency in ((slow, 2.0), (fast, 0.5)):
+            socks5, lease = self.db.acquire_lease(4, 60)
+            assert socks5.id == socks5_id
+            self.db.release_lease(lease.id, socks5_id, latency=latency)
+
+        # Unleased socks5s are leased first
+        leased = [self.db.acquire_lease(4, 60)[0].id for _ in range(2)]
+        assert sorted(leased) == [slow, fast]
+        # Then the socks5 with the least active leases times latency
+        leased = [self.db.acquire_lease(4, 60)[0].id for _ in range(4)]
+        assert leased == [fast, fast, fast, slow]
+        assert self.db.count_leases(fast) == 4
+
+    def test_acquire_lease_expired(self):
+        s1 = self.db.add_socks5("9.8.8.8", 1, "France", "FR", operational=True)
+        self.db.acquire_lease(1, 0)
+        assert self.db.count_leases(s1) == 0
+        socks5, lease = self.db.acquire_lease(1, 60)
+        assert socks5.id == s1
+        assert self.db.acquire_lease(1, 60) is None
+        session = self.db.Session()
+        try:
+            # The expired lease is removed
+            assert session.query(Socks5Lease).count() == 1
+        finally:
+            session.close()
+
+    def test_release_lease_feedback(self):
+        s1 = self.db.add_socks5("9.8.8.8", 1, "France", "FR", operational=True)
+        _, lease = self.db.acquire_lease(4, 60)
+        self.db.release_lease(lease.id, s1, latency=1.0)
+        assert self.db.view_socks5(s1).lease_latency == 1.0
+        _, lease = self.db.acquire_lease(4, 60)
+        self.db.release_lease(lease.id, s1, latency=2.0)
+        assert self.db.view_socks5(s1).lease_latency == pytest.approx(1.3)
+
+        for _ in range(2):
+            _, lease = self.db.acquire_lease(4, 60)
+            self.db.release_lease(lease.id, s1, success=False, max_failures=3)
+        s = self.db.view_socks5(s1)
+        assert s.operational
+        assert s.lease_failures == 2
+        assert s.last_failure is not None
+
+        _, lease = self.db.acquire_lease(4, 60)
+        self.db.release_lease(lease.id, s1, success=False, max_failures=3)
+        assert not self.db.view_socks5(s1).operational
+        assert self.db.acquire_lease(4, 60) is None
+
+        self.db.set_operational(s1, True)
+        assert self.db.view_socks5(s1).lease_failures == 0
+
+    def test_acquire_lease_concurrent(self):
+        for i in range(5):
+            self.db.add_socks5("9.8.8.8", i, "France", "FR", operational=True)
+        leased = []
+        def lease():
+            for _ in range(5):
+                found = self.db.acquire_lease(3, 60)
+                if found:
+                    leased.append(found[0].id)
+
+        threads = [threading.Thread(target=lease) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(leased) == 15
+        assert sorted(leased) == sorted(list(range(1, 6)) * 3)
+
+    def test_pragmas(self):
+        conn = self.db.engine.connect()
+        try:
+            assert conn.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert conn.execute("PRAGMA synchronous").scalar() == 1
+            assert conn.execute("PRAGMA busy_timeout").scalar() == 10000
+            assert conn.execute("PRAGMA cache_size").scalar() == -8192
+        finally:
+            conn.close()
+
+    def test_concurrent_verify_acquire(self):
+        ids = [
+            self.db.add_socks5(
+                "9.8.8.%s" % i, 4141, "France", "FR", operational=True
+            ) for i in range(100)
+        ]
+        # The verifier runs in its own process and keeps writing results
+        # while this process acquires socks5s
+        verifier = subprocess.Popen([
+            sys.executable, "-c", VERIFIER_SCRIPT, cwd(),
+            ",".join(str(i) for i in ids)
+        ], stdout=subprocess.PIPE)
+        assert verifier.stdout.readline().strip() == b"started"
+
+        errors = []
+        found = []
+        def acquire():
+            try:
+                for _ in range(50):
+                    found.extend(s.id for s in self.db.find_socks5())
+                    self.db.set_connect_time(ids[0], 0.1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=acquire) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        open(cwd("stop"), "w").close()
+        verifier.stdout.close()
+        assert verifier.wait() == 0
+        assert errors == []
+        assert len(found) == 500
+
     def test_find_socks5_no_usage_update(self):
         s1id = self.db.add_socks5(
             "9.8.8.8", 4141, "Germany", "DE", city="Berlin",
@@ -469,15 +772,216 @@ class TestSocks5(object):
         self.db.set_approx_bandwidth(id1, 10.24)
         assert self.db.view_socks5(id1).bandwidth == 10.24
 
+    def test_bulk_update_results(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        id2 = self.db.add_socks5("8.8.8.8", 4141, "Germany", "DE")
+        id3 = self.db.add_socks5("7.8.8.8", 4141, "Germany", "DE")
+        now = datetime.now()
+        self.db.bulk_update_results([
+            {"id": id1, "operational": True, "last_check": now,
+             "connect_time": 0.2},
+            {"id": id2, "operational": False, "last_check": now},
+            {"id": id3, "bandwidth": 10.5},
+            {"id": 8127313, "operational": True}
+        ])
+        s1 = self.db.view_socks5(id1)
+        s2 = self.db.view_socks5(id2)
+        s3 = self.db.view_socks5(id3)
+        assert s1.operational
+        assert s1.last_check == now
+        assert s1.connect_time == 0.2
+        assert not s2.operational
+        assert s2.last_check == now
+        assert s2.last_failure == now
+        assert s2.connect_time is None
+        assert s1.last_failure is None
+        assert s3.bandwidth == 10.5
+        assert s3.last_check is None
+
+    def test_check_history(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        self.db.set_operational(id1, True)
+        self.db.set_connect_time(id1, 0.5)
+        self.db.set_approx_bandwidth(id1, 10)
+        self.db.set_operational(id1, False)
+        self.db.set_operational(id1, False)
+
+        checks = self.db.list_checks(id1)
+        assert [c.successes for c in checks] == [0, 0, 1]
+        assert checks[2].connect_time == 0.5
+        assert checks[2].bandwidth == 10
+        assert checks[0].connect_time is None
+        s = self.db.view_socks5(id1)
+        assert s.uptime == pytest.approx(1 / 3.0)
+        assert s.check_failures == 2
+        assert s.connect_time_ewma == 0.5
+        assert s.connect_time_p95 == 0.5
+
+        self.db.set_operational(id1, True)
+        assert self.db.view_socks5(id1).check_failures == 0
+        self.db.remove_socks5(id1)
+        assert self.db.list_checks(id1) == []
+
+    def test_bulk_update_results_statistics(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        id2 = self.db.add_socks5("8.8.8.8", 4141, "Germany", "DE")
+        for connect_time in (1.0, 0.5, 2.0):
+            self.db.bulk_update_results([
+                {"id": id1, "operational": True, "last_check": datetime.now(),
+                 "connect_time": connect_time},
+                {"id": id2, "operational": False},
+                {"id": 8127313, "operational": True}
+            ])
+        # A connection time measured after the results were written
+        # belongs to the latest check
+        self.db.bulk_update_results([{"id": id1, "connect_time": 3.0}])
+
+        s1 = self.db.view_socks5(id1)
+        assert s1.uptime == 1.0
+        assert s1.check_failures == 0
+        ewma = 1.0
+        for connect_time in (0.5, 2.0, 3.0):
+            ewma = 0.3 * connect_time + 0.7 * ewma
+        assert s1.connect_time_ewma == pytest.approx(ewma)
+        assert s1.connect_time_p95 == 3.0
+        assert [c.connect_time for c in self.db.list_checks(id1)] == [
+            3.0, 0.5, 1.0
+        ]
+        s2 = self.db.view_socks5(id2)
+        assert s2.uptime == 0.0
+        assert s2.check_failures == 3
+        assert self.db.list_checks(8127313) == []
+
+    def test_percentile(self):
+        assert percentile([], 95) is None
+        assert percentile([3, 1, 2], 95) == 3
+        assert percentile(list(range(1, 101)), 95) == 95
+        assert percentile([5], 0) == 5
+
+    def test_compact_checks(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        now = datetime.now()
+        hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(
+            days=2
+        )
+        ses = self.db.Session()
+        for i in range(12):
+            ses.add(Socks5Check(
+                socks5_id=id1, checked_on=hour + timedelta(minutes=i * 10),
+                successes=i % 2, connect_time=i if i % 2 else None
+            ))
+        ses.commit()
+        ses.close()
+        self.db.bulk_update_results([
+            {"id": id1, "operational": False,
+             "last_check": now - timedelta(days=40)},
+        ])
+        self.db.bulk_update_results([
+            {"id": id1, "operational": True, "last_check": now}
+        ])
+        assert self.db.view_socks5(id1).uptime == 0.5
+
+        assert self.db.compact_checks(30 * 86400, 86400, 3600) == (1, 12)
+        s = self.db.view_socks5(id1)
+        assert s.uptime == 1.0
+        assert s.check_count == 1
+        checks = self.db.list_checks(id1)
+        assert [(c.checks, c.successes, c.downsampled) for c in checks] == [
+            (1, 1, False), (6, 3, True), (6, 3, True)
+        ]
+        assert checks[1].checked_on == hour + timedelta(hours=1)
+        assert checks[1].connect_time == 9
+        assert checks[2].checked_on == hour
+        assert checks[2].connect_time == 3
+        assert self.db.compact_checks(30 * 86400, 86400, 3600) == (0, 0)
+
+    def test_find_socks5_statistics(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        id2 = self.db.add_socks5("8.8.8.8", 4141, "Germany", "DE")
+        id3 = self.db.add_socks5("7.8.8.8", 4141, "Germany", "DE")
+        for operational in (True, False, True):
+            self.db.bulk_update_results([
+                {"id": id1, "operational": operational, "connect_time": 0.1},
+                {"id": id2, "operational": True, "connect_time": 0.3},
+            ])
+        self.db.bulk_update_results([
+            {"id": id3, "operational": True, "connect_time": 0.2}
+        ])
+
+        found = self.db.find_socks5(min_uptime=0.9, limit=3)
+        assert sorted(s.id for s in found) == [id2, id3]
+        found = self.db.find_socks5(max_connect_time_p95=0.25, limit=3)
+        assert sorted(s.id for s in found) == [id1, id3]
+        self.db.set_operational(id2, False)
+        self.db.set_operational(id2, True)
+        found = self.db.find_socks5(max_check_failures=0, limit=3)
+        assert sorted(s.id for s in found) == [id1, id2, id3]
+
+        found = self.db.find_socks5(order_by="uptime", limit=3)
+        assert [s.id for s in found][0] in (id2, id3)
+        assert [s.id for s in found][-1] == id1
+        found = self.db.find_socks5(order_by="connect_time", limit=2)
+        assert [s.id for s in found] == [id1, id3]
+        found = self.db.find_socks5(
+            order_by="connect_time_p95", update_usage=False, limit=3
+        )
+        assert [s.id for s in found] == [id1, id3, id2]
+        with pytest.raises(ValueError):
+            self.db.find_socks5(order_by="doge")
+
+    def test_find_socks5_statistics_compare_and_set(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        id2 = self.db.add_socks5("8.8.8.8", 4141, "Germany", "DE")
+        self.db.bulk_update_results([
+            {"id": id1, "operational": True, "connect_time": 0.5},
+            {"id": id2, "operational": True, "connect_time": 0.1},
+        ])
+        self.db.supports_returning = False
+        found = self.db.find_socks5(order_by="connect_time", limit=2)
+        assert [s.id for s in found] == [id2, id1]
+
+    def test_result_batch_size(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        id2 = self.db.add_socks5("8.8.8.8", 4141, "Germany", "DE")
+        batch = ResultBatch(size=2, interval=60)
+        batch.add(id1, operational=True)
+        batch.add(id1, connect_time=0.5)
+        assert not self.db.view_socks5(id1).operational
+        batch.add(id2, operational=True)
+        s1 = self.db.view_socks5(id1)
+        assert s1.operational
+        assert s1.connect_time == 0.5
+        assert self.db.view_socks5(id2).operational
+        assert not batch.pending
+
+    def test_result_batch_interval(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        batch = ResultBatch(size=100, interval=0)
+        batch.add(id1, bandwidth=4.2)
+        assert self.db.view_socks5(id1).bandwidth == 4.2
+
+    def test_result_batch_flush(self):
+        id1 = self.db.add_socks5("9.8.8.8", 4141, "Germany", "DE")
+        batch = ResultBatch(size=100, interval=60)
+        batch.add(id1, operational=True)
+        assert not self.db.view_socks5(id1).operational
+        batch.flush()
+        assert self.db.view_socks5(id1).operational
+        # Nothing pending, should not raise exception
+        batch.flush()
+
     def test_delete(self):
         for x in range(25):
             self.db.add_socks5(
                 "9.8.8.8", x, "Germany", "DE",
                 operational=False
             )
-        assert len(self.db.list_socks5()) == 25
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        self.db.acquire_lease(1, 60)
+        assert len(self.db.list_socks5()) == 26
         self.db.delete_all_socks5()
         assert len(self.db.list_socks5()) == 0
+        assert self.db.count_leases() == 0
 
     def test_bulk_delete_socks5(self):
         ids = []
@@ -488,11 +992,16 @@ class TestSocks5(object):
             )
             if x <= 12:
                 ids.append(i)
+        self.db.set_operational(ids[0], True)
+        self.db.acquire_lease(1, 60)
+        assert self.db.count_leases(ids[0]) == 1
         assert len(self.db.list_socks5()) == 25
         self.db.bulk_delete_socks5(ids)
         assert len(self.db.list_socks5()) == 12
         for i in ids:
             assert self.db.view_socks5(socks5_id=i) is None
+            assert self.db.list_checks(i) == []
+        assert self.db.count_leases() == 0
 
     def test_big_bulk_delete(self):
         bulk_socks = [{
@@ -515,6 +1024,35 @@ class TestSocks5(object):
         assert len(workingsocks) == 1
         assert workingsocks[0].operational
 
+    def test_delete_socks5_where(self):
+        ids = [
+            self.db.add_socks5("8.8.8.8", x, "Germany", "DE")
+            for x in range(6)
+        ]
+        self.db.add_socks5(
+            "8.8.8.8", 10, "France", "FR", description="cheap"
+        )
+        self.db.set_operational(ids[0], True)
+        self.db.set_operational(ids[1], False)
+        self.db.acquire_lease(1, 60, country_code="DE")
+
+        assert self.db.delete_socks5_where(
+            operational=False, country_code="de", min_id=ids[1],
+            max_id=ids[3]
+        ) == 3
+        assert [s.port for s in self.db.list_socks5()] == [0, 4, 5, 10]
+        assert self.db.list_checks(ids[1]) == []
+
+        assert self.db.delete_socks5_where(description="CHEAP") == 1
+        assert self.db.delete_socks5_where(
+            checked_before=datetime.now() - timedelta(days=1)
+        ) == 0
+        assert self.db.delete_socks5_where(
+            checked_before=datetime.now() + timedelta(days=1)
+        ) == 1
+        assert self.db.count_leases() == 0
+        assert [s.port for s in self.db.list_socks5()] == [4, 5]
+
     def test_update_geoinfo(self):
         id1 = self.db.add_socks5(
             "9.8.8.8", 4242, "Germany", "DE",
@@ -560,6 +1098,48 @@ class TestSocks5(object):
                 id1, country="France", country_code=None, city="Paris"
             )
 
+    def test_iter_socks5_geoinfo(self):
+        for port in range(5):
+            self.db.add_socks5("9.8.8.8", port, "Germany", "DE")
+
+        chunks = list(self.db.iter_socks5_geoinfo(chunk_size=2))
+        assert [[row.id for row in chunk] for chunk in chunks] == [
+            [1, 2], [3, 4], [5]
+        ]
+        assert tuple(chunks[0][0]) == (1, "9.8.8.8", "Germany", "DE", None)
+        assert list(self.db.iter_socks5_geoinfo(chunk_size=5))[0][-1].id == 5
+
+    def test_bulk_update_geoinfo(self):
+        id1 = self.db.add_socks5("9.8.8.8", 1, "Germany", "DE")
+        id2 = self.db.add_socks5("9.8.8.8", 2, "Germany", "DE")
+        id3 = self.db.add_socks5("9.8.8.8", 3, "Germany", "DE")
+        self.db.bulk_update_geoinfo([
+            {"id": id1, "country": "France", "country_code": "FR",
+             "city": "Paris"},
+            {"id": id3, "country": "Netherlands", "country_code": "NL",
+             "city": None},
+        ])
+        self.db.bulk_update_geoinfo([])
+        assert [
+            (s.country, s.country_code, s.city)
+            for s in (self.db.view_socks5(i) for i in (id1, id2, id3))
+        ] == [
+            ("France", "FR", "Paris"), ("Germany", "DE", None),
+            ("Netherlands", "NL", None)
+        ]
+
+    def test_bulk_update_geoinfo_invalid(self):
+        id1 = self.db.add_socks5("9.8.8.8", 1, "Germany", "DE")
+        id2 = self.db.add_socks5("9.8.8.8", 2, "Germany", "DE")
+        with pytest.raises(Socks5manDatabaseError):
+            self.db.bulk_update_geoinfo([
+                {"id": id1, "country": "France", "country_code": "FR",
+                 "city": None},
+                {"id": id2, "country": None, "country_code": "FR",
+                 "city": None},
+            ])
+        assert self.db.view_socks5(id1).country == "Germany"
+
     def test_schema_latest_version(self):
         ses = self.db.Session()
         try:
@@ -568,6 +1148,29 @@ class TestSocks5(object):
         finally:
             ses.close()
 
+    def test_schema_indexes(self):
+        indexes = [
+            r[0] for r in self.db.engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        ]
+        for index in ("ix_socks5s_acquire", "ix_socks5s_country",
+                      "ix_socks5s_country_code", "ix_socks5s_city",
+                      "ix_socks5_leases_socks5_id",
+                      "ix_socks5_leases_expires_on",
+                      "ix_socks5_checks_socks5_id",
+                      "ix_socks5_checks_checked_on",
+                      "ix_socks5_checks_downsampled"):
+            assert index in indexes
+
+        plan = self.db.engine.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM socks5s WHERE operational = 1"
+            " ORDER BY last_use ASC, last_check DESC, connect_time ASC,"
+            " bandwidth DESC LIMIT 1"
+        ).fetchall()
+        assert "ix_socks5s_acquire" in plan[0][-1]
+        assert "TEMP B-TREE" not in " ".join(r[-1] for r in plan)
+
     def test_db_migratable_true(self):
         ses = self.db.Session()
         try:
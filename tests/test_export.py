@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+import csv
+import gzip
+import io
+import json
+import pytest
+from datetime import datetime
+
+from socks5man.database import Database, EXPORT_COLUMNS
+from socks5man.export import BinaryReader, BinaryWriter, export_socks5
+from socks5man.misc import set_cwd
+
+from tests.helpers import CleanedTempFile
+
+class TestExport(object):
+
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        self.db = Database()
+        self.db.connect(create=True)
+        self.db.add_socks5(
+            "8.8.8.8", 1337, "Germany", "DE", city="Berlin",
+            operational=True, username="doge", password="wow",
+            description="Such wow, many socks5"
+        )
+        self.db.add_socks5("example.com", 1080, "France", "FR")
+        self.db.set_connect_time(1, 0.25)
+
+    def test_csv(self):
+        fp = io.BytesIO()
+        assert export_socks5(fp) == 2
+        rows = [
+            row for row in csv.DictReader(
+                io.StringIO(fp.getvalue().decode("utf-8"))
+            )
+        ]
+        assert [r["host"] for r in rows] == ["8.8.8.8", "example.com"]
+        assert rows[0]["city"] == "Berlin"
+        assert rows[0]["connect_time"] == "0.25"
+        assert rows[0]["operational"] == "True"
+        assert rows[1]["city"] == ""
+        assert rows[0]["added_on"] == self.db.view_socks5(
+            1
+        ).added_on.strftime("%Y-%m-%d %H:%M:%S")
+        assert list(rows[0].keys()) == list(EXPORT_COLUMNS)
+
+    def test_csv_columns(self):
+        fp = io.BytesIO()
+        export_socks5(fp, columns="id, host,port")
+        assert fp.getvalue().decode("utf-8").splitlines() == [
+            "id,host,port", "1,8.8.8.8,1337", "2,example.com,1080"
+        ]
+
+    def test_jsonl(self):
+        fp = io.BytesIO()
+        assert export_socks5(
+            fp, fmt="jsonl", columns=["id", "city", "operational"],
+            country_code="fr"
+        ) == 1
+        assert [
+            json.loads(line) for line in fp.getvalue().splitlines()
+        ] == [{"id": 2, "city": None, "operational": False}]
+
+    def test_binary(self):
+        fp = io.BytesIO()
+        assert export_socks5(fp, fmt="binary") == 2
+        fp.seek(0)
+        reader = BinaryReader(fp)
+        assert reader.columns == list(EXPORT_COLUMNS)
+        rows = list(reader)
+        s = self.db.view_socks5(1)
+        assert rows[0]["host"] == "8.8.8.8"
+        assert rows[0]["port"] == 1337
+        assert rows[0]["operational"] is True
+        assert rows[0]["connect_time"] == 0.25
+        assert rows[0]["added_on"] == s.added_on
+        assert rows[1]["city"] is None
+
+    def test_binary_values(self):
+        fp = io.BytesIO()
+        values = [
+            None, True, False, -5, 2 ** 40, 1.5, "ü", "",
+            datetime(2001, 2, 3, 4, 5, 6, 789), datetime(1960, 1, 1)
+        ]
+        columns = ["c%s" % i for i in range(len(values))]
+        writer = BinaryWriter(fp, columns)
+        writer.write(values)
+        writer.write(values)
+        writer.close()
+        fp.seek(0)
+        assert list(BinaryReader(fp)) == [dict(zip(columns, values))] * 2
+
+    def test_binary_invalid(self):
+        with pytest.raises(ValueError):
+            BinaryReader(io.BytesIO(b"nope"))
+
+        fp = io.BytesIO()
+        export_socks5(fp, fmt="binary", columns=["host"])
+        fp = io.BytesIO(fp.getvalue()[:-2])
+        with pytest.raises(ValueError):
+            list(BinaryReader(fp))
+
+    def test_gzip(self):
+        fp = io.BytesIO()
+        export_socks5(fp, fmt="jsonl", columns=["id"], compress=True)
+        assert gzip.decompress(fp.getvalue()) == b'{"id": 1}\n{"id": 2}\n'
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            export_socks5(io.BytesIO(), fmt="xml")
+        with pytest.raises(ValueError):
+            export_socks5(io.BytesIO(), columns="id,nope")
@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+import socket
+
+import pytest
+
+from socks5man import aiosocks5
+from socks5man.database import Database
+from socks5man.exceptions import Socks5ClientError, Socks5GatewayError
+from socks5man.gateway import Gateway, parse_tags
+from socks5man.misc import set_cwd, create_cwd, cwd
+
+from tests.helpers import CleanedTempFile, FakeSocks5
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\n8.8.8.8"
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_parse_tags():
+    assert parse_tags("") == {}
+    assert parse_tags("country=Germany, min_mbps=5") == {
+        "country": "Germany", "min_mbps_down": 5.0
+    }
+    assert parse_tags("code=nl,city=amsterdam,max_connect=0.5") == {
+        "country_code": "nl", "city": "amsterdam", "max_connect_time": 0.5
+    }
+
+def test_parse_tags_invalid():
+    with pytest.raises(Socks5GatewayError):
+        parse_tags("doge=wow")
+    with pytest.raises(Socks5GatewayError):
+        parse_tags("country")
+    with pytest.raises(Socks5GatewayError):
+        parse_tags("min_mbps=fast")
+
+class TestGateway(object):
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        create_cwd(cwd())
+        self.db = Database()
+        self.db.connect(create=True)
+
+    def run(self, upstreams, func):
+        async def _run():
+            ports = [await fake.start() for fake in upstreams]
+            gateway = Gateway(host="127.0.0.1", port=0, connect_attempts=2)
+            port = await gateway.start()
+            try:
+                return await func(port, ports)
+            finally:
+                await gateway.close()
+                for fake in upstreams:
+                    fake.stop()
+
+        return aiosocks5.run(_run())
+
+    def test_relay(self):
+        fake = FakeSocks5(RESPONSE)
+        def func(port, ports):
+            self.db.add_socks5(
+                "127.0.0.1", ports[0], "Germany", "DE", operational=True
+            )
+            return aiosocks5.http_get(
+                "http://example.com/ip", "127.0.0.1", port
+            )
+
+        assert self.run([fake], func) == b"8.8.8.8"
+        assert fake.requests[0] == (aiosocks5.CMD_CONNECT, "example.com", 80)
+        assert fake.requests[1].startswith(b"GET /ip HTTP/1.1\r\n")
+        assert self.db.view_socks5(1).last_use is not None
+
+    def test_relay_filters(self):
+        germany = FakeSocks5(RESPONSE)
+        france = FakeSocks5(RESPONSE)
+        def func(port, ports):
+            self.db.add_socks5(
+                "127.0.0.1", ports[0], "Germany", "DE", operational=True
+            )
+            self.db.add_socks5(
+                "127.0.0.1", ports[1], "France", "FR", operational=True
+            )
+            return aiosocks5.http_get(
+                "http://example.com", "127.0.0.1", port,
+                username="country=france", password="x"
+            )
+
+        assert self.run([germany, france], func) == b"8.8.8.8"
+        assert germany.requests == []
+        assert len(france.requests) == 2
+
+    def test_retry_other_upstream(self):
+        fake = FakeSocks5(RESPONSE)
+        def func(port, ports):
+            self.db.add_socks5(
+                "127.0.0.1", ports[0], "Germany", "DE", operational=True
+            )
+            dead = self.db.add_socks5(
+                "127.0.0.1", closed_port(), "Germany", "DE"
+            )
+            # Makes the dead server the first one to be acquired
+            self.db.set_operational(dead, True)
+            return aiosocks5.http_get("http://example.com", "127.0.0.1", port)
+
+        assert self.run([fake], func) == b"8.8.8.8"
+        assert self.db.view_socks5(1).last_use is not None
+        assert self.db.view_socks5(2).last_use is not None
+
+    def test_no_match(self):
+        fake = FakeSocks5(RESPONSE)
+        def func(port, ports):
+            self.db.add_socks5(
+                "127.0.0.1", ports[0], "Germany", "DE", operational=True
+            )
+            return aiosocks5.http_get(
+                "http://example.com", "127.0.0.1", port,
+                username="code=nl", password="x"
+            )
+
+        with pytest.raises(Socks5ClientError):
+            self.run([fake], func)
+        assert fake.requests == []
+
+    def test_invalid_tags(self):
+        def func(port, ports):
+            return aiosocks5.http_get(
+                "http://example.com", "127.0.0.1", port,
+                username="such=wow", password="x"
+            )
+
+        with pytest.raises(Socks5ClientError):
+            self.run([], func)
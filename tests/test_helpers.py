@@ -1,14 +1,23 @@
 from __future__ import absolute_import
+import asyncio
+import maxminddb
 import mock
-import urllib.request, urllib.error, urllib.parse
+import os
+import pytest
+import shutil
+import socket
 
 from socks5man.helpers import (
     Dictionary, is_ipv4, is_reserved_ipv4, GeoInfo, get_ipv4_hostname,
-    validify_host_port, get_over_socks5, approximate_bandwidth
+    validify_host_port, get_over_socks5, approximate_bandwidth, LRUCache,
+    IPv4RangeMatcher, reserved_ipv4, Resolver, ameasure_download,
+    calculate_mbps, measure_bandwidth
 )
+from socks5man import aiosocks5
+from socks5man.exceptions import Socks5ClientError
 from socks5man.misc import set_cwd, create_cwd
 
-from tests.helpers import CleanedTempFile
+from tests.helpers import CleanedTempFile, FakeSocks5
 
 def test_dictionary():
     d = {
@@ -58,6 +67,38 @@ def test_is_ipv4():
     for ipv6 in ipv6:
         assert not is_ipv4(ipv6)
 
+def test_ipv4_range_matcher():
+    matcher = IPv4RangeMatcher(["10.0.0.0/8", "10.1.0.0/16", "11.0.0.0/8",
+                                "192.168.1.5"])
+    # Overlapping and adjacent ranges are merged
+    assert matcher.starts == [0x0A000000, 0xC0A80105]
+    assert matcher.ends == [0x0BFFFFFF, 0xC0A80105]
+    assert matcher.match("10.20.30.40")
+    assert matcher.match("11.255.255.255")
+    assert "192.168.1.5" in matcher
+    assert not matcher.match("192.168.1.6")
+    assert not matcher.match("9.255.255.255")
+    assert not matcher.match("12.0.0.0")
+    assert not matcher.match("invalid")
+    assert not matcher.match(None)
+
+def test_ipv4_range_matcher_classify():
+    ips = ["10.0.0.1", "8.8.8.8", "invalid", "100.64.0.1", "255.255.255.255"]
+    assert reserved_ipv4.classify(ips) == [True, False, False, True, True]
+    assert reserved_ipv4.classify(ips) == [is_reserved_ipv4(ip) for ip in ips]
+
+def test_ipv4_range_matcher_extra_ranges():
+    matcher = reserved_ipv4.with_ranges(["8.8.8.0/24"])
+    assert matcher.match("8.8.8.8")
+    assert matcher.match("10.0.0.1")
+    assert not reserved_ipv4.match("8.8.8.8")
+
+def test_ipv4_range_matcher_invalid_range():
+    with pytest.raises(ValueError):
+        IPv4RangeMatcher(["10.0.0.0/33"])
+    with pytest.raises(ValueError):
+        IPv4RangeMatcher(["notanip/8"])
+
 class TestGeoInfo(object):
 
     def setup_class(self):
@@ -99,6 +140,83 @@ class TestGeoInfo(object):
         assert res["country_code"] == "unknown"
         assert res["city"] == "unknown"
 
+    def test_ipv4info_many(self):
+        tmppath = self.tempfile.mkdtemp()
+        set_cwd(tmppath)
+        create_cwd(tmppath)
+
+        ips = ["93.184.216.34", "10.0.0.5", "8adna87dasd87asd"]
+        assert GeoInfo.ipv4info_many(ips) == [GeoInfo.ipv4info(ip) for ip in ips]
+        assert GeoInfo.ipv4info_many(ips)[1]["country"] == "unknown"
+
+    def test_ipv4info_reader_opened_once(self):
+        tmppath = self.tempfile.mkdtemp()
+        set_cwd(tmppath)
+        create_cwd(tmppath)
+        GeoInfo.reset()
+
+        with mock.patch(
+                "socks5man.helpers.maxminddb.open_database",
+                wraps=maxminddb.open_database
+        ) as mo:
+            for _ in range(10):
+                GeoInfo.ipv4info("93.184.216.34")
+                GeoInfo.ipv4info("8.8.8.8")
+            mo.assert_called_once()
+
+    def test_ipv4info_cache(self):
+        tmppath = self.tempfile.mkdtemp()
+        set_cwd(tmppath)
+        create_cwd(tmppath)
+        GeoInfo.reset()
+        stats = GeoInfo.cache_stats()
+
+        res = GeoInfo.ipv4info("93.184.216.34")
+        assert GeoInfo.cache_stats()["misses"] == stats["misses"] + 1
+        # Same /24 network
+        res2 = GeoInfo.ipv4info("93.184.216.80")
+        assert res == res2
+        assert GeoInfo.cache_stats()["hits"] == stats["hits"] + 1
+        res2["country"] = "Changed"
+        assert GeoInfo.ipv4info("93.184.216.34")["country"] == res["country"]
+
+    def test_ipv4info_file_replaced(self):
+        tmppath = self.tempfile.mkdtemp()
+        set_cwd(tmppath)
+        create_cwd(tmppath)
+        GeoInfo.reset()
+        GeoInfo.ipv4info("93.184.216.34")
+        reader = GeoInfo.opened[0]
+
+        path = os.path.join(tmppath, "geodb", "extracted", "geodblite.mmdb")
+        shutil.copy(path, path + ".new")
+        os.rename(path + ".new", path)
+        GeoInfo.last_version_check = 0
+
+        GeoInfo.ipv4info("93.184.216.34")
+        assert GeoInfo.opened[0] is not reader
+        assert GeoInfo.cache_stats()["size"] == 1
+
+        # Threads that still use the previous reader can finish lookups,
+        # but their results are not cached
+        assert GeoInfo._lookup(reader, "8.8.8.8") == GeoInfo.ipv4info(
+            "8.8.8.8"
+        )
+        GeoInfo._lookup(reader, "1.1.1.1")
+        assert GeoInfo.cache_stats()["size"] == 2
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.lookup("d", "c") == 3
+    assert cache.lookup("d", "e") is None
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 2}
+
 def test_get_ipv4_hostname():
     ip = get_ipv4_hostname("example.com")
     assert ip == "93.184.216.34"
@@ -107,6 +225,56 @@ def test_get_ipv4_hostname_invalid():
     ip = get_ipv4_hostname("nonexisting.stuff.tosti")
     assert ip is None
 
+@mock.patch("socks5man.helpers.socket.gethostbyname")
+def test_resolver_cache(mg):
+    mg.return_value = "93.184.216.34"
+    resolver = Resolver(ttl=300)
+    assert resolver.resolve("example.com") == "93.184.216.34"
+    assert resolver.resolve("example.com") == "93.184.216.34"
+    mg.assert_called_once_with("example.com")
+
+@mock.patch("time.time")
+@mock.patch("socks5man.helpers.socket.gethostbyname")
+def test_resolver_ttl(mg, mt):
+    mg.side_effect = "93.184.216.34", socket.gaierror, "93.184.216.35"
+    mt.return_value = 1000
+    resolver = Resolver(ttl=300, negative_ttl=10)
+    assert resolver.resolve("example.com") == "93.184.216.34"
+    mt.return_value = 1301
+    assert resolver.resolve("example.com") is None
+    mt.return_value = 1305
+    assert resolver.resolve("example.com") is None
+    mt.return_value = 1312
+    assert resolver.resolve("example.com") == "93.184.216.35"
+    assert mg.call_count == 3
+
+@mock.patch("socks5man.helpers.socket.gethostbyname")
+def test_resolver_resolve_many(mg):
+    ips = {"a.example.com": "1.1.1.1", "b.example.com": "2.2.2.2"}
+    def gethostbyname(hostname):
+        if hostname not in ips:
+            raise socket.gaierror
+        return ips[hostname]
+    mg.side_effect = gethostbyname
+    resolver = Resolver(workers=4)
+    res = resolver.resolve_many([
+        "a.example.com", "b.example.com", "a.example.com", "8.8.8.8",
+        "nonexisting.tosti"
+    ])
+    assert res == {
+        "a.example.com": "1.1.1.1", "b.example.com": "2.2.2.2",
+        "8.8.8.8": "8.8.8.8", "nonexisting.tosti": None
+    }
+    assert mg.call_count == 3
+    assert resolver.resolve("b.example.com") == "2.2.2.2"
+    assert mg.call_count == 3
+
+def test_resolver_aresolve():
+    resolver = Resolver()
+    resolver._store("example.com", "93.184.216.34")
+    assert aiosocks5.run(resolver.aresolve("example.com")) == "93.184.216.34"
+    assert aiosocks5.run(resolver.aresolve("localhost")) == "127.0.0.1"
+
 def test_validify_host_port():
     res = validify_host_port("8.8.8.8", 4000)
     assert res.ip == "8.8.8.8"
@@ -134,133 +302,194 @@ def test_validify_host_port():
     res11 = validify_host_port(None, 8132)
     assert res11 is None
 
-@mock.patch("socks5man.helpers.socket")
-@mock.patch("urllib.request.urlopen")
-@mock.patch("socks5man.helpers.socks")
-def test_get_over_socks5(ms, mu, mss):
-    mss.socket = "DOGE"
-    mss._socketobject = "socket"
-    httpresponse = mock.MagicMock()
-    httpresponse.read.return_value = "many content, such wow"
-    mu.return_value = httpresponse
-    ms.socksocket = "socksocket"
+@mock.patch("socks5man.helpers.aiosocks5.http_get")
+def test_get_over_socks5(mh):
+    mh.return_value = b"many content, such wow"
     res = get_over_socks5(
         "http://example.com", "8.8.8.8", 1337, username="many",
         password="doge", timeout=10
     )
-    ms.set_default_proxy.assert_called_once_with(
-        ms.SOCKS5, "8.8.8.8", 1337, username="many", password="doge"
+    mh.assert_called_once_with(
+        "http://example.com", "8.8.8.8", 1337, username="many",
+        password="doge"
     )
-    mu.assert_called_once_with("http://example.com", timeout=10)
-    assert res == "many content, such wow"
-    assert mss.socket == "DOGE"
-
-@mock.patch("socks5man.helpers.socket")
-@mock.patch("urllib.request.urlopen")
-@mock.patch("socks5man.helpers.socks")
-def test_get_over_socks5_fail(ms, mu, mss):
-    mss.socket = "DOGE"
-    mss._socketobject = "socket"
-    httpresponse = mock.MagicMock()
-    httpresponse.read.side_effect = urllib.error.URLError("Error")
-    mu.return_value = httpresponse
-    ms.socksocket = "socksocket"
+    assert res == b"many content, such wow"
+
+@mock.patch("socks5man.helpers.aiosocks5.http_get")
+def test_get_over_socks5_fail(mh):
+    mh.side_effect = Socks5ClientError("Error")
     res = get_over_socks5(
         "http://example.com", "8.8.8.8", 1337, username="many",
         password="doge", timeout=10
     )
     assert res is None
-    assert mss.socket == "DOGE"
 
-@mock.patch("time.time")
+@mock.patch("socks5man.helpers.aiosocks5.http_get")
+def test_get_over_socks5_timeout(mh):
+    async def slow(*args, **kwargs):
+        await asyncio.sleep(10)
+    mh.side_effect = slow
+    res = get_over_socks5(
+        "http://example.com", "8.8.8.8", 1337, timeout=0.01
+    )
+    assert res is None
+
+class FakeResponse(object):
+    """HTTPResponse of which each read takes 0.1 second on the given clock"""
+
+    def __init__(self, clock, size):
+        self.clock = clock
+        self.remaining = size
+        self.received = 0
+        self.closed = False
+
+    async def read(self, size=65536):
+        data = b"A" * min(size, self.remaining)
+        self.remaining -= len(data)
+        self.received += len(data)
+        self.clock[0] += 0.1
+        return data
+
+    def close(self):
+        self.closed = True
+
+def fake_download(size):
+    clock = [0]
+    response = FakeResponse(clock, size)
+
+    async def http_open(*args, **kwargs):
+        clock[0] += 0.5
+        return response
+    return clock, response, http_open
+
+def test_measure_download():
+    clock, response, http_open = fake_download(1000000)
+    with mock.patch("socks5man.helpers.aiosocks5.http_open", http_open), \
+            mock.patch("time.time", lambda: clock[0]):
+        mbps, ttfb = aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337,
+            chunk_size=100000
+        ))
+    assert ttfb == pytest.approx(0.6)
+    # 900000 bytes after the first chunk in 0.9 seconds
+    assert mbps == pytest.approx(8.8)
+    assert response.received == 1000000
+    assert response.closed
+
+def test_measure_download_max_bytes():
+    clock, response, http_open = fake_download(10000000)
+    with mock.patch("socks5man.helpers.aiosocks5.http_open", http_open), \
+            mock.patch("time.time", lambda: clock[0]):
+        mbps, ttfb = aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337,
+            chunk_size=100000, max_bytes=450000
+        ))
+    assert response.received == 450000
+    assert ttfb == pytest.approx(0.6)
+
+def test_measure_download_max_time():
+    clock, response, http_open = fake_download(10000000)
+    with mock.patch("socks5man.helpers.aiosocks5.http_open", http_open), \
+            mock.patch("time.time", lambda: clock[0]):
+        mbps, ttfb = aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337,
+            chunk_size=100000, max_time=0.25
+        ))
+    assert response.received == 400000
+    assert mbps == pytest.approx(8.8)
+
+def test_measure_download_single_chunk():
+    clock, response, http_open = fake_download(50000)
+    with mock.patch("socks5man.helpers.aiosocks5.http_open", http_open), \
+            mock.patch("time.time", lambda: clock[0]):
+        mbps, ttfb = aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337,
+            chunk_size=100000
+        ))
+    assert mbps == pytest.approx(calculate_mbps(50000, 0.6))
+
+def test_measure_download_fail():
+    clock, response, http_open = fake_download(0)
+    with mock.patch("socks5man.helpers.aiosocks5.http_open", http_open):
+        assert aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337
+        )) is None
+    assert response.closed
+
+    with mock.patch("socks5man.helpers.aiosocks5.http_open") as mh:
+        mh.side_effect = Socks5ClientError
+        assert aiosocks5.run(ameasure_download(
+            "http://example.com/1MB.bin", "8.8.8.8", 1337
+        )) is None
+
+def test_measure_download_socks5():
+    fake = FakeSocks5(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 300000\r\n\r\n" +
+        b"A" * 300000
+    )
+
+    async def download():
+        port = await fake.start()
+        try:
+            return await ameasure_download(
+                "http://example.com/1MB.bin", "127.0.0.1", port,
+                max_bytes=100000, chunk_size=1000
+            )
+        finally:
+            fake.stop()
+
+    mbps, ttfb = aiosocks5.run(download())
+    assert mbps > 0
+    assert ttfb > 0
+
 @mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_8(mg, mc, mt):
-    data = "A"*1000000
-    mg.side_effect = data, data
+@mock.patch("socks5man.helpers.ameasure_download")
+def test_approximate_bandwidth_8(md, mc):
+    md.side_effect = (8, 0.2), (8, 0.4)
     mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 2, 1, 2
     speed = approximate_bandwidth(
         "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10,
         times=2
     )
-    mg.assert_any_call(
+    md.assert_any_call(
         "http://example.com/1MB.bin", "8.8.8.8", 1337, username="doge",
-        password="suchwow", timeout=10
+        password="suchwow", timeout=10, max_bytes=None, max_time=None,
+        chunk_size=65536
     )
-    assert mg.call_count == 2
+    assert md.call_count == 2
     assert speed == 8
 
-@mock.patch("time.time")
 @mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_25_45(mg, mc, mt):
-    data = "A"*1000000
-    mg.side_effect = data, data
+@mock.patch("socks5man.helpers.ameasure_download")
+def test_measure_bandwidth_ttfb(md, mc):
+    md.side_effect = (8, 0.2), (10, 0.4)
     mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 1.55, 1, 1.22
-    speed = approximate_bandwidth(
-        "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10
+    speed, ttfb = measure_bandwidth(
+        "8.8.8.8", 1337, times=2, max_bytes=1000, max_time=2,
+        chunk_size=100
     )
-    assert round(speed, 2) == 25.45
-
-@mock.patch("time.time")
-@mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_instant(mg, mc, mt):
-    data = "A"*1000000
-    mg.side_effect = data, data
-    mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 1, 1, 1
-    speed = approximate_bandwidth(
-        "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10
+    md.assert_any_call(
+        "http://example.com/1MB.bin", "8.8.8.8", 1337, username=None,
+        password=None, timeout=10, max_bytes=1000, max_time=2,
+        chunk_size=100
     )
-    assert speed == 8000
+    assert speed == 9
+    assert ttfb == pytest.approx(0.3)
 
-@mock.patch("time.time")
 @mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_0_87(mg, mc, mt):
-    data = "A"*1000000
-    mg.side_effect = data, data
+@mock.patch("socks5man.helpers.ameasure_download")
+def test_approximate_bandwidth_maxfail(md, mc):
+    md.side_effect = None, (0.88, 0.2)
     mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 10.1, 1, 10.2
-    speed = approximate_bandwidth(
-        "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10
-    )
-    assert round(speed, 2) == 0.87
-
-@mock.patch("time.time")
-@mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_maxfail(mg, mc, mt):
-    data = "A"*1000000
-    mg.side_effect = None, data
-    mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 1, 10.1
     speed = approximate_bandwidth(
         "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10
     )
     assert round(speed, 2) == 0.44
 
-@mock.patch("time.time")
-@mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_smallfile(mg, mc, mt):
-    data = "A"*100000
-    mg.side_effect = data, data
-    mc.return_value = "http://example.com/1MB.bin"
-    mt.side_effect = 1, 1, 1, 1
-    speed = approximate_bandwidth(
-        "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10
-    )
-    assert speed == 880.0
-
-@mock.patch("time.time")
 @mock.patch("socks5man.helpers.cfg")
-@mock.patch("socks5man.helpers.get_over_socks5")
-def test_approximate_bandwidth_failed(mg, mc, mt):
-    mg.side_effect = None, None
+@mock.patch("socks5man.helpers.ameasure_download")
+def test_approximate_bandwidth_failed(md, mc):
+    md.side_effect = None, None
     mc.return_value = "http://example.com/1MB.bin"
     speed = approximate_bandwidth(
         "8.8.8.8", 1337, username="doge", password="suchwow", timeout=10,
@@ -268,3 +497,9 @@ def test_approximate_bandwidth_failed(mg, mc, mt):
     )
     assert speed is None
 
+def test_calculate_mbps():
+    assert calculate_mbps(1000000, 1) == 8
+    assert round(calculate_mbps(1000000, 0.22), 2) == 36.36
+    assert calculate_mbps(1000000, 0) == 8000
+    assert calculate_mbps(100000, 0) == 880.0
+
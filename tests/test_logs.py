@@ -2,11 +2,12 @@ from __future__ import absolute_import
 import logging
 import mock
 import os
+import sys
 import tempfile
 
 log = logging.getLogger(__name__)
 
-from socks5man.logs import init_loggers
+from socks5man.logs import ConsoleHandler, init_loggers, log_to_stderr
 from socks5man.misc import set_cwd
 
 @mock.patch("socks5man.logs.red")
@@ -21,3 +22,12 @@ def test_init_logger(my, mr):
     assert os.path.isfile(os.path.join(tmpdir, "socks5man.log"))
     my.assert_called_once()
     mr.assert_called_once()
+
+def test_log_to_stderr():
+    handler = ConsoleHandler(sys.stdout)
+    logging.getLogger().addHandler(handler)
+    try:
+        log_to_stderr()
+        assert handler.stream is sys.stderr
+    finally:
+        logging.getLogger().removeHandler(handler)
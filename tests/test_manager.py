@@ -1,11 +1,15 @@
 from __future__ import absolute_import
 import datetime
+import mock
 import pytest
+import threading
 
+from socks5man import metrics
 from socks5man.database import Database
 from socks5man.exceptions import Socks5CreationError
 from socks5man.manager import Manager
 from socks5man.misc import set_cwd, create_cwd, cwd
+from socks5man.policies import Policy
 from socks5man.socks5 import Socks5
 
 from tests.helpers import CleanedTempFile
@@ -46,6 +50,150 @@ class TestManager(object):
         assert socks5_4.id == 1
         assert socks5_4.last_use > socks5_1.last_use
 
+    def test_acquire_pool(self):
+        create_cwd(cwd())
+        for c in ["United States", "China", "Germany"]:
+            self.db.add_socks5(
+                "8.8.8.8", 1337, c, "Unknown", operational=True
+            )
+        m = Manager(pool=True)
+        try:
+            assert [m.acquire().id for _ in range(4)] == [1, 2, 3, 1]
+            assert m.acquire(country="germany").id == 3
+            assert m.acquire(country="france") is None
+            assert m.acquire(update_usage=False).id == 2
+        finally:
+            m.close()
+        assert self.db.view_socks5(1).last_use is not None
+        assert self.db.view_socks5(3).last_use > self.db.view_socks5(1).last_use
+
+    def test_acquire_lease(self):
+        create_cwd(cwd())
+        for c in ["United States", "Germany"]:
+            self.db.add_socks5(
+                "8.8.8.8", 1337, c, "Unknown", operational=True
+            )
+        m = Manager()
+        with m.acquire(country="germany", lease=True) as socks5:
+            assert socks5.id == 2
+            assert socks5.last_use is not None
+            assert self.db.count_leases(2) == 1
+        assert self.db.count_leases() == 0
+
+        leased = [m.acquire(lease=True) for _ in range(8)]
+        assert sorted(s.id for s in leased) == [1, 1, 1, 1, 2, 2, 2, 2]
+        assert m.acquire(lease=True) is None
+        leased[0].release()
+        assert m.acquire(lease=True).id == leased[0].id
+
+    def test_acquire_metrics(self):
+        def acquires(result):
+            return metrics.ACQUIRES.get(source="database", result=result)
+
+        found, none = acquires("found"), acquires("none")
+        count = metrics.ACQUIRE_DURATION.get(source="database")[0]
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        m = Manager()
+        assert m.acquire() is not None
+        assert m.acquire(country="France") is None
+        assert acquires("found") == found + 1
+        assert acquires("none") == none + 1
+        assert metrics.ACQUIRE_DURATION.get(
+            source="database"
+        )[0] == count + 2
+
+    def test_acquire_policy(self):
+        create_cwd(cwd())
+        for i in range(3):
+            self.db.add_socks5("8.8.8.8", i, "Germany", "DE", operational=True)
+        self.db.set_approx_bandwidth(3, 100)
+        self.db.set_connect_time(3, 0.01)
+        m = Manager()
+        socks5 = m.acquire(policy="weighted_random")
+        assert socks5.last_use is not None
+        assert self.db.view_socks5(socks5.id).last_use == socks5.last_use
+        # Round robin ignores the bandwidth
+        assert m.acquire(policy="round_robin").id != socks5.id
+
+        with pytest.raises(ValueError):
+            m.acquire(policy="doge")
+        assert m.acquire(country="france", policy="power_of_two") is None
+
+    def test_acquire_policy_claimed(self):
+        create_cwd(cwd())
+        for i in range(3):
+            self.db.add_socks5("8.8.8.8", i, "Germany", "DE", operational=True)
+        db = self.db
+        class ClaimedByOther(Policy):
+            def choose(self, candidates):
+                # Another caller uses the chosen socks5 in the meantime
+                if candidates[0].id == 1:
+                    db.mark_used(1)
+                return candidates[0]
+
+        m = Manager()
+        assert m.acquire(policy=ClaimedByOther()).id == 2
+        assert self.db.view_socks5(2).last_use is not None
+
+    def test_acquire_policy_concurrent(self):
+        create_cwd(cwd())
+        for i in range(30):
+            self.db.add_socks5("8.8.8.8", i, "Germany", "DE", operational=True)
+        class First(Policy):
+            def choose(self, candidates):
+                return candidates[0]
+
+        m = Manager()
+        acquired = []
+        def acquire():
+            acquired.append(m.acquire(policy=First()).id)
+
+        threads = [threading.Thread(target=acquire) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(acquired)) == 20
+
+    def test_acquire_pool_policy(self):
+        create_cwd(cwd())
+        for i in range(3):
+            self.db.add_socks5("8.8.8.8", i, "Germany", "DE", operational=True)
+        seen = []
+        class Last(Policy):
+            def choose(self, candidates):
+                seen.append([c.id for c in candidates])
+                return candidates[-1]
+
+        policy = Last()
+        m = Manager(pool=True)
+        try:
+            assert m.acquire(policy=policy).id == 3
+            assert seen == [[1, 2, 3]]
+            # The most recently used socks5 is the last candidate
+            assert m.acquire(policy=policy).id == 3
+            assert m.acquire().id == 1
+        finally:
+            m.close()
+
+    def test_acquire_many(self):
+        for c in ["DE", "DE", "US", "US", "NL"]:
+            self.db.add_socks5("8.8.8.8", 1337, "Unknown", c, operational=True)
+        m = Manager()
+        socks5s = m.acquire_many(3)
+        assert sorted(s.id for s in socks5s) == [1, 2, 3]
+        assert all(isinstance(s, Socks5) for s in socks5s)
+        assert sorted(s.id for s in m.acquire_many(3)) == [1, 4, 5]
+
+        socks5s = m.acquire_many(quotas={"DE": 1, "US": 2})
+        assert sorted(s.country_code for s in socks5s) == ["DE", "US", "US"]
+        socks5s = m.acquire_many(4, quotas={"US": 2})
+        assert sorted(s.country_code for s in socks5s) == [
+            "DE", "NL", "US", "US"
+        ]
+        with pytest.raises(ValueError):
+            m.acquire_many(1, quotas={"DE": 2})
+
     def test_acquire_country(self):
         for c in ["United States", "China", "Germany"]:
             self.db.add_socks5(
@@ -402,6 +550,46 @@ class TestManager(object):
         allsocks = self.db.list_socks5()
         assert allsocks[0].dnsport == 5050
 
+    def test_bulk_add_batches(self):
+        create_cwd(path=cwd())
+        servers = (
+            {"host": "8.8.8.%s" % i, "port": 4242} for i in range(25)
+        )
+        progress = []
+        m = Manager()
+        with mock.patch.object(
+                self.db, "bulk_add_socks5", wraps=self.db.bulk_add_socks5
+        ) as mb:
+            count = m.bulk_add(
+                servers, batch_size=10,
+                progress=lambda a, p: progress.append((a, p))
+            )
+            assert mb.call_count == 3
+        assert count == 25
+        assert progress == [(10, 10), (20, 20), (25, 25)]
+        assert len(self.db.list_socks5()) == 25
+        assert self.db.view_socks5(1).country == "United States"
+
+    def test_bulk_add_rejects(self):
+        create_cwd(path=cwd())
+        servers = [
+            {"host": "8.8.8.8", "port": 4242},
+            {"port": 4242},
+            {"host": "8.8.8.9", "port": 4242, "username": "doge"},
+            {"host": "8.8.8.10", "port": 99999},
+            {"host": "8.8.8.11", "port": "4242"},
+        ]
+        rejects = []
+        m = Manager()
+        count = m.bulk_add(
+            iter(servers), on_reject=lambda *r: rejects.append(r)
+        )
+        assert count == 2
+        assert [(r[0], r[1]) for r in rejects] == [
+            (2, servers[1]), (3, servers[2]), (4, servers[3])
+        ]
+        assert self.db.view_socks5(2).port == 4242
+
     def test_bulk_add_nonew(self):
         create_cwd(path=cwd())
         servers = [
@@ -455,6 +643,44 @@ class TestManager(object):
         for s in all_socks:
             assert isinstance(s, Socks5)
 
+    def test_list_socks5_pages(self):
+        for x in range(5):
+            self.db.add_socks5("8.8.8.8", x, "germany", "DE")
+        m = Manager()
+        assert [s.id for s in m.list_socks5(limit=2, after_id=1)] == [2, 3]
+
+    def test_iter_socks5(self):
+        for x in range(5):
+            self.db.add_socks5(
+                "8.8.8.8", x, "germany", "DE", operational=x != 2
+            )
+        m = Manager()
+        with mock.patch.object(
+                m, "list_socks5", wraps=m.list_socks5
+        ) as ml:
+            assert [s.id for s in m.iter_socks5(page_size=2)] == [
+                1, 2, 3, 4, 5
+            ]
+            assert ml.call_count == 3
+
+        assert [
+            s.id for s in m.iter_socks5(operational=True, page_size=2)
+        ] == [1, 2, 4, 5]
+        assert [
+            s.id for s in m.iter_socks5(limit=3, after_id=1, page_size=2)
+        ] == [2, 3, 4]
+        assert [s.id for s in m.iter_socks5(limit=0)] == []
+        assert all(isinstance(s, Socks5) for s in m.iter_socks5())
+
+    def test_count_socks5(self):
+        for x in range(3):
+            self.db.add_socks5("8.8.8.8", x, "germany", "DE")
+        self.db.add_socks5("8.8.8.8", 4, "france", "FR", operational=True)
+        m = Manager()
+        assert m.count_socks5() == 4
+        assert m.count_socks5(country="germany") == 3
+        assert m.count_socks5(operational=True) == 1
+
     def test_list_socks5_description(self):
         for x in range(3):
             self.db.add_socks5(
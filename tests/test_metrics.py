@@ -0,0 +1,283 @@
+from __future__ import absolute_import
+import asyncio
+import mock
+import os
+import pytest
+import socket
+import urllib.request
+
+from socks5man import metrics
+from socks5man.database import Database, collect_socks5_counts
+from socks5man.helpers import collect_geoip_cache
+from socks5man.metrics import (
+    Counter, Gauge, Histogram, Registry, Exporter, start_exporter, timed,
+    write_textfile
+)
+from socks5man.config import Config
+from socks5man.exceptions import Socks5ConfigError
+from socks5man.misc import set_cwd, create_cwd, cwd
+
+from tests.helpers import CleanedTempFile
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        c = Counter(
+            "test_total", "Test counter", ("result",),
+            registry=self.registry
+        )
+        c.inc(result="ok")
+        c.inc(2, result="ok")
+        c.inc(result="failed")
+        assert c.get(result="ok") == 3
+        assert c.get(result="unknown") == 0
+        assert self.registry.render() == (
+            "# HELP test_total Test counter\n"
+            "# TYPE test_total counter\n"
+            "test_total{result=\"failed\"} 1\n"
+            "test_total{result=\"ok\"} 3\n"
+        )
+
+    def test_gauge(self):
+        g = Gauge("test_gauge", "Test gauge", registry=self.registry)
+        g.set(5)
+        g.inc()
+        g.dec(2.5)
+        assert g.get() == 3.5
+        assert "test_gauge 3.5\n" in self.registry.render()
+
+    def test_labels_required(self):
+        c = Counter(
+            "test_total", "Test", ("result",), registry=self.registry
+        )
+        with pytest.raises(ValueError):
+            c.inc()
+        with pytest.raises(ValueError):
+            c.inc(result="ok", other="label")
+
+    def test_label_escaping(self):
+        c = Counter("test_total", "Test", ("name",), registry=self.registry)
+        c.inc(name="a\"b\\c\nd")
+        assert "test_total{name=\"a\\\"b\\\\c\\nd\"} 1" in \
+            self.registry.render()
+
+    def test_histogram(self):
+        h = Histogram(
+            "test_seconds", "Test histogram", ("probe",),
+            buckets=(0.1, 1, 10), registry=self.registry
+        )
+        for value in (0.05, 0.1, 0.5, 20):
+            h.observe(value, probe="connect")
+
+        assert h.get(probe="connect") == (4, 20.65)
+        lines = self.registry.render().splitlines()
+        assert lines[1] == "# TYPE test_seconds histogram"
+        assert lines[2:] == [
+            "test_seconds_bucket{probe=\"connect\",le=\"0.1\"} 2",
+            "test_seconds_bucket{probe=\"connect\",le=\"1\"} 3",
+            "test_seconds_bucket{probe=\"connect\",le=\"10\"} 3",
+            "test_seconds_bucket{probe=\"connect\",le=\"+Inf\"} 4",
+            "test_seconds_count{probe=\"connect\"} 4",
+            "test_seconds_sum{probe=\"connect\"} 20.65",
+        ]
+
+    def test_histogram_time(self):
+        h = Histogram("test_seconds", "Test", registry=self.registry)
+        with h.time():
+            pass
+        assert h.get()[0] == 1
+
+    def test_timed(self):
+        h = Histogram(
+            "test_seconds", "Test", ("query",), registry=self.registry
+        )
+
+        @timed(h, query="find")
+        def find(value):
+            """Find docs"""
+            return value
+
+        @timed(h, query="fail")
+        def fail():
+            raise RuntimeError()
+
+        assert find(1) == 1
+        assert find.__doc__ == "Find docs"
+        with pytest.raises(RuntimeError):
+            fail()
+        assert h.get(query="find")[0] == 1
+        assert h.get(query="fail")[0] == 1
+
+    def test_timed_async(self):
+        h = Histogram("test_seconds", "Test", registry=self.registry)
+
+        @timed(h)
+        async def probe():
+            await asyncio.sleep(0.01)
+            return True
+
+        assert asyncio.iscoroutinefunction(probe)
+        assert asyncio.new_event_loop().run_until_complete(probe())
+        count, total = h.get()
+        assert count == 1
+        assert total >= 0.01
+
+    def test_collectors(self):
+        def collector():
+            return [("test_items", "gauge", "Items", [
+                ("test_items", [("kind", "a")], 2)
+            ])]
+
+        def broken():
+            raise RuntimeError("broken")
+
+        self.registry.register_collector(broken)
+        self.registry.register_collector(collector)
+        assert self.registry.render() == (
+            "# HELP test_items Items\n"
+            "# TYPE test_items gauge\n"
+            "test_items{kind=\"a\"} 2\n"
+        )
+
+    def test_default_metrics(self):
+        rendered = metrics.REGISTRY.render()
+        for name in (
+                "socks5man_verifications_total",
+                "socks5man_probe_duration_seconds",
+                "socks5man_acquire_duration_seconds",
+                "socks5man_db_query_duration_seconds",
+                "socks5man_geoip_cache_hits_total"
+        ):
+            assert "# TYPE %s " % name in rendered
+
+    def test_collect_geoip_cache(self):
+        stats = {"size": 3, "maxsize": 10, "hits": 7, "misses": 3}
+        with mock.patch(
+                "socks5man.helpers.GeoInfo.cache_stats", return_value=stats
+        ):
+            families = dict((f[0], f[3]) for f in collect_geoip_cache())
+
+        assert families["socks5man_geoip_cache_hits_total"][0][2] == 7
+        assert families["socks5man_geoip_cache_misses_total"][0][2] == 3
+        assert families["socks5man_geoip_cache_entries"][0][2] == 3
+
+class TestExporter(object):
+
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        self.registry = Registry()
+        Counter(
+            "test_total", "Test", registry=self.registry
+        ).inc()
+
+    def test_write_textfile(self):
+        path = os.path.join(self.tempfile.mkdtemp(), "socks5man.prom")
+        write_textfile(path, self.registry)
+        with open(path, "r") as fp:
+            assert fp.read() == self.registry.render()
+        assert os.listdir(os.path.dirname(path)) == ["socks5man.prom"]
+
+    def test_http(self):
+        exporter = Exporter(
+            host="127.0.0.1", port=free_port(), textfile="",
+            textfile_interval=1, registry=self.registry
+        )
+        port = exporter.start()
+        try:
+            res = urllib.request.urlopen(
+                "http://127.0.0.1:%s/metrics" % port, timeout=5
+            )
+            assert res.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert res.read().decode("utf-8") == self.registry.render()
+
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(
+                    "http://127.0.0.1:%s/other" % port, timeout=5
+                )
+        finally:
+            exporter.close()
+
+    def test_textfile(self):
+        path = os.path.join(self.tempfile.mkdtemp(), "socks5man.prom")
+        exporter = Exporter(
+            host="127.0.0.1", port=0, textfile=path, textfile_interval=60,
+            registry=self.registry
+        )
+        assert exporter.start() is None
+        exporter.close()
+        with open(path, "r") as fp:
+            assert "test_total 1\n" in fp.read()
+
+    def test_start_exporter_disabled(self):
+        set_cwd(self.tempfile.mkdtemp())
+        create_cwd()
+        # Configs created before metrics existed have no [metrics] section
+        with open(cwd("conf", "socks5man.conf"), "w") as fw:
+            fw.write("[socks5man]\nverify_interval = 300\n")
+        Config._cache = {}
+        assert start_exporter() is None
+
+        with mock.patch(
+                "socks5man.metrics.cfg",
+                side_effect=Socks5ConfigError("No [metrics] section")
+        ):
+            assert start_exporter() is None
+
+class TestDatabaseMetrics(object):
+
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        self.db = Database()
+        self.db.connect(create=True)
+
+    def test_collect_socks5_counts(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        self.db.add_socks5("8.8.8.8", 2, "Germany", "DE", operational=True)
+        self.db.add_socks5("8.8.8.8", 3, "Germany", "DE")
+        self.db.add_socks5("8.8.8.8", 4, "France", "FR")
+
+        assert sorted(self.db.count_by_state()) == [
+            ("DE", False, 1), ("DE", True, 2), ("FR", False, 1)
+        ]
+        (name, metric_type, _, samples), = collect_socks5_counts()
+        assert name == "socks5man_socks5s"
+        assert metric_type == "gauge"
+        assert sorted(samples) == [
+            ("socks5man_socks5s", [
+                ("country_code", "DE"), ("operational", "false")
+            ], 1),
+            ("socks5man_socks5s", [
+                ("country_code", "DE"), ("operational", "true")
+            ], 2),
+            ("socks5man_socks5s", [
+                ("country_code", "FR"), ("operational", "false")
+            ], 1),
+        ]
+
+    def test_find_socks5_timed(self):
+        before = metrics.DB_QUERY_DURATION.get(query="find_socks5")[0]
+        self.db.find_socks5()
+        assert metrics.DB_QUERY_DURATION.get(
+            query="find_socks5"
+        )[0] == before + 1
@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+import mock
+import pytest
+
+from socks5man.policies import (
+    get_policy, score, RoundRobin, WeightedRandom, PowerOfTwoChoices,
+    LeastRecentlyFailed
+)
+
+def candidate(id, bandwidth=None, connect_time=None, last_failure=None):
+    return mock.MagicMock(
+        id=id, bandwidth=bandwidth, connect_time=connect_time,
+        last_failure=last_failure
+    )
+
+def test_score():
+    assert score(candidate(1, 10, 0.5)) == 20
+    assert score(candidate(1)) == 1
+    assert score(candidate(1, 10, 0)) == 10
+
+def test_round_robin():
+    candidates = [candidate(1), candidate(2)]
+    assert RoundRobin().choose(candidates).id == 1
+    assert not RoundRobin.uses_candidates
+
+def test_weighted_random():
+    candidates = [candidate(1, 100, 0.1), candidate(2, 1, 1)]
+    policy = WeightedRandom(rng=random.Random(42))
+    chosen = Counter(policy.choose(candidates).id for _ in range(1000))
+    assert chosen[1] > 950
+    assert chosen[2] > 0
+
+def test_power_of_two():
+    candidates = [candidate(1, 1, 1), candidate(2, 50, 0.1), candidate(3)]
+    policy = PowerOfTwoChoices(rng=random.Random(42))
+    chosen = Counter(policy.choose(candidates).id for _ in range(300))
+    # The best server wins every comparison it is part of
+    assert chosen[2] > 150
+    assert PowerOfTwoChoices().choose([candidate(1)]).id == 1
+
+def test_least_recently_failed():
+    now = datetime.now()
+    candidates = [
+        candidate(1, last_failure=now - timedelta(minutes=5)),
+        candidate(2, last_failure=now - timedelta(hours=1)),
+        candidate(3, last_failure=now)
+    ]
+    assert LeastRecentlyFailed().choose(candidates).id == 2
+    # Socks5s that never failed are chosen first
+    candidates += [candidate(4), candidate(5)]
+    assert LeastRecentlyFailed().choose(candidates).id == 4
+
+def test_get_policy():
+    assert isinstance(get_policy("weighted_random"), WeightedRandom)
+    policy = PowerOfTwoChoices()
+    assert get_policy(policy) is policy
+    with pytest.raises(ValueError):
+        get_policy("doge")
+
+@mock.patch("socks5man.policies.cfg")
+def test_get_policy_config(mc):
+    mc.return_value = "least_recently_failed"
+    assert isinstance(get_policy(), LeastRecentlyFailed)
+    mc.assert_called_once_with("socks5man", "policy")
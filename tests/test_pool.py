@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+import datetime
+
+from socks5man.database import Database
+from socks5man.misc import set_cwd
+from socks5man.pool import Socks5Pool
+
+from tests.helpers import CleanedTempFile
+
+class TestSocks5Pool(object):
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        self.db = Database()
+        self.db.connect(create=True)
+        self.pool = Socks5Pool(
+            sync_interval=60, refresh_interval=60, max_age=600
+        )
+
+    def test_acquire_order(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        s2 = self.db.add_socks5("8.8.8.8", 2, "Germany", "DE")
+        self.db.add_socks5("8.8.8.8", 3, "Germany", "DE", operational=True)
+        self.db.set_operational(s2, True)
+        self.pool.load()
+
+        expected = [
+            s.id for s in self.db.find_socks5(update_usage=False, limit=3)
+        ]
+        assert expected[0] == s2
+        assert [self.pool.acquire().id for _ in range(6)] == expected * 2
+
+    def test_acquire_filters(self):
+        self.db.add_socks5(
+            "8.8.8.8", 1, "Germany", "DE", city="Berlin", operational=True
+        )
+        s2 = self.db.add_socks5(
+            "8.8.8.8", 2, "France", "FR", city="Paris", operational=True
+        )
+        s3 = self.db.add_socks5(
+            "8.8.8.8", 3, "France", "FR", city="Paris", operational=True
+        )
+        self.db.add_socks5("8.8.8.8", 4, "France", "FR")
+        self.db.set_approx_bandwidth(s3, 20)
+        self.db.set_connect_time(s2, 0.1)
+        self.pool.load()
+
+        assert self.pool.acquire(country="germany").id == 1
+        assert self.pool.acquire(country="Belgium") is None
+        assert self.pool.acquire(country_code="fr", min_mbps_down=10).id == s3
+        assert self.pool.acquire(city="paris", max_connect_time=0.5).id == s2
+        # Usage through other filters counts, s3 was used before s2
+        assert self.pool.acquire(country="france").id == s3
+        assert self.pool.acquire(country="france").id == s2
+
+    def test_acquire_no_usage_update(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        self.db.add_socks5("8.8.8.8", 2, "Germany", "DE", operational=True)
+        self.pool.load()
+        assert self.pool.acquire(update_usage=False).id == 1
+        assert self.pool.acquire(update_usage=False).id == 1
+        assert self.pool.pending == {}
+
+    def test_flush(self):
+        s1 = self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        self.pool.load()
+        past = datetime.datetime.now()
+        self.pool.acquire()
+        assert self.db.view_socks5(s1).last_use is None
+        self.pool.flush()
+        assert self.db.view_socks5(s1).last_use > past
+        assert self.pool.pending == {}
+
+    def test_refresh_on_operational_change(self):
+        s1 = self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        s2 = self.db.add_socks5("8.8.8.8", 2, "Germany", "DE")
+        self.pool.load()
+        assert self.pool.acquire().id == s1
+        assert self.pool.acquire().id == s1
+
+        self.db.set_operational(s2, True)
+        self.pool.refresh_interval = 0
+        self.pool.sync()
+        assert self.pool.acquire().id == s2
+
+        self.db.set_operational(s1, False)
+        self.pool.sync()
+        assert self.pool.acquire().id == s2
+        assert s1 not in self.pool.socks5s
+
+    def test_load_keeps_pending_usage(self):
+        s1 = self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        s2 = self.db.add_socks5("8.8.8.8", 2, "Germany", "DE", operational=True)
+        self.pool.load()
+        assert self.pool.acquire().id == s1
+        self.pool.load()
+        assert self.pool.acquire().id == s2
+        assert set(self.pool.pending) == set([s1, s2])
+
+    def test_start_close(self):
+        s1 = self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", operational=True)
+        self.pool.start()
+        self.pool.acquire()
+        self.pool.close()
+        assert self.db.view_socks5(s1).last_use is not None
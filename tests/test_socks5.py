@@ -4,6 +4,7 @@ import mock
 import socket
 import sys
 
+from socks5man import aiosocks5
 from socks5man.database import Database
 from socks5man.misc import set_cwd, create_cwd, cwd
 from socks5man.socks5 import Socks5
@@ -89,6 +90,24 @@ class TestSocks5(object):
         db_socks5_2 = self.db.view_socks5(1)
         assert db_socks5_2.operational
 
+    @mock.patch("socks5man.socks5.get_over_socks5")
+    def test_verify_results_batch(self, mg):
+        create_cwd(cwd())
+        mg.return_value = b"8.8.8.8"
+        self.db.add_socks5(
+            "8.8.8.8", 1337, "germany", "DE", operational=False
+        )
+        results = mock.MagicMock()
+        s = Socks5(self.db.view_socks5(1), results=results)
+        assert s.verify()
+        results.add.assert_called_once_with(
+            1, operational=True, last_check=mock.ANY, lease_failures=0
+        )
+        assert isinstance(
+            results.add.call_args[1]["last_check"], datetime.datetime
+        )
+        assert not self.db.view_socks5(1).operational
+
     @mock.patch("socks5man.socks5.get_over_socks5")
     def test_verify_fail(self, mg):
         create_cwd(cwd())
@@ -119,6 +138,50 @@ class TestSocks5(object):
         db_socks5_2 = self.db.view_socks5(1)
         assert db_socks5_2.operational
 
+    @mock.patch("socks5man.socks5.aget_over_socks5")
+    def test_verify_async(self, mg):
+        create_cwd(cwd())
+        mg.return_value = b"8.8.8.8"
+        self.db.add_socks5(
+            "8.8.8.8", 1337, "germany", "DE",
+            city="Frankfurt", operational=False, username="doge",
+            password="wow", description="Such wow, many socks5"
+        )
+        s = Socks5(self.db.view_socks5(1))
+        assert aiosocks5.run(s.verify_async())
+        mg.assert_called_once_with(
+            "http://api.ipify.org", "8.8.8.8", 1337, username="doge",
+            password="wow", timeout=3
+        )
+        assert self.db.view_socks5(1).operational
+
+    @mock.patch("socks5man.socks5.aget_over_socks5")
+    def test_verify_async_fail(self, mg):
+        create_cwd(cwd())
+        mg.return_value = None
+        self.db.add_socks5(
+            "8.8.8.8", 1337, "germany", "DE", operational=True
+        )
+        s = Socks5(self.db.view_socks5(1))
+        assert not aiosocks5.run(s.verify_async())
+        assert not self.db.view_socks5(1).operational
+
+    @mock.patch("socks5man.socks5.ameasure_connect_time")
+    def test_measure_conn_time_async(self, mm):
+        create_cwd(cwd())
+        mm.return_value = 0.25
+        self.db.add_socks5(
+            "example.com", 1337, "germany", "DE", username="doge",
+            password="wow"
+        )
+        s = Socks5(self.db.view_socks5(1))
+        assert aiosocks5.run(s.measure_connection_time_async()) == 0.25
+        mm.assert_called_once_with(
+            "example.com", 1337, "api.ipify.org", 80, username="doge",
+            password="wow", timeout=3
+        )
+        assert self.db.view_socks5(1).connect_time == 0.25
+
     @mock.patch("socks5man.socks5.get_over_socks5")
     def test_verify_hostname(self, mg):
         create_cwd(cwd())
@@ -134,10 +197,10 @@ class TestSocks5(object):
         db_socks5_2 = self.db.view_socks5(1)
         assert db_socks5_2.operational
 
-    @mock.patch("socks5man.socks5.approximate_bandwidth")
+    @mock.patch("socks5man.socks5.measure_bandwidth")
     def test_approx_bandwidth(self, ma):
         create_cwd(cwd())
-        ma.return_value = 15.10
+        ma.return_value = 15.10, 0.3
         self.db.add_socks5(
             "example.com", 1337, "germany", "DE",
             city="Frankfurt", operational=False, username="doge",
@@ -149,12 +212,14 @@ class TestSocks5(object):
         assert res == 15.10
         ma.assert_called_once_with(
             "example.com", 1337, username="doge", password="wow",
-            times=2, timeout=10
+            times=2, timeout=10, max_bytes=5000000, max_time=5,
+            chunk_size=65536
         )
         db_socks5_2 = self.db.view_socks5(1)
         assert db_socks5_2.bandwidth == 15.10
+        assert db_socks5_2.ttfb == 0.3
 
-    @mock.patch("socks5man.socks5.approximate_bandwidth")
+    @mock.patch("socks5man.socks5.measure_bandwidth")
     def test_approx_bandwidth_fail(self, ma):
         create_cwd(cwd())
         ma.return_value = None
@@ -170,11 +235,10 @@ class TestSocks5(object):
         db_socks5_2 = self.db.view_socks5(1)
         assert db_socks5_2.bandwidth is None
 
-    @mock.patch("socks5man.socks5.socks")
-    def test_measure_conn_time(self, ms):
+    @mock.patch("socks5man.socks5.ameasure_connect_time")
+    def test_measure_conn_time(self, mm):
         create_cwd(cwd())
-        socksocket = mock.MagicMock()
-        ms.socksocket.return_value = socksocket
+        mm.return_value = 0.25
         self.db.add_socks5(
             "example.com", 1337, "germany", "DE",
             city="Frankfurt", operational=False, username="doge",
@@ -184,22 +248,17 @@ class TestSocks5(object):
         s = Socks5(db_socks5)
         res = s.measure_connection_time()
 
-        assert isinstance(res, float)
-        socksocket.set_proxy.assert_called_once_with(
-            ms.SOCKS5, "example.com", 1337, username="doge", password="wow"
-        )
-        socksocket.settimeout.assert_called_once_with(3)
-        socksocket.connect.assert_called_once_with(
-            ("api.ipify.org", 80)
+        assert res == 0.25
+        mm.assert_called_once_with(
+            "example.com", 1337, "api.ipify.org", 80, username="doge",
+            password="wow", timeout=3
         )
         assert self.db.view_socks5(1).connect_time == res
 
-    @mock.patch("socks5man.socks5.socks")
-    def test_measure_conn_time_fail(self, ms):
+    @mock.patch("socks5man.socks5.ameasure_connect_time")
+    def test_measure_conn_time_fail(self, mm):
         create_cwd(cwd())
-        socksocket = mock.MagicMock()
-        ms.socksocket.return_value = socksocket
-        socksocket.connect.side_effect = socket.error
+        mm.return_value = None
         self.db.add_socks5(
             "example.com", 1337, "germany", "DE",
             city="Frankfurt", operational=False, username="doge",
@@ -207,8 +266,53 @@ class TestSocks5(object):
         )
         db_socks5 = self.db.view_socks5(1)
         s = Socks5(db_socks5)
-        s.measure_connection_time() is None
-        self.db.view_socks5(1).connect_time is None
+        assert s.measure_connection_time() is None
+        assert self.db.view_socks5(1).connect_time is None
+
+    def test_check_statistics(self):
+        create_cwd(cwd())
+        self.db.add_socks5("8.8.8.8", 1337, "germany", "DE")
+        self.db.set_operational(1, True)
+        self.db.set_connect_time(1, 0.2)
+        self.db.set_operational(1, False)
+        s = Socks5(self.db.view_socks5(1))
+        assert s.uptime == 0.5
+        assert s.connect_time_ewma == 0.2
+        assert s.connect_time_p95 == 0.2
+        assert s.check_failures == 1
+
+    def test_lease_release(self):
+        create_cwd(cwd())
+        self.db.add_socks5("8.8.8.8", 1337, "germany", "DE", operational=True)
+        db_socks5, lease = self.db.acquire_lease(4, 60)
+        s = Socks5(db_socks5, lease=lease)
+        assert s.lease_expires_on == lease.expires_on
+        assert self.db.count_leases(1) == 1
+        s.release(latency=0.5)
+        assert s.lease_expires_on is None
+        assert self.db.count_leases(1) == 0
+        assert self.db.view_socks5(1).lease_latency == 0.5
+        # Releasing again does nothing
+        s.release(success=False)
+        assert self.db.view_socks5(1).lease_failures == 0
+
+    def test_lease_context_manager(self):
+        create_cwd(cwd())
+        self.db.add_socks5("8.8.8.8", 1337, "germany", "DE", operational=True)
+        db_socks5, lease = self.db.acquire_lease(4, 60)
+        with Socks5(db_socks5, lease=lease) as s:
+            assert self.db.count_leases(1) == 1
+        assert self.db.count_leases(1) == 0
+        assert s.lease_failures == 0
+
+        db_socks5, lease = self.db.acquire_lease(4, 60)
+        try:
+            with Socks5(db_socks5, lease=lease):
+                raise socket.error("Such fail")
+        except socket.error:
+            pass
+        assert self.db.count_leases(1) == 0
+        assert self.db.view_socks5(1).lease_failures == 1
 
     def test_socks5_to_dict(self):
         self.db.add_socks5(
@@ -1,14 +1,36 @@
 from __future__ import absolute_import
+import io
 import mock
+import os
 import socket
+import time
+import urllib.error
 
 from socks5man.config import Config
 from socks5man.database import Database
-from socks5man.misc import set_cwd, create_cwd, cwd
-from socks5man.tools import verify_all
+from socks5man.misc import set_cwd, create_cwd, cwd, md5
+from socks5man.tools import (
+    verify_all, reannotate_geoinfo, update_geodb, VerifyScheduler
+)
+from socks5man import aiosocks5
 
 from tests.helpers import CleanedTempFile
 
+def socks5_mock():
+    """Mock of a Socks5 object of which the asynchronous checks call the
+    synchronous mocks, so call assertions hold for every worker amount"""
+    socks5 = mock.MagicMock()
+    socks5.verify_async = mock.AsyncMock(
+        side_effect=lambda: socks5.verify()
+    )
+    socks5.measure_connection_time_async = mock.AsyncMock(
+        side_effect=lambda: socks5.measure_connection_time()
+    )
+    socks5.approx_bandwidth_async = mock.AsyncMock(
+        side_effect=lambda: socks5.approx_bandwidth()
+    )
+    return socks5
+
 class TestVerifyAll(object):
     def setup_class(self):
         self.tempfile = CleanedTempFile()
@@ -18,13 +40,16 @@ class TestVerifyAll(object):
 
     def setup(self):
         set_cwd(self.tempfile.mkdtemp())
+        create_cwd(cwd())
+        # Tests change config values in the cache
+        Config().read()
         self.db = Database()
         self.db.connect(create=True)
 
     @mock.patch("socks5man.tools.Socks5")
     def test_success(self, ms):
         create_cwd(cwd())
-        socks5 = mock.MagicMock()
+        socks5 = socks5_mock()
         socks5.host = "8.8.8.8"
         socks5.port = 4242
         ms.return_value = socks5
@@ -38,7 +63,7 @@ class TestVerifyAll(object):
     @mock.patch("socks5man.tools.Socks5")
     def test_fail(self, ms):
         create_cwd(cwd())
-        socks5 = mock.MagicMock()
+        socks5 = socks5_mock()
         socks5.host = "8.8.8.8"
         socks5.port = 4242
         socks5.verify.return_value = False
@@ -53,7 +78,7 @@ class TestVerifyAll(object):
     @mock.patch("socks5man.tools.Socks5")
     def test_bandwidth(self, ms):
         create_cwd(cwd())
-        socks5 = mock.MagicMock()
+        socks5 = socks5_mock()
         socks5.host = "8.8.8.8"
         socks5.port = 4242
         ms.return_value = socks5
@@ -69,7 +94,7 @@ class TestVerifyAll(object):
     @mock.patch("socks5man.tools.Socks5")
     def test_conntime_fail(self, ms):
         create_cwd(cwd())
-        socks5 = mock.MagicMock()
+        socks5 = socks5_mock()
         socks5.host = "8.8.8.8"
         socks5.port = 4242
         socks5.measure_connection_time.return_value = False
@@ -87,7 +112,7 @@ class TestVerifyAll(object):
     @mock.patch("socks5man.tools.Socks5")
     def test_download_verify_fail(self, ms, mu):
         create_cwd(cwd())
-        socks5 = mock.MagicMock()
+        socks5 = socks5_mock()
         socks5.host = "8.8.8.8"
         socks5.port = 4242
         ms.return_value = socks5
@@ -101,3 +126,346 @@ class TestVerifyAll(object):
         mu.assert_called_once_with(mock.ANY, timeout=5)
         socks5.approx_bandwidth.assert_not_called()
         Config._cache["bandwidth"]["enabled"] = False
+
+    @mock.patch("socks5man.tools.Socks5")
+    def test_workers(self, ms):
+        create_cwd(cwd())
+        socks5s = []
+        def new_socks5(db_socks5, results=None):
+            socks5 = socks5_mock()
+            socks5.host = db_socks5.host
+            socks5.port = db_socks5.port
+            socks5s.append(socks5)
+            return socks5
+        ms.side_effect = new_socks5
+        for i in range(20):
+            self.db.add_socks5("8.8.8.%s" % i, 4242, "Germany", "DE")
+
+        verify_all(workers=5)
+        assert len(socks5s) == 20
+        for socks5 in socks5s:
+            socks5.verify_async.assert_awaited_once()
+            socks5.verify.assert_called_once()
+            socks5.measure_connection_time.assert_called_once()
+            socks5.approx_bandwidth.assert_not_called()
+
+    @mock.patch("socks5man.tools.Socks5")
+    def test_workers_check_error(self, ms):
+        create_cwd(cwd())
+        socks5s = []
+        def new_socks5(db_socks5, results=None):
+            socks5 = socks5_mock()
+            if not socks5s:
+                socks5.verify_async.side_effect = ValueError("wow")
+            socks5s.append(socks5)
+            return socks5
+        ms.side_effect = new_socks5
+        for i in range(5):
+            self.db.add_socks5("8.8.8.%s" % i, 4242, "Germany", "DE")
+
+        verify_all(workers=2)
+        assert len(socks5s) == 5
+        for socks5 in socks5s[1:]:
+            socks5.verify.assert_called_once()
+
+    @mock.patch("socks5man.tools.Socks5")
+    def test_single_worker(self, ms):
+        create_cwd(cwd())
+        socks5 = socks5_mock()
+        ms.return_value = socks5
+        self.db.add_socks5("8.8.8.8", 4242, "Germany", "DE")
+
+        verify_all(workers=1)
+        socks5.verify.assert_called_once()
+        socks5.verify_async.assert_not_called()
+        socks5.measure_connection_time.assert_called_once()
+        socks5.measure_connection_time_async.assert_not_called()
+
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    @mock.patch("socks5man.tools.Socks5")
+    def test_workers_bandwidth_download_verified_once(self, ms, mu):
+        create_cwd(cwd())
+        socks5 = socks5_mock()
+        ms.return_value = socks5
+        for i in range(10):
+            self.db.add_socks5("8.8.8.%s" % i, 4242, "Germany", "DE")
+        Config._cache["bandwidth"]["enabled"] = True
+
+        verify_all(workers=4)
+        mu.assert_called_once_with(mock.ANY, timeout=5)
+        assert socks5.approx_bandwidth.call_count == 10
+        Config._cache["bandwidth"]["enabled"] = False
+
+class TestVerifyScheduler(object):
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        create_cwd(cwd())
+        Config().read()
+        self.db = Database()
+        self.db.connect(create=True)
+
+    def test_refresh(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        self.db.add_socks5("8.8.8.8", 2, "Germany", "DE")
+        self.db.set_operational(2, True)
+        now = time.time()
+        s = VerifyScheduler()
+        s.refresh(now=now)
+
+        assert s.pop_due(now).socks5.id == 1
+        assert s.pop_due(now) is None
+        next_due = s.next_due()
+        assert now + 295 < next_due <= now + 300
+        assert s.pop_due(next_due).socks5.id == 2
+
+    def test_refresh_removed(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        s = VerifyScheduler()
+        s.refresh()
+        self.db.remove_socks5(1)
+        s.refresh()
+        assert s.pop_due() is None
+        assert s.next_due() is None
+
+    def test_refresh_recently_used(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        now = time.time()
+        s = VerifyScheduler()
+        s.refresh(now=now)
+        s.record(s.pop_due(now), True, now=now)
+        assert s.next_due() == now + 300
+
+        self.db.mark_used(1)
+        s.refresh(now=now)
+        assert s.next_due() == now + 60
+
+    def test_backoff(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        now = time.time()
+        s = VerifyScheduler()
+        s.refresh(now=now)
+        intervals = []
+        for _ in range(10):
+            schedule = s.pop_due(now + 10 ** 6)
+            s.record(schedule, False, now=now)
+            intervals.append(schedule.next_due - now)
+
+        assert intervals[:4] == [300, 600, 1200, 2400]
+        assert intervals[-1] == 86400
+
+    def test_stable(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        now = time.time()
+        s = VerifyScheduler()
+        s.refresh(now=now)
+        intervals = []
+        for _ in range(30):
+            schedule = s.pop_due(now + 10 ** 6)
+            s.record(schedule, True, now=now)
+            intervals.append(schedule.next_due - now)
+
+        assert intervals[0] == 300
+        assert intervals[4] == 600
+        assert intervals[9] == 1200
+        assert intervals[-1] == 3600
+
+    def test_flapping(self):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE")
+        now = time.time()
+        s = VerifyScheduler()
+        s.refresh(now=now)
+        for operational in (True, False, True):
+            schedule = s.pop_due(now + 10 ** 6)
+            s.record(schedule, operational, now=now)
+
+        assert schedule.next_due == now + 60
+
+    @mock.patch("socks5man.tools.Socks5")
+    def test_run(self, ms):
+        for i in range(3):
+            self.db.add_socks5("8.8.8.%s" % i, 4242, "Germany", "DE")
+        s = VerifyScheduler(workers=2)
+        checked = []
+        def new_socks5(db_socks5, results=None):
+            socks5 = socks5_mock()
+            socks5.host = db_socks5.host
+            def verify():
+                checked.append(db_socks5.id)
+                if len(checked) == 3:
+                    s.stop()
+                return db_socks5.id != 2
+            socks5.verify.side_effect = verify
+            return socks5
+        ms.side_effect = new_socks5
+
+        now = time.time()
+        aiosocks5.run(s.run())
+        assert sorted(checked) == [1, 2, 3]
+        for schedule in s.schedules.values():
+            assert not schedule.checking
+            assert schedule.next_due >= now + 300
+        assert s.schedules[2].failures == 1
+        assert s.schedules[1].successes == 1
+
+    @mock.patch("socks5man.tools.VerifyScheduler")
+    def test_verify_all_repeated(self, mv):
+        mv.return_value.run = mock.AsyncMock()
+        verify_all(repeated=True, workers=3)
+        mv.assert_called_once_with(
+            operational=None, unverified=None, workers=3,
+            results=mock.ANY, bandwidth_state=mock.ANY
+        )
+        mv.return_value.run.assert_awaited_once()
+
+class TestReannotateGeoinfo(object):
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        self.db = Database()
+        self.db.connect(create=True)
+
+    @mock.patch("socks5man.tools.GeoInfo")
+    def test_reannotate(self, mg):
+        self.db.add_socks5("8.8.8.8", 1, "Germany", "DE", city="Berlin")
+        self.db.add_socks5("8.8.4.4", 1, "unknown", "unknown")
+        self.db.add_socks5("example.invalid", 1, "Germany", "DE")
+        germany = {
+            "country": "Germany", "country_code": "DE", "city": "Berlin"
+        }
+        mg.unknown.return_value = {
+            "country": "unknown", "country_code": "unknown", "city": "unknown"
+        }
+        mg.ipv4info_many.side_effect = lambda ips: [
+            dict(germany) if ip else mg.unknown() for ip in ips
+        ]
+
+        with mock.patch(
+                "socks5man.tools.get_resolver"
+        ) as mr, mock.patch.object(
+            self.db, "bulk_update_geoinfo", wraps=self.db.bulk_update_geoinfo
+        ) as mu:
+            mr.return_value.resolve_many.side_effect = lambda hosts: dict(
+                (h, None if h == "example.invalid" else h) for h in hosts
+            )
+            assert reannotate_geoinfo(chunk_size=2) == 2
+
+        mg.reset.assert_called_once_with()
+        assert mg.ipv4info_many.call_args_list == [
+            mock.call(["8.8.8.8", "8.8.4.4"]), mock.call([None])
+        ]
+        assert mu.call_count == 2
+        assert [
+            (s.country, s.country_code, s.city)
+            for s in self.db.list_socks5()
+        ] == [
+            ("Germany", "DE", "Berlin"), ("Germany", "DE", "Berlin"),
+            ("unknown", "unknown", "unknown")
+        ]
+
+class TestUpdateGeodb(object):
+    def setup_class(self):
+        self.tempfile = CleanedTempFile()
+
+    def teardown_class(self):
+        self.tempfile.clean()
+
+    def setup(self):
+        set_cwd(self.tempfile.mkdtemp())
+        create_cwd(cwd())
+        Config().read()
+        self.mmdb = cwd("geodb", "extracted", "geodblite.mmdb")
+        with open(cwd("geodb", "geodblite.tar.gz"), "rb") as fp:
+            self.tar = fp.read()
+
+    def urlopen(self, version, tar=None):
+        def urlopen(url):
+            if url.endswith(".md5"):
+                return io.BytesIO(version.encode("utf-8") + b"\n")
+            if tar is None:
+                raise urllib.error.URLError("unreachable")
+            return io.BytesIO(tar)
+        return urlopen
+
+    @mock.patch("socks5man.tools.reannotate_geoinfo")
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    def test_latest(self, mu, mr):
+        mu.side_effect = self.urlopen(md5(cwd("geodb", "geodblite.tar.gz")))
+        update_geodb()
+        assert mu.call_count == 1
+        mr.assert_not_called()
+
+    @mock.patch("socks5man.tools.reannotate_geoinfo")
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    def test_update(self, mu, mr):
+        with open(cwd("geodb", ".version"), "w") as fp:
+            fp.write("old")
+        inode = os.stat(self.mmdb).st_ino
+        version = md5(cwd("geodb", "geodblite.tar.gz"))
+        mu.side_effect = self.urlopen(version, self.tar)
+
+        update_geodb()
+        mr.assert_called_once_with(10000)
+        with open(cwd("geodb", ".version"), "r") as fp:
+            assert fp.read() == version
+        # The mmdb is replaced by a new file, so readers notice the change
+        assert os.stat(self.mmdb).st_ino != inode
+        assert not [
+            f for f in os.listdir(cwd("geodb", "extracted"))
+            if f.endswith(".tmp")
+        ]
+        assert not [
+            f for f in os.listdir(cwd("geodb")) if f.endswith(".download")
+        ]
+
+    @mock.patch("socks5man.tools.reannotate_geoinfo")
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    def test_update_old_config(self, mu, mr):
+        # Configs created before update_chunk_size existed
+        with open(cwd("conf", "socks5man.conf"), "w") as fw:
+            fw.write("[geodb]\ngeodb_url = http://example.com/geo.tar.gz\n")
+        Config().read()
+        with open(cwd("geodb", ".version"), "w") as fp:
+            fp.write("old")
+        mu.side_effect = self.urlopen(
+            md5(cwd("geodb", "geodblite.tar.gz")), self.tar
+        )
+
+        update_geodb()
+        mr.assert_called_once_with(10000)
+
+    @mock.patch("socks5man.tools.reannotate_geoinfo")
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    def test_update_md5_mismatch(self, mu, mr):
+        inode = os.stat(self.mmdb).st_ino
+        mu.side_effect = self.urlopen("0" * 32, self.tar)
+
+        update_geodb()
+        mr.assert_not_called()
+        assert os.stat(self.mmdb).st_ino == inode
+        with open(cwd("geodb", ".version"), "r") as fp:
+            assert fp.read() == md5(cwd("geodb", "geodblite.tar.gz"))
+        assert not [
+            f for f in os.listdir(cwd("geodb")) if f.endswith(".download")
+        ]
+
+    @mock.patch("socks5man.tools.reannotate_geoinfo")
+    @mock.patch("socks5man.tools.urllib.request.urlopen")
+    def test_update_download_fail(self, mu, mr):
+        inode = os.stat(self.mmdb).st_ino
+        mu.side_effect = self.urlopen("0" * 32)
+
+        update_geodb()
+        mr.assert_not_called()
+        assert os.stat(self.mmdb).st_ino == inode
+        assert os.path.isfile(self.mmdb)